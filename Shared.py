@@ -1,16 +1,233 @@
-from multiprocessing import Manager
+from multiprocessing import Event, Lock, RawArray
+import ctypes
 
-''' Shared object between processes '''
+''' Shared object between processes
+
+    The index lives in shared memory: a fixed-size table of keys, a state and
+    an integer value per slot, and a readiness event per slot. It is created
+    before any worker is forked so that every process of the pipeline
+    inherits it. Reads are plain memory accesses, updates are done under a
+    single lock without any round-trip to a manager process.
+
+    When the node is an agent of a multi-node run, the objects becoming
+    ready and the products released are also forwarded to the index of the
+    coordinator, see cluster.
+'''
+
+# Maximum number of objects which can be subscribed to the shared index.
+MAX_SUBSCRIPTIONS = 256
+# Maximum length of a key in bytes.
+KEY_SIZE = 128
+
+# States of an object in the index.
+ABSENT = 0
+REGISTERED = 1
+DOWNLOADING = 2
+READY = 3
+FAILED = 4
+
+# Separator between the product and the object name in the keys.
+KEY_SEP = '/'
+
+
+def _encode(k):
+    return k.encode('utf-8')
+
+
+def key(product, name):
+    """Returns the index key of the object 'name' of the product 'product' so
+    that several products can be in flight at the same time."""
+    return product + KEY_SEP + name
 
 
 class Shared:
 
-    def __init__(self):
-        self.dict = Manager().dict()
+    def __init__(self, size=MAX_SUBSCRIPTIONS):
+        self.lock = Lock()
+        self.table = RawArray(ctypes.c_char * KEY_SIZE, size)
+        self.states = RawArray(ctypes.c_byte, size)
+        self.values = RawArray(ctypes.c_long, size)
+        self.events = [Event() for _ in range(size)]
+        self._slots = {}  # per process cache of the key-to-slot table
+        # index of the coordinator of a multi-node run, cluster.RemoteIndex
+        self.remote = None
+
+    def _lookup(self, k):
+        """Returns the slot of the object 'k' or None if not in the index."""
+        encoded = _encode(k)
+        slot = self._slots.get(k)
+        if slot is not None and self.states[slot] != ABSENT and self.table[slot].value == encoded:
+            return slot
+        for slot in range(len(self.table)):
+            if self.states[slot] != ABSENT and self.table[slot].value == encoded:
+                self._slots[k] = slot
+                return slot
+        return None
+
+    def _slot(self, k):
+        slot = self._lookup(k)
+        if slot is None:
+            raise KeyError(k)
+        return slot
+
+    def _register(self, k):
+        """Must be called with the lock held."""
+        slot = self._lookup(k)
+        if slot is not None:
+            return slot
+        encoded = _encode(k)
+        if len(encoded) >= KEY_SIZE:
+            raise Exception('Key %s is longer than %d bytes.' % (k, KEY_SIZE - 1))
+        for slot in range(len(self.table)):
+            if self.states[slot] == ABSENT:
+                self.table[slot].value = encoded
+                self.values[slot] = 0
+                self.events[slot].clear()
+                self.states[slot] = REGISTERED
+                self._slots[k] = slot
+                return slot
+        raise Exception('Shared index is full, cannot subscribe %s.' % k)
+
+    def __contains__(self, k):
+        return self._lookup(k) is not None
+
+    def keys(self):
+        return [self.table[s].value.decode('utf-8')
+                for s in range(len(self.table)) if self.states[s] != ABSENT]
+
+    def release(self, product):
+        """Removes all the objects of the product 'product' from the index and
+        frees their slots.
+
+        :param product: product name
+        :return:
+        """
+        prefix = _encode(key(product, ''))
+        with self.lock:
+            for slot in range(len(self.table)):
+                if self.states[slot] != ABSENT and self.table[slot].value.startswith(prefix):
+                    self.states[slot] = ABSENT
+                    self.events[slot].clear()
+        if self.remote is not None:
+            self.remote.release(product)
+
+    def snapshot(self):
+        """Returns a copy of the index as a dict {key: (state, value)}."""
+        return dict((self.table[s].value.decode('utf-8'), (self.states[s], self.values[s]))
+                    for s in range(len(self.table)) if self.states[s] != ABSENT)
+
+    def __repr__(self):
+        return repr(self.snapshot())
 
     def write(self, k, v):
-        self.dict[k] = v
+        """Sets the object 'k', registering it if needed. A boolean sets
+        its readiness, any other value is stored as its integer value.
+
+        :param k: object key
+        :param v: readiness flag or integer value
+        :return:
+        """
+        with self.lock:
+            slot = self._register(k)
+            if isinstance(v, bool):
+                self.states[slot] = READY if v else REGISTERED
+                if v:
+                    self.events[slot].set()
+                else:
+                    self.events[slot].clear()
+            else:
+                self.values[slot] = v
+        if v is True and self.remote is not None:
+            self.remote.notify(k)
+
+    def read(self, k):
+        """Returns the integer value of the object 'k'."""
+        return self.values[self._slot(k)]
+
+    def is_ready(self, k):
+        return self.states[self._slot(k)] == READY
+
+    def state(self, k):
+        slot = self._lookup(k)
+        return ABSENT if slot is None else self.states[slot]
+
+    def increment(self, k, n=1):
+        """Atomically increments the value of the object 'k'.
+
+        :return: the new value
+        """
+        return self.decrement(k, -n)
+
+    def decrement(self, k, n=1):
+        """Atomically decrements the value of the object 'k'.
+
+        :return: the new value
+        """
+        slot = self._slot(k)
+        with self.lock:
+            self.values[slot] -= n
+            return self.values[slot]
+
+    def transition(self, k, old, new):
+        """Atomically moves the object 'k' from the state 'old' to 'new'.
+
+        :return: True if the transition took place
+        """
+        slot = self._slot(k)
+        with self.lock:
+            if self.states[slot] != old:
+                return False
+            self.states[slot] = new
+            return True
+
+    def subscribe(self, k):
+        """Registers the object 'k' to the index if not already done and
+        returns the slot of its readiness event.
+
+        :param k: object key
+        :return: slot number
+        """
+        with self.lock:
+            return self._register(k)
+
+    def notify(self, k):
+        """Marks the object 'k' as ready and wakes up the processes waiting
+        on it.
+
+        :param k: object key
+        :return:
+        """
+        slot = self._slot(k)
+        self.states[slot] = READY
+        self.events[slot].set()
+        if self.remote is not None:
+            self.remote.notify(k)
+
+    def fail(self, k):
+        """Marks the object 'k' as failed and wakes up the processes waiting
+        on it, see wait.
+
+        :param k: object key
+        :return:
+        """
+        slot = self._slot(k)
+        self.states[slot] = FAILED
+        self.events[slot].set()
+
+    def wait(self, keys, timeout=None):
+        """Blocks until all the objects in 'keys' are ready.
+
+        :param keys: list of subscribed object keys
+        :param timeout: seconds to wait for each object, None for no limit
+        :return: True if all the objects are ready
+        :raise Exception: if any of the objects failed
+        """
+        slots = [self._slot(k) for k in keys]
+        ready = all([self.events[s].wait(timeout) for s in slots])
+        failed = [k for k, s in zip(keys, slots) if self.states[s] == FAILED]
+        if failed:
+            raise Exception('Objects %s failed to download.' % ', '.join(failed))
+        return ready
 
 
 shared = Shared()
-shared.write("meta", False)
@@ -0,0 +1,145 @@
+from contextlib import contextmanager
+from multiprocessing import Condition, RawArray
+import multiprocessing
+import os
+
+import metrics
+import product_meta as pm
+import staging
+from utils import config_get_num
+from log import get_logger
+
+logger = get_logger()
+
+''' Admission control of the processing tasks.
+
+    A task is admitted once the cpus and the memory it needs fit in the
+    budgets of the machine, otherwise it waits for running tasks to finish.
+    The memory of a task is estimated as the heap of the JVM plus the
+    footprint of its rasters. The budgets are shared by all the processes
+    forked after the import of the module, whether the tasks run in the
+    product processes or in the processing workers, and only the processing
+    is admitted: the downloads of the tasks waiting go on.
+
+    The holders of the resources are kept in a table in shared memory with
+    their pid, so that the resources of a process which died are given
+    back.
+'''
+
+MB = 1024 ** 2
+
+# Maximum number of tasks running at the same time.
+MAX_HOLDERS = 256
+# Period in seconds of the check of the dead holders while waiting.
+POLL = 1.
+
+# Cpus used by a task.
+TASK_CPUS = config_get_num('task_cpus', 1, float)
+# Heap of the JVM of a task.
+TASK_HEAP = config_get_num('task_heap_mb', 1024) * MB
+# Bytes per pixel of a band at its resolution, decoded from JPEG 2000.
+NATIVE_BYTES_PER_PIXEL = 2
+# Bytes per pixel of a band resampled, or of an index.
+PROCESSING_BYTES_PER_PIXEL = 4
+
+
+def _physical_memory():
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+CPU_BUDGET = config_get_num('cpu_budget', multiprocessing.cpu_count(), float)
+# 80% of the memory not reserved for the staging area by default.
+MEMORY_BUDGET = config_get_num('memory_budget_mb', 0) * MB or \
+    max(TASK_HEAP, int(0.8 * _physical_memory()) - staging.STAGING_MEMORY)
+
+_cond = Condition()
+_pids = RawArray('i', MAX_HOLDERS)
+_cpus = RawArray('d', MAX_HOLDERS)
+_memory = RawArray('d', MAX_HOLDERS)
+
+
+def configure(cpus=None, memory=None):
+    """Sets the budgets. Must be called before the processes are forked.
+
+    :param cpus: number of cpus
+    :param memory: bytes
+    """
+    global CPU_BUDGET, MEMORY_BUDGET
+    CPU_BUDGET = cpus or CPU_BUDGET
+    MEMORY_BUDGET = memory or MEMORY_BUDGET
+
+
+def task_cost(bands, nb_indices=1, roi=None):
+    """Returns the (cpus, memory in bytes) of a task estimated from the
+    rasters it reads and writes.
+
+    :param bands: band names
+    :param nb_indices: number of indices computed by the task
+    :param roi: (x, y, w, h) region of interest in pixels of the processing grid
+    """
+    _, _, w, h = roi or pm.SUBSET_REGION
+    pixels = w * h
+    rasters = 0
+    for band in bands:
+        scale = pm.PROCESSING_RESOLUTION // pm.BAND_RESOLUTION.get(band, pm.PROCESSING_RESOLUTION)
+        rasters += pixels * (scale ** 2 * NATIVE_BYTES_PER_PIXEL + PROCESSING_BYTES_PER_PIXEL)
+    rasters += pixels * nb_indices * PROCESSING_BYTES_PER_PIXEL
+    return TASK_CPUS, TASK_HEAP + rasters
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def _reap():
+    """Frees the resources of the dead holders. Must be called with the
+    condition held."""
+    for i in range(MAX_HOLDERS):
+        if _pids[i] and not _alive(_pids[i]):
+            logger.warn('Admission: process %d died holding %g cpus and %d MB.',
+                        _pids[i], _cpus[i], _memory[i] // MB)
+            _pids[i] = 0
+
+
+def _fits(cpus, memory):
+    used_cpus = sum(_cpus[i] for i in range(MAX_HOLDERS) if _pids[i])
+    used_memory = sum(_memory[i] for i in range(MAX_HOLDERS) if _pids[i])
+    # a task larger than the budgets runs alone
+    if not any(_pids):
+        return True
+    return used_cpus + cpus <= CPU_BUDGET and used_memory + memory <= MEMORY_BUDGET
+
+
+@contextmanager
+def admitted(cost, name=''):
+    """Blocks until the task fits in the budgets and holds its resources
+    until the exit of the context.
+
+    :param cost: (cpus, memory in bytes) as returned by task_cost
+    :param name: name of the task in the metrics
+    """
+    cpus, memory = cost
+    with metrics.Timer('admission', name, cpus=cpus, memory_mb=memory // MB):
+        with _cond:
+            while True:
+                _reap()
+                if _fits(cpus, memory) and 0 in _pids:
+                    break
+                _cond.wait(POLL)
+            slot = list(_pids).index(0)
+            _pids[slot] = os.getpid()
+            _cpus[slot] = cpus
+            _memory[slot] = memory
+    try:
+        yield
+    finally:
+        with _cond:
+            _pids[slot] = 0
+            _cond.notify_all()
@@ -0,0 +1,70 @@
+from __future__ import print_function
+from multiprocessing import Array, Manager, Process, Value
+import sys
+import time
+
+import Shared
+from utils import rdm_sleep
+
+''' Latency benchmark of the band readiness barrier. Compares the polling
+    barrier on a Manager dict, as it was done before the shared index, with
+    the subscribe/notify barrier of the shared index.
+
+    usage: python bench_barrier.py [nb_waiters] [nb_bands] [rounds]
+'''
+
+polled = Manager().dict()
+
+
+def _poll_barrier(bands):
+    while not all(polled[k] for k in bands):
+        rdm_sleep(1)
+
+
+def _event_barrier(bands):
+    Shared.shared.wait(bands)
+
+
+def _waiter(barrier, bands, notified_at, latencies, i):
+    barrier(bands)
+    latencies[i] = time.time() - notified_at.value
+
+
+def _run(barrier, nb_waiters, nb_bands, rnd):
+    bands = ['R%sB%02d' % (rnd, b) for b in range(nb_bands)]
+    for b in bands:
+        Shared.shared.subscribe(b)
+        polled[b] = False
+    notified_at = Value('d', 0.)
+    latencies = Array('d', nb_waiters)
+    waiters = [Process(target=_waiter, args=(barrier, bands, notified_at, latencies, i))
+               for i in range(nb_waiters)]
+    for w in waiters:
+        w.start()
+    time.sleep(.5)  # all the waiters are blocked in the barrier
+
+    for b in bands[:-1]:
+        Shared.shared.notify(b)
+        polled[b] = True
+    notified_at.value = time.time()
+    Shared.shared.notify(bands[-1])
+    polled[bands[-1]] = True
+    for w in waiters:
+        w.join()
+    return list(latencies)
+
+
+def main(nb_waiters, nb_bands, rounds):
+    for name, barrier in (('poll', _poll_barrier), ('event', _event_barrier)):
+        lat = []
+        for r in range(rounds):
+            lat.extend(_run(barrier, nb_waiters, nb_bands, '%s%d' % (name, r)))
+        lat.sort()
+        print('%-6s waiters=%d bands=%d mean=%0.4fs p50=%0.4fs max=%0.4fs' %
+              (name, nb_waiters, nb_bands, sum(lat) / len(lat), lat[len(lat) // 2], lat[-1]))
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:4]]
+    args += [8, 2, 3][len(args):]
+    main(*args)
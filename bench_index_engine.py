@@ -0,0 +1,159 @@
+from __future__ import print_function
+import sys
+import time
+
+import numpy
+
+import index_engine
+
+''' Throughput of the NumPy index engine compared with the SNAP BandMaths
+    operator, and check that both give the same results.
+
+    Synthetic reflectance bands with no-data pixels are evaluated with the
+    expressions of task_planner. The results of the engine are compared
+    pixel by pixel with a scalar evaluation following the semantics of
+    BandMaths and, if snappy is installed, with BandMaths itself.
+
+    usage: python bench_index_engine.py [size] [block_rows]
+'''
+
+# the expressions of task_planner.indices_expr
+INDICES = [('ndvi', '(B7 + B4) != 0 ? (B7 - B4) / (B7 + B4) : -2'),
+           ('ndi45', '(B5 + B4) != 0 ? (B5 - B4) / (B5 + B4) : -2'),
+           ('gndvi', '(B7 + B3) != 0 ? (B7 - B3) / (B7 + B3) : -2')]
+BANDS = ['B3', 'B4', 'B5', 'B7']
+# pixels checked against the scalar evaluation
+SAMPLE = 20000
+
+
+def _bands(size):
+    rnd = numpy.random.RandomState(0)
+    data = {}
+    masks = {}
+    for b in BANDS:
+        dn = rnd.randint(0, 4000, (size, size))
+        dn[:, :size // 50] = 0  # no-data border
+        data[b] = dn / 10000.
+        masks[b] = dn != 0
+    # pixels where the guard of the expressions is false
+    data['B4'][:size // 10, -10:] = 0.
+    data['B7'][:size // 10, -10:] = 0.
+    return data, masks
+
+
+def _scalar(tree, env):
+    """Evaluates the tree on a single pixel with the semantics of BandMaths."""
+    kind = tree[0]
+    if kind == 'num':
+        return tree[1]
+    if kind == 'band':
+        return env[tree[1]]
+    if kind == 'neg':
+        return -_scalar(tree[1], env)
+    if kind == 'cond':
+        return _scalar(tree[2] if _scalar(tree[1], env) != 0 else tree[3], env)
+    op, x, y = tree[1:]
+    x, y = numpy.float64(_scalar(x, env)), numpy.float64(_scalar(y, env))
+    if op == '/':
+        return x / y  # IEEE 754 division by zero, as in Java
+    return {'+': x + y, '-': x - y, '*': x * y,
+            '==': float(x == y), '!=': float(x != y), '<': float(x < y),
+            '<=': float(x <= y), '>': float(x > y), '>=': float(x >= y)}[op]
+
+
+def _check_scalar(expr, data, masks, result):
+    rnd = numpy.random.RandomState(1)
+    size = result.shape[0]
+    numpy.seterr(all='ignore')
+    for _ in range(SAMPLE):
+        i, j = rnd.randint(0, size, 2)
+        if all(masks[b][i, j] for b in expr.bands):
+            expected = numpy.float32(_scalar(expr.tree, dict((b, data[b][i, j]) for b in expr.bands)))
+        else:
+            expected = numpy.float32(index_engine.NO_DATA)
+        if not (expected == result[i, j] or numpy.isnan(expected) and numpy.isnan(result[i, j])):
+            return 'differs at (%d, %d): %r != %r' % (i, j, result[i, j], expected)
+    return 'identical on %d pixels' % SAMPLE
+
+
+def _run_numpy(data, masks, size, block_rows):
+    results = [numpy.empty((size, size), numpy.float32) for _ in INDICES]
+
+    def read_block(names, y, rows):
+        return (dict((b, data[b][y:y + rows]) for b in names),
+                dict((b, masks[b][y:y + rows]) for b in names))
+
+    def write_block(i, y, rows, values):
+        results[i][y:y + rows] = values
+
+    t0 = time.time()
+    index_engine.evaluate_blocks([index_engine.compile_expr(e) for _, e in INDICES],
+                                 read_block, write_block, size, size, block_rows)
+    return time.time() - t0, results
+
+
+def _run_snap(data, masks, size):
+    """Returns the duration and the results of BandMaths, None if snappy is
+    not installed."""
+    try:
+        import snappy
+    except ImportError:
+        return None, None
+    jpy = snappy.jpy
+    Product = jpy.get_type('org.esa.snap.core.datamodel.Product')
+    ProductData = jpy.get_type('org.esa.snap.core.datamodel.ProductData')
+    product = Product('bench', 'bench', size, size)
+    for b in BANDS:
+        band = product.addBand(b, ProductData.TYPE_FLOAT64)
+        band.setNoDataValue(0.)
+        band.setNoDataValueUsed(True)
+        band.setRasterData(ProductData.createInstance(numpy.where(masks[b], data[b], 0.).ravel()))
+    t0 = time.time()
+    results = []
+    for index, expr in INDICES:
+        result = _band_maths(snappy, product, index, expr)
+        values = numpy.zeros(size * size, numpy.float32)
+        result.getBand(index).readPixels(0, 0, size, size, values)
+        results.append(values.reshape(size, size))
+    return time.time() - t0, results
+
+
+def _band_maths(snappy, product, index, expr):
+    jpy = snappy.jpy
+    snappy.GPF.getDefaultInstance().getOperatorSpiRegistry().loadOperatorSpis()
+    BandDescriptor = jpy.get_type('org.esa.snap.core.gpf.common.BandMathsOp$BandDescriptor')
+    target = BandDescriptor()
+    target.name = index
+    target.type = 'float32'
+    target.expression = expr
+    targets = jpy.array('org.esa.snap.core.gpf.common.BandMathsOp$BandDescriptor', 1)
+    targets[0] = target
+    parameters = jpy.get_type('java.util.HashMap')()
+    parameters.put('targetBands', targets)
+    return snappy.GPF.createProduct('BandMaths', parameters, product)
+
+
+def main(size, block_rows):
+    data, masks = _bands(size)
+    mpix = size * size * len(INDICES) / 1e6
+    dt, results = _run_numpy(data, masks, size, block_rows)
+    print('numpy engine  %8.1f Mpixel/s  (%d x %d, %d indices, blocks of %d rows)' %
+          (mpix / dt, size, size, len(INDICES), block_rows))
+    for (index, expr), result in zip(INDICES, results):
+        print('  %-6s scalar check: %s' % (index, _check_scalar(index_engine.compile_expr(expr), data, masks, result)))
+
+    dt, snap_results = _run_snap(data, masks, size)
+    if snap_results is None:
+        print('snap BandMaths skipped, snappy is not installed')
+        return
+    print('snap BandMaths %7.1f Mpixel/s' % (mpix / dt))
+    for (index, _), result, expected in zip(INDICES, results, snap_results):
+        same = numpy.array_equal(result, expected) or \
+            numpy.array_equal(numpy.isnan(result), numpy.isnan(expected)) and \
+            numpy.array_equal(result[~numpy.isnan(result)], expected[~numpy.isnan(expected)])
+        print('  %-6s identical to BandMaths: %s' % (index, same))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1830,
+         int(sys.argv[2]) if len(sys.argv) > 2 else index_engine.BLOCK_ROWS)
@@ -0,0 +1,68 @@
+from __future__ import print_function
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import boto3
+
+import product_downloader as prdl
+from s3_stub import S3Stub
+
+''' Per-object overhead of a new boto3 resource per download, as it was done
+    before the pooled clients, compared with the pooled client of
+    product_downloader. Runs against the local S3 stand-in with a simulated
+    connection setup delay.
+
+    usage: python bench_s3_client.py [nb_objects] [object_size] [connect_delay]
+'''
+
+BUCKET = 'bench'
+
+
+def _populate(root, nb_objects, size):
+    os.makedirs(os.path.join(root, BUCKET, 'objs'))
+    for i in range(nb_objects):
+        with open(os.path.join(root, BUCKET, 'objs', 'obj%04d' % i), 'wb') as f:
+            f.write(os.urandom(size))
+    return ['objs/obj%04d' % i for i in range(nb_objects)]
+
+
+def _resource_per_call(s3conf, key, dest):
+    s3 = boto3.resource('s3', endpoint_url=s3conf['endpoint_url'])
+    s3.Bucket(s3conf['bucket_id']).download_file(key, dest)
+
+
+def _pooled_client(s3conf, key, dest):
+    prdl._get_client(s3conf).download_file(s3conf['bucket_id'], key, dest)
+
+
+def main(nb_objects, size, connect_delay):
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    root = tempfile.mkdtemp()
+    try:
+        keys = _populate(root, nb_objects, size)
+        stub = S3Stub(root, connect_delay=connect_delay).start()
+        s3conf = {'endpoint_url': stub.endpoint_url, 'bucket_id': BUCKET}
+        dest = os.path.join(root, 'out')
+        for name, get in (('resource per call', _resource_per_call),
+                          ('pooled client', _pooled_client)):
+            stub.reset_stats()
+            t0 = time.time()
+            for k in keys:
+                get(s3conf, k, dest)
+            dt = time.time() - t0
+            print('%-18s %7.2f ms/object  connections=%d requests=%d' %
+                  (name, 1e3 * dt / nb_objects, stub.stats['connections'], stub.stats['requests']))
+        stub.shutdown()
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    args = [int(sys.argv[1]) if len(sys.argv) > 1 else 50,
+            int(sys.argv[2]) if len(sys.argv) > 2 else 64 * 1024,
+            float(sys.argv[3]) if len(sys.argv) > 3 else 0.02]
+    main(*args)
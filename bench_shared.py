@@ -0,0 +1,66 @@
+from __future__ import print_function
+from multiprocessing import Manager, Process
+import sys
+import time
+
+import Shared
+
+''' Cost of the shared index operations compared with a Manager dict, and
+    correctness of the atomic decrement under concurrency.
+
+    usage: python bench_shared.py [nb_ops] [nb_procs]
+'''
+
+
+def _timeit(name, func, nb_ops):
+    t0 = time.time()
+    for _ in range(nb_ops):
+        func()
+    dt = time.time() - t0
+    print('%-28s %10.0f ns/op' % (name, 1e9 * dt / nb_ops))
+
+
+def _decrement_index(nb_ops):
+    for _ in range(nb_ops):
+        Shared.shared.decrement('counter')
+
+
+def _decrement_manager(d, nb_ops):
+    for _ in range(nb_ops):
+        d['counter'] += -1
+
+
+def _concurrent(target, args, nb_procs):
+    procs = [Process(target=target, args=args) for _ in range(nb_procs)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+
+def main(nb_ops, nb_procs):
+    d = Manager().dict()
+    d['B04'] = False
+    d['counter'] = 0
+    Shared.shared.write('B04', False)
+    Shared.shared.write('counter', 0)
+
+    _timeit('manager write', lambda: d.__setitem__('B04', True), nb_ops)
+    _timeit('index write', lambda: Shared.shared.write('B04', True), nb_ops)
+    _timeit('manager contains', lambda: 'B04' in d, nb_ops)
+    _timeit('index contains', lambda: 'B04' in Shared.shared, nb_ops)
+    _timeit('manager decrement', lambda: d.__setitem__('counter', d['counter'] - 1), nb_ops)
+    _timeit('index decrement', lambda: Shared.shared.decrement('counter'), nb_ops)
+
+    d['counter'] = nb_ops * nb_procs
+    Shared.shared.write('counter', nb_ops * nb_procs)
+    _concurrent(_decrement_manager, (d, nb_ops), nb_procs)
+    _concurrent(_decrement_index, (nb_ops,), nb_procs)
+    print('after %d x %d concurrent decrements: manager=%d index=%d (expected 0)' %
+          (nb_procs, nb_ops, d['counter'], Shared.shared.read('counter')))
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:3]]
+    args += [10000, 4][len(args):]
+    main(*args)
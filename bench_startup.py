@@ -0,0 +1,46 @@
+from __future__ import print_function
+import subprocess
+import sys
+
+''' Start up time of the entry points of the pipeline and the heavy
+    dependencies they load.
+
+    Each module is imported in a fresh interpreter, as by the coordinator,
+    the planner or a forked download process which inherits the modules
+    of its parent. The import time is the median of the runs, and the heavy
+    dependencies listed are the ones loaded by the import: only the
+    processing workers should load snappy (and start the JVM), matplotlib
+    and NumPy, and only the downloads boto3.
+
+    usage: python bench_startup.py [nb_runs] [module,..]
+'''
+
+MODULES = ['task_planner', 'planner', 'cluster', 'proc_runner', 'product_downloader', 'snap_op']
+HEAVY = ['snappy', 'jpy', 'matplotlib', 'numpy', 'boto3']
+
+_SCRIPT = '''
+import sys, time
+t0 = time.time()
+import %s
+dt = time.time() - t0
+print('%%f %%s' %% (dt, ','.join(m for m in %r if m in sys.modules)))
+'''
+
+
+def _import_time(module):
+    out = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', _SCRIPT % (module, HEAVY)])
+    dt, _, heavy = out.decode('utf-8').strip().splitlines()[-1].partition(' ')
+    return float(dt), heavy
+
+
+def main(nb_runs=5, modules=MODULES):
+    print('%-20s %12s  %s' % ('module', 'import ms', 'heavy modules loaded'))
+    for module in modules:
+        runs = sorted(_import_time(module) for _ in range(nb_runs))
+        dt, heavy = runs[len(runs) // 2]
+        print('%-20s %12.1f  %s' % (module, 1e3 * dt, heavy or '-'))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5,
+         sys.argv[2].split(',') if len(sys.argv) > 2 else MODULES)
@@ -0,0 +1,279 @@
+from __future__ import print_function
+from multiprocessing import Pipe, Process, Value
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import Shared
+from journal import journal
+import metrics
+import product_downloader as prdl
+import product_meta as pm
+from s3_stub import S3Stub
+import task_planner
+
+''' Download and processing benchmark against the local S3 stand-in.
+
+    Synthetic '.SAFE' products are served by s3_stub and the framework is
+    run over a sweep of connection counts, part sizes, hedging multipliers
+    and product counts in two scenarios:
+
+    download - product_downloader.init, get_product_metadata and
+               get_product_data for each product
+    pipeline - task_planner.main over the products with a stub processing
+               function sleeping 'proc-time' seconds, for each number of
+               products prefetched, 0 running them one after the other
+
+    Every run is made in a fresh child process, so that the threads and
+    connections left by a run do not affect the next one and the pipeline
+    scenario forks its workers from a process without download threads.
+    One JSON record per run is appended to the output file with the
+    throughput, time to first task start, per-object latency percentiles
+    and makespan. A fraction of the GETs can be made to straggle or to fail
+    with throttling errors to measure the tail latency mitigation.
+
+    usage: python benchmark.py [--scenario=download,pipeline] [--connections=4,16,auto]
+                               [--part-size-mb=8] [--products=1,4] [--bands=4]
+                               [--band-size-mb=16] [--latency=0.005] [--proc-time=0.5]
+                               [--stragglers=0.02] [--straggler-delay=2] [--errors=0.01]
+                               [--hedge=2,0] [--prefetch=0,1,2] [--out=benchmark.jsonl]
+'''
+
+MB = 1024 ** 2
+BUCKET = 'benchmark'
+BANDS = ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A', 'B09', 'B10', 'B11', 'B12']
+DEFAULTS = {'scenario': 'download,pipeline',
+            'connections': '4,16,auto',
+            'part-size-mb': '8',
+            'products': '1,4',
+            'bands': '4',
+            'band-size-mb': '16',
+            'latency': '0.005',
+            'proc-time': '0.5',
+            'stragglers': '0',
+            'straggler-delay': '2',
+            'errors': '0',
+            'hedge': '2',
+            'prefetch': '0,1,2',
+            'out': 'benchmark.jsonl'}
+
+META_XML = '<?xml version="1.0" encoding="UTF-8"?>' \
+           '<n1:Level-1C_User_Product xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/User_Product_Level-1C.xsd">' \
+           '<n1:General_Info><Product_Info><PRODUCT_TYPE>S2MSI1C</PRODUCT_TYPE>' \
+           '<Product_Organisation><Granule_List><Granule>%s</Granule></Granule_List>' \
+           '</Product_Organisation></Product_Info></n1:General_Info></n1:Level-1C_User_Product>'
+
+first_task_start = Value('d', 0.)
+
+
+def make_product(root, product, nb_bands, band_size):
+    """Writes a synthetic product with the layout of a Sentinel-2 L1C one."""
+    base = os.path.join(root, BUCKET, product)
+    tile = product.split('_')[5]
+    granule = 'GRANULE/L1C_%s/IMG_DATA/' % tile
+    bands = ['%s%s_%s' % (granule, tile, b) for b in BANDS[:nb_bands]]
+    os.makedirs(os.path.join(base, granule))
+    os.makedirs(os.path.join(base, 'QI_DATA'))
+    with open(os.path.join(root, BUCKET, pm.get_meta_from_prod(product)), 'w') as f:
+        f.write(META_XML % ''.join('<IMAGE_FILE>%s</IMAGE_FILE>' % b for b in bands))
+    with open(os.path.join(base, 'QI_DATA', 'MSK_CLOUDS_B00.gml'), 'w') as f:
+        f.write('<gml/>')
+    block = os.urandom(MB)
+    for b in bands:
+        with open(os.path.join(base, b + '.jp2'), 'wb') as f:
+            for _ in range(band_size // MB):
+                f.write(block)
+            f.write(block[:band_size % MB])
+
+
+def _products(n):
+    return ['S2A_MSIL1C_201701%02dT090201_N0204_R007_T35SNA_20170202T090155.SAFE' % (i + 1)
+            for i in range(n)]
+
+
+def _percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100. * len(values)))]
+
+
+def _configure(connections, part_size, hedge):
+    prdl.policy.hedge_multiplier = hedge
+    c = prdl.controller
+    if connections == 'auto':
+        c.min_connections, c.max_connections, c.limit = 1, 64, 8
+    else:
+        c.min_connections = c.max_connections = c.limit = int(connections)
+    c.min_part_size = c.max_part_size = c.part_size = part_size
+
+
+def _run_download(s3conf, products, latencies):
+    download_obj = prdl._download_obj
+
+    def timed_download_obj(*args):
+        t0 = time.time()
+        res = download_obj(*args)
+        latencies.append(time.time() - t0)
+        return res
+
+    prdl._download_obj = timed_download_obj
+    try:
+        for product in products:
+            bands_loc, metadata_loc = prdl.init(s3conf, product)
+            prdl.get_product_metadata(metadata_loc, s3conf, product)
+            prdl.get_product_data(bands_loc, s3conf, None, product)
+            Shared.shared.release(product)
+    finally:
+        prdl._download_obj = download_obj
+
+
+def _download_latencies(fn):
+    """Returns the durations of the object downloads recorded in the
+    metrics file 'fn', made by the forked processes of the pipeline."""
+    latencies = []
+    with open(fn) as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if rec['stage'] in ('metadata', 'band') and not rec['error']:
+                latencies.append(rec['duration'])
+    return latencies
+
+
+def _run_pipeline(s3conf, products, nb_bands, proc_time, prefetch):
+    # two tasks over overlapping bands, as the indices of task_planner
+    bands = BANDS[:nb_bands]
+    tasks = [{'bands': bands[:max(1, nb_bands - 1)], 'index': 'i1'},
+             {'bands': bands[1:] or bands, 'index': 'i2'}]
+    exprs = {'i1': bands[0], 'i2': bands[-1]}
+    proc_func = _StubProcessing(proc_time)
+    task_planner.main([[product, proc_func, tasks] for product in products], exprs, s3conf, prefetch)
+
+
+class _StubProcessing(object):
+    """Processing function recording the start of the first task."""
+
+    def __init__(self, proc_time):
+        self.proc_time = proc_time
+
+    def __call__(self, product_fn_xml, index, index_expr, roi=None):
+        with first_task_start.get_lock():
+            if not first_task_start.value:
+                first_task_start.value = time.time()
+        time.sleep(self.proc_time)
+
+
+def _measure(conn, scenario, s3conf, workdir, connections, part_size, hedge, products, nb_bands, proc_time,
+             prefetch):
+    """Runs the scenario in the child process and sends back its timings."""
+    _configure(connections, part_size, hedge)
+    latencies = []
+    os.chdir(workdir)
+    journal.fn = os.path.join(workdir, os.path.basename(journal.fn))
+    # inherited by the processes forked by the pipeline
+    metrics.METRICS_FILE = os.path.join(workdir, os.path.basename(metrics.METRICS_FILE))
+    t0 = time.time()
+    if scenario == 'download':
+        _run_download(s3conf, products, latencies)
+    else:
+        _run_pipeline(s3conf, products, nb_bands, proc_time, prefetch)
+    makespan = time.time() - t0
+    if scenario == 'pipeline':
+        latencies = _download_latencies(metrics.METRICS_FILE)
+    conn.send({'makespan': makespan,
+               'first_task_start': first_task_start.value - t0 if first_task_start.value else None,
+               'latency_p50': _percentile(latencies, 50),
+               'latency_p90': _percentile(latencies, 90),
+               'latency_p99': _percentile(latencies, 99),
+               'final_connections': prdl.controller.limit})
+    conn.close()
+
+
+def run(scenario, stub, workdir, connections, part_size, hedge, nb_products, nb_bands, band_size, proc_time,
+        prefetch=0):
+    s3conf = {'endpoint_url': stub.endpoint_url, 'bucket_id': BUCKET}
+    stub.reset_stats()
+    first_task_start.value = 0.
+    shutil.rmtree(workdir, True)
+    os.makedirs(workdir)
+    parent, child = Pipe(duplex=False)
+    p = Process(target=_measure, args=(child, scenario, s3conf, workdir, connections, part_size, hedge,
+                                       _products(nb_products), nb_bands, proc_time, prefetch))
+    p.start()
+    child.close()
+    res = parent.recv()
+    p.join()
+    res.update({'scenario': scenario,
+                'connections': connections,
+                'part_size_mb': part_size // MB,
+                'hedge': hedge,
+                'products': nb_products,
+                'prefetch': prefetch,
+                'bands': nb_bands,
+                'band_size_mb': band_size // MB,
+                'requests': stub.stats['requests'],
+                'stragglers': stub.stats['stragglers'],
+                'errors': stub.stats['errors'],
+                'bytes': stub.stats['bytes'],
+                'throughput_mbs': stub.stats['bytes'] / res['makespan'] / MB,
+                'time': time.time()})
+    return res
+
+
+def _get_opts():
+    opts = dict(DEFAULTS)
+    for a in sys.argv[1:]:
+        if a.startswith('--'):
+            k, _, v = a[2:].partition('=')
+            opts[k] = v
+    return opts
+
+
+def main():
+    opts = _get_opts()
+    nb_bands = int(opts['bands'])
+    band_size = int(float(opts['band-size-mb']) * MB)
+    products = [int(n) for n in opts['products'].split(',')]
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    prdl.cache.budget = 0  # every run downloads
+    prdl.MANIFEST_DIR = None  # every run lists
+
+    root = tempfile.mkdtemp(prefix='eo-benchmark-')
+    try:
+        for product in _products(max(products)):
+            make_product(root, product, nb_bands, band_size)
+        stub = S3Stub(root, latency=float(opts['latency']), straggler_rate=float(opts['stragglers']),
+                      straggler_delay=float(opts['straggler-delay']), error_rate=float(opts['errors'])).start()
+        with open(opts['out'], 'a') as out:
+            for scenario in opts['scenario'].split(','):
+                # the downloads alone do not depend on the prefetch
+                prefetches = opts['prefetch'].split(',') if scenario == 'pipeline' else ['0']
+                for connections in opts['connections'].split(','):
+                    for part_size, hedge, nb_products, prefetch in itertools.product(
+                            opts['part-size-mb'].split(','), opts['hedge'].split(','), products, prefetches):
+                        res = run(scenario, stub, os.path.join(root, 'work'), connections,
+                                  int(float(part_size) * MB), float(hedge), nb_products, nb_bands, band_size,
+                                  float(opts['proc-time']), int(prefetch))
+                        out.write(json.dumps(res) + '\n')
+                        out.flush()
+                        print('%(scenario)-8s connections=%(connections)-4s part=%(part_size_mb)dMB '
+                              'hedge=%(hedge)s products=%(products)d prefetch=%(prefetch)d '
+                              'makespan=%(makespan)0.2fs '
+                              'throughput=%(throughput_mbs)0.1fMB/s first_task=%(first_task_start)s '
+                              'p50=%(latency_p50)s p99=%(latency_p99)s' % res)
+        stub.shutdown()
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,389 @@
+from collections import deque
+from multiprocessing.managers import BaseManager
+import os
+import socket
+import threading
+import time
+
+import NoDaemonProcess as ndp
+import Shared
+from utils import CONFIG_FILE, config_get_num, config_get_str
+from log import get_logger
+
+logger = get_logger()
+
+''' Multi-node execution.
+
+    A coordinator owns the units of work of a run, one per product and
+    task, and a readiness index of the objects downloaded on every node. It
+    serves them over TCP with a multiprocessing manager. The agents, one per
+    host or several on the same host, pull units, download and process them
+    with the pipeline of a single VM, and report the objects becoming ready
+    and the units done back to the coordinator.
+
+    An agent claims up to DEPTH products ahead, the units of a product being
+    run together so that its bands are downloaded once. An agent which has
+    nothing left and finds the run queue empty steals half of the products
+    claimed by the busiest agent, with all their units, from the tail of
+    its queue and the products whose objects are not ready on it first.
+
+    The agents send heartbeats: the units of an agent silent for
+    AGENT_TIMEOUT seconds are given to the others, and a unit which failed
+    is run again up to MAX_ATTEMPTS times.
+
+    The manager unpickles the requests it receives, so anyone able to
+    connect with the authentication key can run code on the coordinator.
+    The coordinator listens on the loopback interface unless a host is
+    given, and does not start without a cluster_authkey set by the
+    operator, shared with the agents.
+'''
+
+PORT = config_get_num('cluster_port', 50000)
+# Host the coordinator listens on when none is given.
+HOST = '127.0.0.1'
+AUTHKEY = config_get_str('cluster_authkey', '')
+# Products claimed by an agent, including the ones it runs.
+DEPTH = config_get_num('cluster_depth', 2)
+HEARTBEAT = config_get_num('cluster_heartbeat_s', 5, float)
+AGENT_TIMEOUT = config_get_num('cluster_agent_timeout_s', 30, float)
+MAX_ATTEMPTS = config_get_num('cluster_max_attempts', 2)
+# Period in seconds of the polls of the agents and of the coordinator.
+POLL = 0.5
+# Seconds an agent tries to connect to the coordinator.
+CONNECT_TIMEOUT = 60
+
+
+def parse_address(address):
+    """Returns (host, port) from 'host:port', 'host' or ':port', HOST and
+    PORT being the defaults."""
+    host, _, port = address.partition(':')
+    return host or HOST, int(port or PORT)
+
+
+def _check_authkey(authkey):
+    if not authkey:
+        raise Exception('cluster_authkey is not set in %s, it is required by the coordinator and the agents.'
+                        % CONFIG_FILE)
+
+
+class Coordinator(object):
+    """Queue of the units of a run and readiness index of the agents. The
+    methods are called concurrently by the threads of the manager."""
+
+    def __init__(self, jobs, indices_expr, s3conf):
+        """
+        :param jobs: [[product, processing function, tasks],], the
+                     processing function is set by the agents
+        :param indices_expr: {'index': 'expr',}
+        :param s3conf: {'endpoint_url': '', 'bucket_id': ''}
+        """
+        self.conf = {'indices_expr': indices_expr, 's3conf': s3conf}
+        self.units = [{'id': i, 'product': prod, 'task': task}
+                      for i, (prod, task) in enumerate((j[0], t) for j in jobs for t in j[2])]
+        self._lock = threading.Lock()
+        self._queue = deque(self.units)
+        self._claimed = {}  # {agent: deque of units}
+        self._running = {}  # {unit id: agent}
+        self._seen = {}  # {agent: time of the last call}
+        self._left = set()  # agents told the run is finished
+        self._attempts = dict((u['id'], 0) for u in self.units)
+        self._done = {}  # {unit id: agent}
+        self._failed = set()
+        self._ready = {}  # {object key: set of agents}
+
+    def _keys(self, unit):
+        return [Shared.key(unit['product'], b) for b in unit['task']['bands']]
+
+    def _nb_ready(self, unit, agent):
+        return sum(1 for k in self._keys(unit) if agent in self._ready.get(k, ()))
+
+    def _alive(self, agent):
+        """Must be called with the lock held."""
+        if agent in self._left:
+            return
+        if agent not in self._claimed:
+            self._claimed[agent] = deque()
+            logger.info('Cluster: agent %s joined.', agent)
+        self._seen[agent] = time.time()
+
+    def _requeue(self, units):
+        """Puts the units back at the head of the run queue."""
+        for u in reversed(units):
+            self._queue.appendleft(u)
+
+    def _reap(self):
+        """Gives the units of the silent agents back to the run queue. Must be
+        called with the lock held."""
+        now = time.time()
+        for agent in [a for a in self._seen if now - self._seen[a] > AGENT_TIMEOUT]:
+            running = [self.units[i] for i, a in self._running.items() if a == agent]
+            for u in running:
+                del self._running[u['id']]
+            self._requeue(sorted(running, key=lambda u: u['id']) + list(self._claimed[agent]))
+            self._claimed[agent] = deque()
+            del self._seen[agent]
+            for agents in self._ready.values():
+                agents.discard(agent)
+            logger.warn('Cluster: agent %s lost, %d units running requeued.', agent, len(running))
+
+    def _claim(self, agent):
+        """Moves products from the head of the run queue to the agent up to
+        DEPTH products claimed. Must be called with the lock held."""
+        claimed = self._claimed[agent]
+        while self._queue and len(set(u['product'] for u in claimed)) < DEPTH:
+            product = self._queue[0]['product']
+            for u in [u for u in self._queue if u['product'] == product]:
+                self._queue.remove(u)
+                claimed.append(u)
+
+    def _steal(self, thief):
+        """Moves half of the products claimed by the busiest agent to
+        'thief', with all their units. Must be called with the lock held."""
+        victims = [a for a in self._claimed if a != thief and self._claimed[a]]
+        if not victims:
+            return
+        victim = max(victims, key=lambda a: len(self._claimed[a]))
+        claimed = list(self._claimed[victim])
+        products = []
+        for u in claimed:
+            if u['product'] not in products:
+                products.append(u['product'])
+
+        def readiness(i):
+            units = [u for u in claimed if u['product'] == products[i]]
+            return sum(self._nb_ready(u, victim) - self._nb_ready(u, thief) for u in units)
+        # last in the queue of the victim and with the fewest objects ready on
+        # it and the most on the thief first
+        order = sorted(range(len(products)), key=lambda i: (readiness(i), -i))
+        stolen = set(products[i] for i in order[:max(1, len(products) // 2)])
+        units = [u for u in claimed if u['product'] in stolen]
+        self._claimed[thief].extend(units)
+        self._claimed[victim] = deque(u for u in claimed if u['product'] not in stolen)
+        logger.info('Cluster: %s stole %d products, %d units, of %s.', thief, len(stolen), len(units), victim)
+
+    def _finished(self):
+        return len(self._done) + len(self._failed) == len(self.units)
+
+    def register(self, agent):
+        """Returns the configuration of the run for the agent."""
+        with self._lock:
+            self._alive(agent)
+        return self.conf
+
+    def heartbeat(self, agent):
+        with self._lock:
+            self._alive(agent)
+            self._reap()
+
+    def take(self, agent):
+        """Returns the units of a product to run, [] if there is none to run
+        now, None once the run is finished."""
+        with self._lock:
+            if agent in self._left:
+                # asked again by an agent waiting for its last products
+                return None
+            self._alive(agent)
+            self._reap()
+            self._claim(agent)
+            if not self._claimed[agent]:
+                self._steal(agent)
+            claimed = self._claimed[agent]
+            if not claimed:
+                if not self._finished():
+                    return []
+                self._left.add(agent)
+                del self._seen[agent]
+                return None
+            product = claimed[0]['product']
+            units = [u for u in claimed if u['product'] == product]
+            for u in units:
+                claimed.remove(u)
+                self._running[u['id']] = agent
+            return units
+
+    def complete(self, agent, ids, ok):
+        """Records the end of the units 'ids' run by the agent, a failed unit
+        is queued again until it was tried MAX_ATTEMPTS times."""
+        with self._lock:
+            self._alive(agent)
+            for i in ids:
+                if self._running.get(i) == agent:
+                    del self._running[i]
+                elif ok and i not in self._done:
+                    # given to another agent after a heartbeat was missed
+                    for q in [self._queue] + list(self._claimed.values()):
+                        if self.units[i] in q:
+                            q.remove(self.units[i])
+                else:
+                    continue
+                self._attempts[i] += 1
+                if ok:
+                    self._done[i] = agent
+                elif self._attempts[i] < MAX_ATTEMPTS:
+                    self._requeue([self.units[i]])
+                else:
+                    self._failed.add(i)
+                    logger.error('Cluster: unit %s failed %d times.', self.units[i], self._attempts[i])
+
+    def notify(self, agent, k):
+        """Marks the object 'k' as ready on the agent."""
+        with self._lock:
+            self._ready.setdefault(k, set()).add(agent)
+
+    def release(self, agent, product):
+        """Removes the objects of the product from the index of the agent."""
+        prefix = Shared.key(product, '')
+        with self._lock:
+            for k in [k for k in self._ready if k.startswith(prefix)]:
+                self._ready[k].discard(agent)
+                if not self._ready[k]:
+                    del self._ready[k]
+
+    def ready(self, k):
+        """Returns the agents on which the object 'k' is ready."""
+        with self._lock:
+            return sorted(self._ready.get(k, ()))
+
+    def finished(self):
+        """Returns True once all the units are done and the agents alive
+        were told so."""
+        with self._lock:
+            self._reap()
+            return self._finished() and not self._seen
+
+    def status(self):
+        """Returns the state of the run as a dict."""
+        with self._lock:
+            agents = dict((a, {'claimed': len(self._claimed[a]),
+                               'running': sum(1 for r in self._running.values() if r == a),
+                               'done': sum(1 for d in self._done.values() if d == a)})
+                          for a in self._claimed)
+            return {'units': len(self.units), 'queued': len(self._queue), 'done': len(self._done),
+                    'failed': len(self._failed), 'ready': len(self._ready), 'agents': agents}
+
+
+class _Manager(BaseManager):
+    pass
+
+
+class RemoteIndex(object):
+    """Forwards the readiness of the objects of an agent to the coordinator,
+    set as the 'remote' of the shared index. The processes forked by the
+    agent inherit it and open their own connections."""
+
+    def __init__(self, coordinator, agent):
+        self.coordinator = coordinator
+        self.agent = agent
+
+    def notify(self, k):
+        try:
+            self.coordinator.notify(self.agent, k)
+        except Exception as ex:
+            logger.warn('Cluster: cannot notify %s to the coordinator: %s', k, ex)
+
+    def release(self, product):
+        try:
+            self.coordinator.release(self.agent, product)
+        except Exception as ex:
+            logger.warn('Cluster: cannot release %s on the coordinator: %s', product, ex)
+
+
+def serve(coordinator, address=(HOST, PORT), authkey=AUTHKEY):
+    """Serves the coordinator until all its units are done.
+
+    :param coordinator: Coordinator
+    :param address: (host, port) to listen on
+    :param authkey: key the agents authenticate with
+    :return: the final status of the run
+    """
+    _check_authkey(authkey)
+    _Manager.register('coordinator', callable=lambda: coordinator)
+    manager = _Manager(address=address, authkey=authkey)
+    # the coordinator lives in the process of the manager
+    manager.start()
+    proxy = manager.coordinator()
+    logger.info('Cluster: coordinator listening on %s:%d with %d units.',
+                address[0], address[1], len(coordinator.units))
+    last = time.time()
+    try:
+        while not proxy.finished():
+            time.sleep(POLL)
+            if time.time() - last > HEARTBEAT:
+                last = time.time()
+                logger.info('Cluster: %s', proxy.status())
+        return proxy.status()
+    finally:
+        manager.shutdown()
+
+
+def connect(address, authkey=AUTHKEY):
+    """Returns a proxy of the coordinator at 'address', waiting for it to
+    be up."""
+    _check_authkey(authkey)
+    _Manager.register('coordinator')
+    t0 = time.time()
+    while True:
+        manager = _Manager(address=address, authkey=authkey)
+        try:
+            manager.connect()
+            return manager.coordinator()
+        except socket.error:
+            if time.time() - t0 > CONNECT_TIMEOUT:
+                raise Exception('Coordinator %s:%d not reachable.' % address)
+            time.sleep(POLL)
+
+
+def _heartbeat(coordinator, agent, stop):
+    while not stop.wait(HEARTBEAT):
+        try:
+            coordinator.heartbeat(agent)
+        except Exception as ex:
+            logger.warn('Cluster: heartbeat failed: %s', ex)
+
+
+def run_agent(address, run_job, slots=1):
+    """Pulls the units of the coordinator at 'address' and runs them until
+    the run is finished.
+
+    :param address: (host, port) of the coordinator
+    :param run_job: function(product, tasks, indices_expr, s3conf) run in a
+                    process per product
+    :param slots: number of products run at the same time
+    :return: number of units run
+    """
+    agent = '%s:%d' % (socket.gethostname(), os.getpid())
+    coordinator = connect(address)
+    conf = coordinator.register(agent)
+    logger.info('Cluster: agent %s connected to %s:%d.', agent, address[0], address[1])
+    Shared.shared.remote = RemoteIndex(coordinator, agent)
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(coordinator, agent, stop))
+    heartbeat.daemon = True
+    heartbeat.start()
+    running = []
+    nb_units = 0
+    try:
+        while True:
+            for units, p in [r for r in running if not r[1].is_alive()]:
+                running.remove((units, p))
+                p.join()
+                if p.exitcode != 0:
+                    logger.error('Processing of %s failed with exit code %s.', units[0]['product'], p.exitcode)
+                coordinator.complete(agent, [u['id'] for u in units], p.exitcode == 0)
+            units = coordinator.take(agent) if len(running) < slots else []
+            if units is None and not running:
+                break
+            if not units:
+                time.sleep(POLL)
+                continue
+            logger.info('Cluster: %s runs %s', agent, ', '.join('%s/%s' % (u['product'], u['task']['index'])
+                                                               for u in units))
+            p = ndp.NoDaemonProcess(target=run_job, args=(units[0]['product'], [u['task'] for u in units],
+                                                          conf['indices_expr'], conf['s3conf']))
+            p.start()
+            running.append((units, p))
+            nb_units += len(units)
+    finally:
+        stop.set()
+        Shared.shared.remote = None
+    return nb_units
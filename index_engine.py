@@ -0,0 +1,296 @@
+import re
+
+import numpy
+
+''' Vectorized evaluation of band maths expressions with NumPy.
+
+    Compiles the expressions of the indices, written in the band maths
+    syntax of SNAP, e.g. '(B7 + B4) != 0 ? (B7 - B4) / (B7 + B4) : -2', and
+    evaluates them on whole blocks of pixels instead of pixel by pixel in
+    the JVM. The results are those of the SNAP BandMaths operator: the
+    expression is evaluated in double precision, comparisons and logical
+    operators give 1 or 0, the pixels where any of the bands is not valid
+    are set to NO_DATA and the result is stored as float32.
+
+    The branches of a '?:' are only evaluated on the pixels which select
+    them, so that the guarded divisions are never computed.
+
+    Supported: numbers, band names, + - * / %, unary - and !, comparisons,
+    && || (or 'and' 'or' 'not'), ?:, parentheses and the functions of
+    FUNCTIONS.
+'''
+
+NO_DATA = numpy.nan
+# Default number of rows of a block.
+BLOCK_ROWS = 256
+# Estimate of the memory per pixel of the temporary arrays of an evaluation.
+TEMP_BYTES_PER_PIXEL = 64
+
+FUNCTIONS = {'abs': numpy.abs,
+             'sqrt': numpy.sqrt,
+             'exp': numpy.exp,
+             'log': numpy.log,
+             'pow': numpy.power,
+             'min': numpy.minimum,
+             'max': numpy.maximum}
+
+_TOKEN = re.compile(r'\s*(?:(\d+\.?\d*(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?)'
+                    r'|([A-Za-z_][A-Za-z0-9_.]*)'
+                    r'|(==|!=|<=|>=|&&|\|\||[-+*/%<>!?:(),]))')
+_KEYWORDS = {'and': '&&', 'or': '||', 'not': '!'}
+_BINARY = (('||',), ('&&',), ('==', '!='), ('<', '<=', '>', '>='), ('+', '-'), ('*', '/', '%'))
+
+
+class ExpressionError(Exception):
+    pass
+
+
+def _tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = _TOKEN.match(text, pos)
+        if not m:
+            raise ExpressionError('Unexpected character at %d in: %s' % (pos, text))
+        number, name, op = m.groups()
+        if number:
+            tokens.append(('num', float(number)))
+        elif name in _KEYWORDS:
+            tokens.append(('op', _KEYWORDS[name]))
+        elif name:
+            tokens.append(('name', name))
+        else:
+            tokens.append(('op', op))
+        pos = m.end()
+    return tokens
+
+
+class _Parser(object):
+    """Recursive descent parser building a tree of tuples:
+    ('num', value), ('band', name), ('neg', x), ('not', x),
+    ('bin', op, x, y), ('cond', c, x, y), ('call', function, [args])."""
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = _tokenize(text)
+        self.pos = 0
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def _next(self):
+        tok = self._peek()
+        self.pos += 1
+        return tok
+
+    def _expect(self, op):
+        if self._next() != ('op', op):
+            raise ExpressionError("Expected '%s' at token %d in: %s" % (op, self.pos, self.text))
+
+    def parse(self):
+        tree = self._cond()
+        if self.pos != len(self.tokens):
+            raise ExpressionError('Unexpected %s in: %s' % (self._peek()[1], self.text))
+        return tree
+
+    def _cond(self):
+        c = self._binary(0)
+        if self._peek() == ('op', '?'):
+            self._next()
+            x = self._cond()
+            self._expect(':')
+            return 'cond', c, x, self._cond()
+        return c
+
+    def _binary(self, level):
+        if level == len(_BINARY):
+            return self._unary()
+        x = self._binary(level + 1)
+        while self._peek()[0] == 'op' and self._peek()[1] in _BINARY[level]:
+            op = self._next()[1]
+            x = 'bin', op, x, self._binary(level + 1)
+        return x
+
+    def _unary(self):
+        tok = self._peek()
+        if tok == ('op', '-'):
+            self._next()
+            return 'neg', self._unary()
+        if tok == ('op', '+'):
+            self._next()
+            return self._unary()
+        if tok == ('op', '!'):
+            self._next()
+            return 'not', self._unary()
+        return self._primary()
+
+    def _primary(self):
+        kind, value = self._next()
+        if kind == 'num':
+            return 'num', value
+        if kind == 'name':
+            if self._peek() != ('op', '('):
+                return 'band', value
+            if value not in FUNCTIONS:
+                raise ExpressionError('Unknown function %s in: %s' % (value, self.text))
+            self._next()
+            args = [self._cond()]
+            while self._peek() == ('op', ','):
+                self._next()
+                args.append(self._cond())
+            self._expect(')')
+            return 'call', value, args
+        if (kind, value) == ('op', '('):
+            x = self._cond()
+            self._expect(')')
+            return x
+        raise ExpressionError('Unexpected %s in: %s' % (value, self.text))
+
+
+def _bands(tree):
+    if tree[0] == 'band':
+        return set([tree[1]])
+    if tree[0] == 'call':
+        return set().union(*[_bands(a) for a in tree[2]])
+    return set().union(*[_bands(t) for t in tree[1:] if isinstance(t, tuple)])
+
+
+def _truth(x):
+    return x != 0
+
+
+_OPERATORS = {'+': numpy.add,
+              '-': numpy.subtract,
+              '*': numpy.multiply,
+              '/': numpy.true_divide,
+              '%': numpy.fmod,
+              '==': numpy.equal,
+              '!=': numpy.not_equal,
+              '<': numpy.less,
+              '<=': numpy.less_equal,
+              '>': numpy.greater,
+              '>=': numpy.greater_equal}
+
+
+def _eval(tree, env):
+    """Evaluates the tree on the arrays of 'env', returns an array of
+    float64 or a scalar."""
+    kind = tree[0]
+    if kind == 'num':
+        return numpy.float64(tree[1])
+    if kind == 'band':
+        return env[tree[1]]
+    if kind == 'neg':
+        return -_eval(tree[1], env)
+    if kind == 'not':
+        return numpy.float64(0) + numpy.logical_not(_truth(_eval(tree[1], env)))
+    if kind == 'call':
+        return FUNCTIONS[tree[1]](*[_eval(a, env) for a in tree[2]])
+    if kind == 'cond':
+        return _eval_cond(tree, env)
+    op, x, y = tree[1:]
+    if op == '&&':
+        return numpy.float64(0) + numpy.logical_and(_truth(_eval(x, env)), _truth(_eval(y, env)))
+    if op == '||':
+        return numpy.float64(0) + numpy.logical_or(_truth(_eval(x, env)), _truth(_eval(y, env)))
+    # comparisons give 1 or 0 as in SNAP
+    return numpy.float64(0) + _OPERATORS[op](_eval(x, env), _eval(y, env))
+
+
+def _eval_cond(tree, env):
+    """'c ? x : y' evaluating each branch only on the pixels selecting it."""
+    _, c, x, y = tree
+    mask = _truth(_eval(c, env))
+    if numpy.ndim(mask) == 0:
+        return _eval(x if mask else y, env)
+    if mask.all():
+        return _eval(x, env)
+    if not mask.any():
+        return _eval(y, env)
+    out = numpy.empty(mask.shape)
+    inverse = ~mask
+    out[mask] = _eval(x, dict((k, v[mask]) for k, v in env.items()))
+    out[inverse] = _eval(y, dict((k, v[inverse]) for k, v in env.items()))
+    return out
+
+
+class Expression(object):
+
+    def __init__(self, text):
+        self.text = text
+        self.tree = _Parser(text).parse()
+        # names of the bands the expression refers to
+        self.bands = sorted(_bands(self.tree))
+
+    def __repr__(self):
+        return 'Expression(%r)' % self.text
+
+    def evaluate(self, bands, masks=None, out=None):
+        """Evaluates the expression on a block of pixels.
+
+        :param bands: {band name: array}, arrays of the same shape
+        :param masks: {band name: array of booleans}, False where the pixel
+                      of the band is not valid, None if they are all valid
+        :param out: float32 array the result is written to, allocated if None
+        :return: float32 array
+        """
+        if not self.bands:
+            raise ExpressionError('Expression without band: %s' % self.text)
+        env = dict((b, numpy.asarray(bands[b], numpy.float64)) for b in self.bands)
+        if out is None:
+            out = numpy.empty(env[self.bands[0]].shape, numpy.float32)
+        valid = None
+        for b in self.bands:
+            if masks and masks.get(b) is not None:
+                valid = masks[b] if valid is None else valid & masks[b]
+        if valid is not None and not valid.all():
+            # invalid pixels are not evaluated
+            env = dict((k, v[valid]) for k, v in env.items())
+            with numpy.errstate(all='ignore'):
+                out[valid] = _eval(self.tree, env)
+            out[~valid] = NO_DATA
+        else:
+            with numpy.errstate(all='ignore'):
+                out[...] = _eval(self.tree, env)
+        return out
+
+
+def block_bytes_per_pixel(expressions):
+    """Returns the memory used per pixel of a block by evaluate_blocks with
+    the bands read as float64 with their valid masks."""
+    bands = set().union(*[e.bands for e in expressions])
+    return len(bands) * (8 + 1) + 4 + TEMP_BYTES_PER_PIXEL
+
+
+_compiled = {}
+
+
+def compile_expr(text):
+    """Returns the compiled expression, cached by its text."""
+    if text not in _compiled:
+        _compiled[text] = Expression(text)
+    return _compiled[text]
+
+
+def evaluate_blocks(expressions, read_block, write_block, width, height, block_rows=BLOCK_ROWS):
+    """Evaluates expressions over rasters block of rows by block of rows,
+    each band being read once per block for all the expressions.
+
+    :param expressions: list of Expression
+    :param read_block: function(band names, y, rows) returning
+                       ({band name: array of rows x width},
+                        {band name: valid mask or None})
+    :param write_block: function(index of the expression, y, rows, array)
+    :param width: raster width in pixels
+    :param height: raster height in pixels
+    :param block_rows: number of rows of a block
+    :return:
+    """
+    bands = sorted(set().union(*[e.bands for e in expressions]))
+    out = numpy.empty((block_rows, width), numpy.float32)
+    for y in range(0, height, block_rows):
+        rows = min(block_rows, height - y)
+        data, masks = read_block(bands, y, rows)
+        for i, e in enumerate(expressions):
+            write_block(i, y, rows, e.evaluate(data, masks, out[:rows]))
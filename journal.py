@@ -0,0 +1,192 @@
+import json
+import os
+import threading
+
+from utils import config_get_str
+from log import get_logger
+
+logger = get_logger()
+
+''' Persistent journal of the object downloads.
+
+    Every change of state of a download is appended as a JSON line to
+    JOURNAL_FILE with a single write, so that the lines of concurrent
+    processes are not interleaved and a crash leaves at most a truncated
+    last line, which is ignored. The objects are recorded by the absolute
+    path of their local file and their state is obtained by replaying their
+    lines:
+
+      pending   the download started, with the size, ETag and part size
+      partial   parts were written to the temporary file, listed by offset
+      complete  the file is in place, with its ETag and local size
+
+    After an interrupted run, the complete objects are not downloaded again
+    and the partial ones are resumed from their missing parts.
+
+    Each process keeps the entries it replayed in memory, updated with its
+    own records, and only reads the lines appended to the journal since its
+    last read.
+'''
+
+JOURNAL_FILE = os.path.abspath(os.path.expanduser(config_get_str('journal_file', 'eo-journal.jsonl')))
+
+PENDING = 'pending'
+PARTIAL = 'partial'
+COMPLETE = 'complete'
+
+
+class Journal(object):
+
+    def __init__(self, fn=JOURNAL_FILE):
+        self.fn = fn
+        self._fds = {}
+        self._replayed = {}  # per process entries, see _entries
+
+    def _append(self, rec):
+        rec['key'] = os.path.abspath(rec['key'])
+        pid = os.getpid()
+        if pid not in self._fds:
+            self._fds[pid] = os.open(self.fn, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(self._fds[pid], (json.dumps(rec) + '\n').encode('utf-8'))
+        replayed = self._replayed.get(pid)
+        if replayed is not None:
+            with replayed['lock']:
+                _apply(replayed['entries'], dict(rec))
+
+    def _replay(self):
+        """Returns {key: entry} from the records of the journal."""
+        entries = {}
+        try:
+            f = open(self.fn)
+        except IOError:
+            return entries
+        with f:
+            for line in f:
+                _apply_line(entries, line)
+        return entries
+
+    def _entries(self, pid):
+        """Returns the entries replayed by the process, after replaying the
+        lines appended since its last call. Must be called with the lock of
+        the process held."""
+        replayed = self._replayed[pid]
+        try:
+            st = os.stat(self.fn)
+        except OSError:
+            return replayed['entries']
+        if st.st_ino != replayed['inode'] or st.st_size < replayed['offset']:
+            # rewritten by compact
+            replayed.update(inode=st.st_ino, offset=0, entries={})
+        if st.st_size > replayed['offset']:
+            with open(self.fn) as f:
+                f.seek(replayed['offset'])
+                data = f.read(st.st_size - replayed['offset'])
+            # a line being appended is read once complete
+            end = data.rfind('\n') + 1
+            for line in data[:end].splitlines():
+                _apply_line(replayed['entries'], line)
+            replayed['offset'] += end
+        return replayed['entries']
+
+    def entry(self, k):
+        """Returns the state of the object 'k' as a dict with the fields
+        'state', 'etag', 'size' and, for the pending and partial ones,
+        'part_size' and 'parts', or None if not in the journal."""
+        pid = os.getpid()
+        replayed = self._replayed.get(pid)
+        if replayed is None:
+            replayed = self._replayed.setdefault(pid, {'lock': threading.Lock(), 'inode': None,
+                                                       'offset': 0, 'entries': {}})
+        with replayed['lock']:
+            entry = self._entries(pid).get(os.path.abspath(k))
+            return dict(entry, parts=list(entry['parts'])) if entry else None
+
+    def pending(self, k, size, etag, part_size):
+        self._append({'key': k, 'state': PENDING, 'size': size, 'etag': etag, 'part_size': part_size})
+
+    def part_done(self, k, etag, start):
+        self._append({'key': k, 'state': PARTIAL, 'etag': etag, 'parts': [start]})
+
+    def complete(self, k, size, etag, window=None):
+        """Records the object as downloaded to the local file 'k'.
+
+        :param window: (x, y, w, h) if only the tiles covering it were
+                       downloaded
+        """
+        self._append({'key': k, 'state': COMPLETE, 'size': size, 'etag': etag,
+                      'local_size': os.path.getsize(k), 'window': list(window) if window else None})
+
+    def is_complete(self, k, etag=None, window=None):
+        """Returns True if the object is complete in the journal and its local
+        file is still in place, with the same ETag if given, and covering the
+        window if given."""
+        return self._is_complete(self.entry(k), k, etag, window)
+
+    @staticmethod
+    def _is_complete(entry, k, etag=None, window=None):
+        if entry is None or entry['state'] != COMPLETE:
+            return False
+        if etag is not None and entry['etag'] != etag:
+            return False
+        if entry['window'] is not None and entry['window'] != list(window or []):
+            return False
+        try:
+            return os.path.getsize(k) == entry['local_size']
+        except OSError:
+            return False
+
+    def resumable(self, k, size, etag):
+        """Returns (part size, offsets of the parts written) of an interrupted
+        download of the object which can be resumed, None otherwise."""
+        entry = self.entry(k)
+        if entry is None or entry['state'] not in (PENDING, PARTIAL) or \
+                entry['etag'] != etag or entry['size'] != size:
+            return None
+        return entry['part_size'], sorted(set(entry['parts']))
+
+    def compact(self):
+        """Rewrites the journal with only the current state of the objects.
+        Must be called before the processes appending to it are started."""
+        if not os.path.exists(self.fn):
+            return
+        entries = self._replay()
+        tmp = self.fn + '.tmp'
+        with open(tmp, 'w') as f:
+            for k, entry in sorted(entries.items()):
+                parts = entry.pop('parts')
+                if entry['state'] == PARTIAL:
+                    entry['state'] = PENDING
+                f.write(json.dumps(dict(entry, key=k)) + '\n')
+                if parts:
+                    f.write(json.dumps({'key': k, 'state': PARTIAL, 'etag': entry['etag'], 'parts': parts}) + '\n')
+        os.rename(tmp, self.fn)
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds = {}
+        self._replayed = {}
+        logger.debug('Journal %s compacted, %d objects.', self.fn, len(entries))
+
+
+def _apply_line(entries, line):
+    try:
+        rec = json.loads(line)
+    except ValueError:
+        return  # torn line of a crashed process
+    _apply(entries, rec)
+
+
+def _apply(entries, rec):
+    """Applies the record 'rec' to the entries {key: entry}."""
+    k = rec.pop('key')
+    if rec['state'] == PARTIAL:
+        entry = entries.get(k)
+        if entry is None or entry['etag'] != rec['etag'] or entry['state'] == COMPLETE:
+            return
+        entry['state'] = PARTIAL
+        entry['parts'].extend(rec['parts'])
+    else:
+        rec.setdefault('parts', [])
+        entries[k] = rec
+
+
+journal = Journal()
@@ -0,0 +1,267 @@
+import os
+import struct
+
+''' Window-aware partial retrieval of JPEG 2000 files.
+
+    Only the byte ranges holding the file header, the codestream main header
+    and the tile-parts covering a window of the image are fetched. The local
+    file keeps the structure of the original one: the tiles outside of the
+    window are replaced by empty tile-parts, whose packets carry no data and
+    decode to a constant value, so the result is a valid JPEG 2000 file that
+    can be read by any decoder.
+
+    The functions take a 'get_range(start, end)' callable returning the
+    bytes of the object between the offsets 'start' and 'end' included.
+'''
+
+SOC = 0xFF4F
+SIZ = 0xFF51
+COD = 0xFF52
+TLM = 0xFF55
+PLM = 0xFF57
+PPM = 0xFF60
+SOT = 0xFF90
+SOP = 0xFF91
+EPH = 0xFF92
+SOD = 0xFF93
+EOC = 0xFFD9
+
+# Initial number of bytes fetched to parse the boxes and the main header.
+HEADER_PROBE = 64 * 1024
+# Gap under which two tile-parts ranges are fetched in a single request.
+MERGE_GAP = 64 * 1024
+# Maximum size of a merged range request.
+MAX_RANGE = 16 * 1024 ** 2
+
+
+class Jp2Error(Exception):
+    pass
+
+
+def _ceil_div(a, b):
+    return -(-a // b)
+
+
+class _Head(object):
+    """Head of the remote object, extended on demand."""
+
+    def __init__(self, get_range, size):
+        self.get_range = get_range
+        self.size = size
+        self.data = b''
+
+    def read(self, offset, length):
+        end = offset + length
+        if end > self.size:
+            raise Jp2Error('Read past the end of the object (%d > %d).' % (end, self.size))
+        if end > len(self.data):
+            n = min(self.size, max(end, 2 * len(self.data), HEADER_PROBE))
+            self.data += self.get_range(len(self.data), n - 1)
+        return self.data[offset:end]
+
+
+def _find_codestream(head):
+    """Returns the offsets of the jp2c box, of the codestream start and end."""
+    if head.read(0, 2) == struct.pack('>H', SOC):
+        return None, 0, head.size  # raw codestream
+    offset = 0
+    while offset + 8 <= head.size:
+        lbox, tbox = struct.unpack('>I4s', head.read(offset, 8))
+        hlen = 8
+        if lbox == 1:
+            lbox, = struct.unpack('>Q', head.read(offset + 8, 8))
+            hlen = 16
+        elif lbox == 0:
+            lbox = head.size - offset
+        if tbox == b'jp2c':
+            return offset, offset + hlen, offset + lbox
+        offset += lbox
+    raise Jp2Error('No codestream box found.')
+
+
+def _parse_main_header(head, cs_start):
+    """Returns the image parameters, the main header segments and the offset of
+    the first tile-part."""
+    if head.read(cs_start, 2) != struct.pack('>H', SOC):
+        raise Jp2Error('Codestream does not start with SOC.')
+    info = {'tlm': [], 'precincts': None}
+    segments = []
+    pos = cs_start + 2
+    while True:
+        marker, = struct.unpack('>H', head.read(pos, 2))
+        if marker == SOT:
+            break
+        length, = struct.unpack('>H', head.read(pos + 2, 2))
+        seg = head.read(pos, 2 + length)
+        if marker == SIZ:
+            (info['X'], info['Y'], info['XO'], info['YO'], info['XT'], info['YT'],
+             info['XTO'], info['YTO'], info['C']) = struct.unpack('>IIIIIIIIH', seg[6:40])
+        elif marker == COD:
+            scod = ord(seg[4:5])
+            info['sop'] = bool(scod & 2)
+            info['eph'] = bool(scod & 4)
+            info['layers'], = struct.unpack('>H', seg[6:8])
+            info['levels'] = ord(seg[9:10])
+            if scod & 1:
+                info['precincts'] = [(ord(seg[14 + r:15 + r]) & 0xF, ord(seg[14 + r:15 + r]) >> 4)
+                                     for r in range(info['levels'] + 1)]
+        elif marker == TLM:
+            stlm = ord(seg[5:6])
+            st, sp = (stlm >> 4) & 3, 4 if (stlm >> 6) & 1 else 2
+            fmt = '>' + {0: '', 1: 'B', 2: 'H'}[st] + ('I' if sp == 4 else 'H')
+            step = st + sp
+            for i in range(6, len(seg), step):
+                entry = struct.unpack(fmt, seg[i:i + step])
+                info['tlm'].append(entry if st else (None, entry[0]))
+        elif marker == PPM:
+            raise Jp2Error('Packed packet headers (PPM) are not supported.')
+        segments.append((marker, seg))
+        pos += 2 + length
+    if 'X' not in info or 'layers' not in info:
+        raise Jp2Error('Missing SIZ or COD marker segment.')
+    return info, segments, pos
+
+
+def _tile_parts(get_range, info, first_sot, cs_end):
+    """Returns the list of (tile index, offset, length) of the tile-parts."""
+    parts = []
+    if info['tlm']:
+        pos = first_sot
+        for i, (tile, length) in enumerate(info['tlm']):
+            parts.append((i if tile is None else tile, pos, length))
+            pos += length
+        return parts
+    # No TLM marker, walk the chain of SOT marker segments.
+    pos = first_sot
+    while pos < cs_end - 2:
+        sot = get_range(pos, pos + 11)
+        marker, _, tile, length = struct.unpack('>HHHI', sot[:10])
+        if marker == EOC:
+            break
+        if marker != SOT:
+            raise Jp2Error('Expected SOT marker at offset %d.' % pos)
+        if length == 0:
+            length = cs_end - 2 - pos
+        parts.append((tile, pos, length))
+        pos += length
+    return parts
+
+
+def _tile_grid(info):
+    return (_ceil_div(info['X'] - info['XTO'], info['XT']),
+            _ceil_div(info['Y'] - info['YTO'], info['YT']))
+
+
+def _tile_bounds(info, tile):
+    ntx, _ = _tile_grid(info)
+    p, q = tile % ntx, tile // ntx
+    return (max(info['XTO'] + p * info['XT'], info['XO']),
+            max(info['YTO'] + q * info['YT'], info['YO']),
+            min(info['XTO'] + (p + 1) * info['XT'], info['X']),
+            min(info['YTO'] + (q + 1) * info['YT'], info['Y']))
+
+
+def window_tiles(info, window):
+    """Returns the indices of the tiles intersecting the window (x, y, w, h)
+    given in pixels of the image."""
+    x, y, w, h = window
+    ntx, nty = _tile_grid(info)
+    x0 = max(info['XO'] + x, info['XO'])
+    y0 = max(info['YO'] + y, info['YO'])
+    x1 = min(info['XO'] + x + w, info['X']) - 1
+    y1 = min(info['YO'] + y + h, info['Y']) - 1
+    if x1 < x0 or y1 < y0:
+        return set()
+    tx0, tx1 = (x0 - info['XTO']) // info['XT'], min((x1 - info['XTO']) // info['XT'], ntx - 1)
+    ty0, ty1 = (y0 - info['YTO']) // info['YT'], min((y1 - info['YTO']) // info['YT'], nty - 1)
+    return set(q * ntx + p for q in range(ty0, ty1 + 1) for p in range(tx0, tx1 + 1))
+
+
+def _empty_tile_part(info, tile):
+    """Returns a tile-part whose packets are all empty."""
+    tx0, ty0, tx1, ty1 = _tile_bounds(info, tile)
+    levels = info['levels']
+    nb_packets = 0
+    for r in range(levels + 1):
+        scale = 2 ** (levels - r)
+        rx0, ry0 = _ceil_div(tx0, scale), _ceil_div(ty0, scale)
+        rx1, ry1 = _ceil_div(tx1, scale), _ceil_div(ty1, scale)
+        ppx, ppy = info['precincts'][r] if info['precincts'] else (15, 15)
+        npx = _ceil_div(rx1, 2 ** ppx) - rx0 // 2 ** ppx if rx1 > rx0 else 0
+        npy = _ceil_div(ry1, 2 ** ppy) - ry0 // 2 ** ppy if ry1 > ry0 else 0
+        nb_packets += npx * npy
+    nb_packets *= info['layers'] * info['C']
+
+    packets = []
+    for n in range(nb_packets):
+        packet = b'\x00'  # zero length packet header
+        if info['sop']:
+            packet = struct.pack('>HHH', SOP, 4, n % 65536) + packet
+        if info['eph']:
+            packet += struct.pack('>H', EPH)
+        packets.append(packet)
+    data = b''.join(packets)
+    return struct.pack('>HHHIBBH', SOT, 10, tile, 14 + len(data), 0, 1, SOD) + data
+
+
+def _ranges(parts):
+    """Merges the tile-parts byte ranges close to each other."""
+    ranges = []
+    for _, offset, length in parts:
+        if ranges and offset - ranges[-1][1] <= MERGE_GAP and \
+                offset + length - ranges[-1][0] <= MAX_RANGE:
+            ranges[-1][1] = offset + length
+        else:
+            ranges.append([offset, offset + length])
+    return ranges
+
+
+def fetch_window(get_range, size, window, dest):
+    """Writes to 'dest' a JPEG 2000 file holding only the tiles intersecting
+    the window.
+
+    :param get_range: callable returning the object bytes between two offsets
+    :param size: size of the remote object in bytes
+    :param window: (x, y, w, h) in pixels of the image
+    :param dest: local file name
+    :return: number of bytes fetched
+    """
+    head = _Head(get_range, size)
+    box, cs_start, cs_end = _find_codestream(head)
+    info, segments, first_sot = _parse_main_header(head, cs_start)
+    parts = _tile_parts(get_range, info, first_sot, cs_end)
+    needed = window_tiles(info, window)
+    wanted = [p for p in parts if p[0] in needed]
+    fetched = len(head.data)
+
+    chunks = {}
+    for start, end in _ranges(wanted):
+        if end <= len(head.data):
+            data = head.data[start:end]
+        else:
+            data = get_range(start, end - 1)
+            fetched += len(data)
+        for tile, offset, length in wanted:
+            if start <= offset < end:
+                chunks[offset] = data[offset - start:offset - start + length]
+
+    codestream = [struct.pack('>H', SOC)]
+    codestream += [seg for marker, seg in segments if marker not in (TLM, PLM)]
+    seen = set()
+    for tile, offset, length in parts:
+        if tile in needed:
+            codestream.append(chunks[offset])
+        elif tile not in seen:
+            codestream.append(_empty_tile_part(info, tile))
+        seen.add(tile)
+    codestream.append(struct.pack('>H', EOC))
+    codestream = b''.join(codestream)
+
+    tmp = dest + '.window'
+    with open(tmp, 'wb') as f:
+        if box is not None:
+            f.write(head.read(0, box))
+            f.write(struct.pack('>I4s', 8 + len(codestream), b'jp2c'))
+        f.write(codestream)
+    os.rename(tmp, dest)
+    return fetched
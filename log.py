@@ -1,34 +1,96 @@
 from __future__ import print_function
-from utils import config_get
+from multiprocessing import util
+from utils import config_get, config_get_str
+import atexit
+import Queue
 import inspect
 import logging
 import multiprocessing
 import multiprocessing_logging
 import os
+import signal
 import sys
 
 LOG_LEVEL = logging.INFO
 LOG_HANDLER = 'file'
 LOG_FILE = 'eo-data-access.log'
+# Source file, line and function of the records. Finding them walks the
+# stack on every record, so they are only logged if 'log_caller' is set.
+LOG_CALLER = config_get_str('log_caller', 'false').lower() in ('1', 'true', 'yes', 'on')
 
 FORMAT_FIELD_SEP = ' : '
+FORMAT_CALLER = \
+    '%(pathname)s:' \
+    '%(lineno)03d{0}' \
+    '%(funcName)s{0}'.format(FORMAT_FIELD_SEP)
 FORMAT = \
     '%(asctime)s{0}' \
     '%(relativeCreated)6d{0}' \
     '%(levelname)s{0}' \
-    '%(pathname)s:' \
-    '%(lineno)03d{0}' \
-    '%(funcName)s{0}' \
+    '{1}' \
     '%(threadName)s{0}' \
     '%(processName)s ' \
     '>>> ' \
-    '%(message)s'.format(FORMAT_FIELD_SEP)
+    '%(message)s'.format(FORMAT_FIELD_SEP, FORMAT_CALLER if LOG_CALLER else '')
 FORMAT_DATE = '%Y-%m-%dT%H:%M:%SZ'
 
+if not LOG_CALLER:
+    logging._srcfile = None
+
+
+class _ProcessPrefix(object):
+    """'[ppid->pid]' of the current process, computed once per process."""
+
+    def __init__(self):
+        self.value = None
+
+    def get(self):
+        if self.value is None:
+            self.value = '[%s->%s]' % (os.getppid(), os.getpid())
+        return self.value
+
+    def reset(self):
+        self.value = None
+
+
+_prefix = _ProcessPrefix()
+util.register_after_fork(_prefix, _ProcessPrefix.reset)
+
 
 class CustomAdapter(logging.LoggerAdapter):
+    """Prefixes the messages with the parent and current process ids. The
+    level is checked first so that disabled calls cost nothing but the
+    evaluation of their arguments, which are only formatted when the
+    record is emitted."""
+
     def process(self, msg, kwargs):
-        return '[%s->%s] %s' % (os.getppid(), os.getpid(), msg), kwargs
+        return '%s %s' % (_prefix.get(), msg), kwargs
+
+    def log(self, level, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(level):
+            msg, kwargs = self.process(msg, kwargs)
+            self.logger.log(level, msg, *args, **kwargs)
+
+    def debug(self, msg, *args, **kwargs):
+        self.log(logging.DEBUG, msg, *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self.log(logging.INFO, msg, *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self.log(logging.WARNING, msg, *args, **kwargs)
+
+    warn = warning
+
+    def error(self, msg, *args, **kwargs):
+        self.log(logging.ERROR, msg, *args, **kwargs)
+
+    def exception(self, msg, *args, **kwargs):
+        kwargs['exc_info'] = 1
+        self.log(logging.ERROR, msg, *args, **kwargs)
+
+    def critical(self, msg, *args, **kwargs):
+        self.log(logging.CRITICAL, msg, *args, **kwargs)
 
 
 def _mod_name():
@@ -126,8 +188,100 @@ def get_logger_print():
     return logger()
 
 
+# queue logger: the processes and threads only enqueue their records, a
+# single listener process formats them and writes them out
+class QueueHandler(logging.Handler):
+    """Puts the records in a multiprocessing queue without blocking."""
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def prepare(self, record):
+        """Merges the message with its arguments and the traceback so that
+        the record is picklable. Being the last handler of the record, it
+        is modified in place."""
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+def _listen(queue, log_handler, log_file, parent):
+    # interrupted by the parent only, so that no record is lost on Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if log_handler == 'console':
+        handler = logging.StreamHandler(stream=sys.stdout)
+    else:
+        handler = logging.FileHandler(log_file)
+    handler.setFormatter(logging.Formatter(fmt=FORMAT, datefmt=FORMAT_DATE))
+    while True:
+        try:
+            record = queue.get(timeout=1)
+        except Queue.Empty:
+            if os.getppid() != parent:
+                break  # the parent was killed
+            continue
+        except (EOFError, IOError):
+            break
+        if record is None:
+            break
+        handler.handle(record)
+    handler.close()
+
+
+class _Listener(object):
+
+    def __init__(self):
+        self.queue = None
+        self.process = None
+        self.pid = None
+
+    def start(self, log_handler):
+        self.queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=_listen, name='log-listener',
+                                               args=(self.queue, log_handler, os.path.abspath(LOG_FILE),
+                                                     os.getpid()))
+        self.process.daemon = True
+        self.process.start()
+        self.pid = os.getpid()
+        # registered after the exit function of multiprocessing, so run before it
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Flushes the records and stops the listener, in the process that
+        started it."""
+        if self.process is not None and os.getpid() == self.pid:
+            self.queue.put(None)
+            self.queue.close()
+            self.queue.join_thread()
+            self.process.join(5)
+            self.process = None
+
+
+_listener = _Listener()
+
+
+def get_logger_queue(log_level=None, log_handler=None):
+    log_handler, log_level = _get_logger_defaults(log_level, log_handler)
+    logger = logging.getLogger()
+    if _listener.process is None:
+        _listener.start(log_handler)
+        logger.addHandler(QueueHandler(_listener.queue))
+        logger.setLevel(log_level)
+    return CustomAdapter(logger, {})
+
+
 def get_logger(*args, **kwargs):
-    return get_logger_multproc_logging(**kwargs)
+    return get_logger_queue(**kwargs)
 
 
 class Logger(object):
@@ -0,0 +1,134 @@
+import errno
+import json
+import os
+import time
+
+from log import get_logger
+
+logger = get_logger()
+
+''' Manifest of the objects of a product.
+
+    The product prefix is listed once with paginated bulk listing and the
+    key, size and ETag of its objects are cached on disk, so that later runs
+    skip the listing entirely. The manifest indexes the objects by their
+    path relative to the product and by their file name, both without
+    extension, which is how the product metadata refers to the bands.
+
+    The band map parsed from the product metadata is cached next to the
+    manifest so that later runs skip the metadata request as well.
+'''
+
+LIST_PAGE_SIZE = 1000
+
+
+def _stem(key):
+    return os.path.splitext(key)[0]
+
+
+class Manifest(object):
+
+    def __init__(self, product, entries):
+        """
+        :param product: product name, i.e. its prefix in the bucket
+        :param entries: list of {'key': '', 'size': 0, 'etag': ''}
+        """
+        self.product = product
+        self.entries = entries
+        self.by_key = dict((e['key'], e) for e in entries)
+        self._by_path = {}
+        self._by_name = {}
+        prefix = len(product) + 1
+        for e in entries:
+            self._by_path[_stem(e['key'][prefix:])] = e['key']
+            self._by_name.setdefault(os.path.basename(_stem(e['key'])), []).append(e['key'])
+
+    def keys(self):
+        return [e['key'] for e in self.entries]
+
+    def size(self, key):
+        return self.by_key[key]['size']
+
+    def find(self, name):
+        """Returns the keys of the objects referred to by 'name', a path
+        relative to the product or a file name, without extension."""
+        if name in self._by_path:
+            return [self._by_path[name]]
+        return self._by_name.get(os.path.basename(name), [])
+
+
+def _list(client, bucket, product):
+    paginator = client.get_paginator('list_objects')
+    entries = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=product + '/',
+                                   PaginationConfig={'PageSize': LIST_PAGE_SIZE}):
+        for o in page.get('Contents', []):
+            entries.append({'key': o['Key'], 'size': o['Size'], 'etag': o['ETag'].strip('"')})
+    return entries
+
+
+def _path(cache_dir, bucket, product, kind=''):
+    return os.path.join(cache_dir, bucket, product + kind + '.json')
+
+
+def _read(fn):
+    with open(fn) as f:
+        return json.load(f)
+
+
+def _write(fn, data):
+    try:
+        os.makedirs(os.path.dirname(fn))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    tmp = '%s.%d.tmp' % (fn, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp, fn)
+
+
+def _fresh(fn, ttl):
+    return os.path.exists(fn) and (not ttl or time.time() - os.path.getmtime(fn) < ttl)
+
+
+def load(client, bucket, product, cache_dir=None, ttl=0):
+    """Returns the manifest of the product, from the disk cache if present.
+
+    :param client: S3 client
+    :param bucket: bucket name
+    :param product: product name
+    :param cache_dir: directory of the manifests cache, None to disable it
+    :param ttl: age in seconds after which a cached manifest is listed again,
+                0 for never since products are immutable
+    :return: Manifest
+    """
+    fn = _path(cache_dir, bucket, product) if cache_dir else None
+    if fn and _fresh(fn, ttl):
+        entries = _read(fn)
+        logger.debug('Manifest of %s loaded from %s.', product, fn)
+        return Manifest(product, entries)
+
+    t0 = time.time()
+    entries = _list(client, bucket, product)
+    logger.info('Manifest of %s: %d objects listed. Time took: %0.3f', product, len(entries), time.time() - t0)
+    if fn and entries:
+        _write(fn, entries)
+    return Manifest(product, entries)
+
+
+def load_band_map(cache_dir, bucket, product, ttl=0):
+    """Returns the cached band map of the product or None.
+
+    :param ttl: age in seconds after which the cached band map is ignored, 0
+                for never, as the manifest it was located in
+    """
+    fn = _path(cache_dir, bucket, product, '.bands') if cache_dir else None
+    if fn and _fresh(fn, ttl):
+        return _read(fn)
+    return None
+
+
+def save_band_map(cache_dir, bucket, product, bands):
+    if cache_dir:
+        _write(_path(cache_dir, bucket, product, '.bands'), bands)
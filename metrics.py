@@ -0,0 +1,217 @@
+from multiprocessing import Lock, RawArray
+import json
+import os
+import threading
+import time
+
+from utils import config_get_num, config_get_str
+from log import get_logger
+
+logger = get_logger()
+
+''' Per-object and per-stage performance metrics.
+
+    Every measured stage of an object (metadata or band download, queue
+    wait in the download scheduler, barrier and admission waits of a task,
+    SNAP read, resample, subset, band maths and write) is appended as a
+    JSON line to METRICS_FILE with its bytes, time to first byte, duration,
+    effective MB/s, retries and hedged requests.
+
+    The totals per stage are kept in shared memory inherited by the forked
+    processes, like the shared index, and are exported in the Prometheus
+    text format to PROMETHEUS_FILE every METRICS_INTERVAL seconds while a
+    run is going, so that it can be scraped (e.g. by the textfile collector
+    of the node exporter).
+'''
+
+MB = 1024 ** 2
+
+METRICS_FILE = os.path.abspath(os.path.expanduser(config_get_str('metrics_file', 'eo-metrics.jsonl')))
+PROMETHEUS_FILE = os.path.abspath(os.path.expanduser(config_get_str('metrics_prom_file', 'eo-metrics.prom')))
+METRICS_INTERVAL = config_get_num('metrics_interval_s', 15, float)
+
+STAGES = ('metadata', 'band', 'queue', 'barrier', 'admission',
+          'read', 'resample', 'subset', 'bandmaths', 'write', 'task')
+FIELDS = ('count', 'seconds', 'max_seconds', 'bytes', 'ttfb_count', 'ttfb_seconds', 'retries', 'hedges',
+          'errors')
+
+_lock = Lock()
+_totals = RawArray('d', len(STAGES) * len(FIELDS))
+_fds = {}
+
+
+def _total(stage, field):
+    return STAGES.index(stage) * len(FIELDS) + FIELDS.index(field)
+
+
+def _add(stage, duration, nbytes, ttfb, retries, hedges, error):
+    with _lock:
+        _totals[_total(stage, 'count')] += 1
+        _totals[_total(stage, 'seconds')] += duration
+        i = _total(stage, 'max_seconds')
+        _totals[i] = max(_totals[i], duration)
+        _totals[_total(stage, 'bytes')] += nbytes
+        if ttfb is not None:
+            _totals[_total(stage, 'ttfb_count')] += 1
+            _totals[_total(stage, 'ttfb_seconds')] += ttfb
+        _totals[_total(stage, 'retries')] += retries
+        _totals[_total(stage, 'hedges')] += hedges
+        _totals[_total(stage, 'errors')] += bool(error)
+
+
+def _write_line(line):
+    """Appends a line to the metrics file with a single write, so that the
+    lines of concurrent processes are not interleaved."""
+    pid = os.getpid()
+    if pid not in _fds:
+        _fds[pid] = os.open(METRICS_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    os.write(_fds[pid], (line + '\n').encode('utf-8'))
+
+
+def record(stage, duration, name='', nbytes=0, ttfb=None, retries=0, error=False, hedges=0, **extra):
+    """Records a measured stage.
+
+    :param stage: one of STAGES
+    :param duration: seconds
+    :param name: object key, product or index the stage is about
+    :param nbytes: bytes transferred
+    :param ttfb: seconds to the first byte, None if not measured
+    :param retries: number of retried requests
+    :param error: True if the stage failed
+    :param hedges: number of hedged requests
+    :param extra: additional fields of the JSON record
+    """
+    rec = {'time': time.time(),
+           'pid': os.getpid(),
+           'stage': stage,
+           'name': name,
+           'duration': duration,
+           'bytes': nbytes,
+           'mbs': nbytes / duration / MB if nbytes and duration > 0 else None,
+           'ttfb': ttfb,
+           'retries': retries,
+           'hedges': hedges,
+           'error': bool(error)}
+    rec.update(extra)
+    try:
+        _add(stage, duration, nbytes, ttfb, retries, hedges, error)
+        _write_line(json.dumps(rec))
+    except Exception as ex:
+        # metrics must never fail a download or a task
+        logger.warn('Failed to record metrics %s: %s', rec, ex)
+
+
+class Timer(object):
+    """Measures a stage of an object. The transfer functions report the
+    first byte, the bytes, the retries and the hedges of their requests to
+    it. Used as a context manager the stage is recorded on exit, as failed
+    if an exception is raised.
+    """
+
+    def __init__(self, stage, name='', **extra):
+        self.stage = stage
+        self.name = name
+        self.extra = extra
+        self.start = time.time()
+        self.ttfb = None
+        self.nbytes = 0
+        self.retries = 0
+        self.hedges = 0
+        self._lock = threading.Lock()
+
+    def first_byte(self):
+        with self._lock:
+            if self.ttfb is None:
+                self.ttfb = time.time() - self.start
+
+    def add(self, nbytes, retries=0):
+        with self._lock:
+            self.nbytes += nbytes
+            self.retries += retries
+
+    def hedge(self):
+        with self._lock:
+            self.hedges += 1
+
+    def stop(self, error=False, **extra):
+        self.extra.update(extra)
+        record(self.stage, time.time() - self.start, self.name, self.nbytes,
+               self.ttfb, self.retries, error, self.hedges, **self.extra)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop(error=exc_type is not None)
+        return False
+
+
+def totals():
+    """Returns {stage: {field: value}} of the stages recorded so far."""
+    with _lock:
+        values = list(_totals)
+    n = len(FIELDS)
+    return dict((s, dict(zip(FIELDS, values[i * n:(i + 1) * n]))) for i, s in enumerate(STAGES))
+
+
+_PROMETHEUS_METRICS = (
+    ('eo_stage_duration_seconds', 'summary', 'Duration of the stages.',
+     (('_count', 'count'), ('_sum', 'seconds'))),
+    ('eo_stage_max_duration_seconds', 'gauge', 'Longest duration of the stages.',
+     (('', 'max_seconds'),)),
+    ('eo_stage_ttfb_seconds', 'summary', 'Time to first byte of the transfers.',
+     (('_count', 'ttfb_count'), ('_sum', 'ttfb_seconds'))),
+    ('eo_stage_bytes_total', 'counter', 'Bytes transferred.', (('', 'bytes'),)),
+    ('eo_stage_retries_total', 'counter', 'Retried requests.', (('', 'retries'),)),
+    ('eo_stage_hedges_total', 'counter', 'Hedged requests.', (('', 'hedges'),)),
+    ('eo_stage_errors_total', 'counter', 'Failed stages.', (('', 'errors'),)))
+
+
+def export_prometheus(fn=None):
+    """Writes the totals in the Prometheus text format. The file is replaced
+    atomically so that a scraper never reads it half written."""
+    fn = fn or PROMETHEUS_FILE
+    stages = totals()
+    lines = []
+    for metric, kind, doc, samples in _PROMETHEUS_METRICS:
+        lines.append('# HELP %s %s' % (metric, doc))
+        lines.append('# TYPE %s %s' % (metric, kind))
+        for suffix, field in samples:
+            for s in STAGES:
+                if stages[s]['count']:
+                    lines.append('%s%s{stage="%s"} %r' % (metric, suffix, s, stages[s][field]))
+    tmp = '%s.%d.tmp' % (fn, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.rename(tmp, fn)
+
+
+class Exporter(object):
+    """Exports the totals every 'interval' seconds from a daemon thread."""
+
+    def __init__(self, interval=METRICS_INTERVAL, fn=None):
+        self.interval = interval
+        self.fn = fn
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metrics-exporter')
+        self._thread.daemon = True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._export()
+
+    def _export(self):
+        try:
+            export_prometheus(self.fn)
+        except Exception as ex:
+            logger.warn('Failed to export metrics: %s', ex)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops the thread and writes the final totals."""
+        self._stop.set()
+        self._thread.join()
+        self._export()
@@ -0,0 +1,323 @@
+from contextlib import contextmanager
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from log import get_logger
+
+logger = get_logger()
+
+''' Persistent local cache of the downloaded objects.
+
+    The files are kept in a directory with an index recording their size and
+    last access time. The index is shared by all the processes through a file
+    lock, and the least recently used files are evicted when the cache goes
+    over its disk budget. Objects are keyed by bucket, key and ETag so that a
+    modified object is never served from the cache.
+
+    The same index and eviction policy keep the intermediate products of the
+    processing, which are directories, see ProductCache.
+'''
+
+GB = 1024 ** 3
+INDEX_FILE = 'index.json'
+LOCK_FILE = '.lock'
+
+
+def _link(src, dst):
+    """Hard links 'src' to 'dst', or copies it across file systems. A
+    symbolic link, e.g. to an object staged in memory, is resolved so that
+    the file itself is linked or copied, not the link which would dangle
+    once the file is released."""
+    src = os.path.realpath(src)
+    try:
+        os.remove(dst)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def _size(path):
+    """Returns the size of the file, or of the files of the directory."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+
+
+class DiskCache(object):
+    """Directory of files indexed by name with an LRU eviction policy bounded
+    by a disk budget in bytes."""
+
+    def __init__(self, root, budget):
+        self.root = root
+        self.budget = budget
+        self._ready = False
+
+    def _init(self):
+        if not self._ready:
+            try:
+                os.makedirs(os.path.join(self.root, 'data'))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            self._ready = True
+
+    @contextmanager
+    def _locked(self):
+        self._init()
+        with open(os.path.join(self.root, LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.root, INDEX_FILE)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, index):
+        fn = os.path.join(self.root, INDEX_FILE)
+        with open(fn + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.rename(fn + '.tmp', fn)
+
+    def _path(self, name):
+        return os.path.join(self.root, 'data', hashlib.sha1(name.encode('utf-8')).hexdigest())
+
+    def _evict(self, index):
+        """Removes the least recently used entries until the cache fits in its
+        budget. Must be called with the lock held."""
+        total = sum(e['size'] for e in index.values())
+        for name in sorted(index, key=lambda n: index[n]['atime']):
+            if total <= self.budget:
+                break
+            if self._in_use(name):
+                continue
+            total -= index.pop(name)['size']
+            try:
+                _remove(self._path(name))
+            except OSError:
+                pass
+            logger.debug('Cache: evicted %s', name)
+
+    def _in_use(self, name):
+        """Returns True if the entry must not be evicted."""
+        return False
+
+    def enabled(self):
+        return self.budget > 0
+
+    def lookup(self, name):
+        """Returns the path of the cached entry 'name' and marks it as recently
+        used, or None if the entry is not in the cache."""
+        with self._locked():
+            index = self._load()
+            path = self._path(name)
+            if name not in index:
+                return None
+            if not os.path.exists(path):
+                # e.g. a dangling link, its bytes must not count in the budget
+                del index[name]
+                _remove(path)
+                self._save(index)
+                return None
+            index[name]['atime'] = time.time()
+            self._save(index)
+            return path
+
+    def insert(self, name, src):
+        """Adds the file 'src' to the cache under 'name' and evicts older
+        entries if needed. A directory is moved into the cache, it must be
+        on the same file system.
+
+        :return: path of the cached entry
+        """
+        size = _size(src)
+        if size > self.budget:
+            return None
+        tmp = None
+        if not os.path.isdir(src):
+            # copied without the lock, which only covers the rename, so that
+            # the other processes do not wait for the copy of a staged file
+            self._init()
+            fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+            os.close(fd)
+            try:
+                _link(src, tmp)
+            except Exception:
+                _remove(tmp)
+                raise
+        with self._locked():
+            index = self._load()
+            path = self._path(name)
+            if tmp is None:
+                _remove(path)
+                os.rename(src, path)
+            else:
+                os.rename(tmp, path)
+                # rename does nothing if both are links to the same file,
+                # e.g. an object fetched from the cache stored again
+                _remove(tmp)
+            index[name] = {'size': size, 'atime': time.time()}
+            self._evict(index)
+            self._save(index)
+            return path
+
+
+class ObjectCache(DiskCache):
+    """Cache of S3 objects keyed by bucket, key and ETag with hit, miss and
+    bytes saved counters."""
+
+    def __init__(self, root, budget):
+        DiskCache.__init__(self, root, budget)
+        self.stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, name, n=1):
+        with self._stats_lock:
+            self.stats[name] += n
+
+    @staticmethod
+    def _name(bucket, key, etag):
+        return '%s/%s/%s' % (bucket, key, etag.strip('"'))
+
+    def fetch(self, bucket, key, etag, dest):
+        """Places the cached copy of the object at 'dest'.
+
+        :return: True on a cache hit
+        """
+        path = self.lookup(self._name(bucket, key, etag))
+        if path is None:
+            self._count('misses')
+            return False
+        _link(path, dest)
+        self._count('hits')
+        self._count('bytes_saved', os.path.getsize(dest))
+        return True
+
+    def store(self, bucket, key, etag, src):
+        self.insert(self._name(bucket, key, etag), src)
+
+    def log_stats(self):
+        logger.info('Object cache: %d hits, %d misses, %0.1f MB saved.',
+                    self.stats['hits'], self.stats['misses'], self.stats['bytes_saved'] / 1024. ** 2)
+
+
+class ProductCache(DiskCache):
+    """Cache of intermediate products, each entry being a directory.
+
+    The processes using an entry hold a shared lock on it, so that it is not
+    evicted under them while any number of them use it at the same time. A
+    missing entry is computed once: its computation holds a second,
+    exclusive, lock on it, so that the concurrent users of the entry wait
+    for the first one to compute it and then reuse it.
+    """
+
+    def __init__(self, root, budget):
+        DiskCache.__init__(self, root, budget)
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def _init(self):
+        if not self._ready:
+            for d in ('data', 'locks', 'tmp'):
+                try:
+                    os.makedirs(os.path.join(self.root, d))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            self._ready = True
+
+    def _lock_path(self, name, kind=''):
+        return os.path.join(self.root, 'locks', os.path.basename(self._path(name)) + kind)
+
+    def _in_use(self, name):
+        with open(self._lock_path(name), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return True
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            return False
+
+    @contextmanager
+    def use(self, names, compute):
+        """Yields {name: path} of the entries 'names', the missing ones being
+        computed first by 'compute'. The entries are not evicted before the
+        exit of the context.
+
+        :param names: names of the entries
+        :param compute: function({name: empty directory}) filling the
+                        directories of the missing entries
+        """
+        self._init()
+        names = sorted(set(names))
+        locks = []
+        tmp_dirs = []
+        try:
+            for name in names:
+                lock = open(self._lock_path(name), 'a')
+                locks.append(lock)
+                fcntl.flock(lock, fcntl.LOCK_SH)
+            paths = dict((name, self.lookup(name)) for name in names)
+            missing = [name for name in names if paths[name] is None]
+            self.stats['hits'] += len(names) - len(missing)
+            if missing:
+                with self._computing(missing):
+                    # computed by another process while waiting
+                    for name in missing:
+                        paths[name] = self.lookup(name)
+                    missing = [name for name in missing if paths[name] is None]
+                    self.stats['misses'] += len(missing)
+                    if missing:
+                        dirs = dict((name, tempfile.mkdtemp(dir=os.path.join(self.root, 'tmp'))) for name in missing)
+                        tmp_dirs.extend(dirs.values())
+                        compute(dirs)
+                        for name in missing:
+                            # an entry larger than the budget is used from its
+                            # temporary directory and removed on exit
+                            paths[name] = self.insert(name, dirs[name]) or dirs[name]
+            yield paths
+        finally:
+            for lock in locks:
+                lock.close()
+            for d in tmp_dirs:
+                _remove(d)
+
+    @contextmanager
+    def _computing(self, names):
+        """Holds the exclusive computation locks of the entries, taken in
+        the order of their names so that concurrent users do not deadlock."""
+        locks = []
+        try:
+            for name in names:
+                lock = open(self._lock_path(name, '.compute'), 'a')
+                locks.append(lock)
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+        finally:
+            for lock in locks:
+                lock.close()
+
+    def log_stats(self):
+        logger.info('Intermediate product cache: %d hits, %d misses.', self.stats['hits'], self.stats['misses'])
@@ -0,0 +1,214 @@
+from collections import deque
+import heapq
+import json
+import os
+
+import admission
+import metrics
+import product_downloader as prdl
+from utils import config_get_num
+from log import get_logger
+
+logger = get_logger()
+
+''' Makespan-aware planning of the products of a run.
+
+    The size of the objects of every product is taken from its manifest, a
+    listing cached on disk, so that planning does not download anything.
+    The download time of a product is its bytes over the aggregate
+    throughput of the band downloads of the previous runs, and the
+    processing time of a task the sum of the mean durations of its SNAP
+    stages, both read from METRICS_FILE, with defaults when there is no
+    history.
+
+    Downloads and processing form a pipeline of two stages, so the products
+    are ordered by the rule of Johnson: the products processed longer than
+    they are downloaded first, by increasing download time, so that the
+    processing starts early, and the others last, by decreasing processing
+    time. The tasks of a product stay together, its bands being shared. The
+    run is then simulated to predict its timings.
+'''
+
+MB = 1024 ** 2
+
+# Aggregate download throughput without history.
+DEFAULT_MBS = config_get_num('plan_default_mbs', 50, float)
+# Mean duration in seconds of the SNAP stages without history.
+DEFAULT_STAGE_SECONDS = {'read': 2., 'resample': 20., 'subset': 2., 'bandmaths': 5., 'write': 10.}
+# Stages run once per task, and once per index of a task.
+TASK_STAGES = ('read', 'resample', 'subset')
+INDEX_STAGES = ('bandmaths', 'write')
+# Number of the last metrics records the history is computed from.
+HISTORY_RECORDS = 100000
+# Pixels per side of the 60 m processing grid of a Sentinel-2 tile.
+GRID_SIZE = 1830
+
+
+class History(object):
+    """Throughput and stage durations of the previous runs."""
+
+    def __init__(self, fn=metrics.METRICS_FILE):
+        records = deque(maxlen=HISTORY_RECORDS)
+        try:
+            with open(fn) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except IOError:
+            pass
+        ok = [r for r in records if not r.get('error')]
+        self.bytes_per_second = self._throughput([r for r in ok if r['stage'] in ('band', 'metadata')])
+        self.stage_seconds = {}
+        for stage in TASK_STAGES + INDEX_STAGES:
+            durations = [r['duration'] for r in ok if r['stage'] == stage]
+            self.stage_seconds[stage] = sum(durations) / len(durations) if durations \
+                else DEFAULT_STAGE_SECONDS[stage]
+
+    @staticmethod
+    def _throughput(downloads):
+        """Returns the bytes per second of the downloads over the time at
+        least one of them was running, since they run concurrently."""
+        nbytes = sum(r['bytes'] for r in downloads)
+        if not nbytes:
+            return DEFAULT_MBS * MB
+        busy = 0.
+        end = None
+        for start, stop in sorted((r['time'] - r['duration'], r['time']) for r in downloads):
+            if end is None or start > end:
+                busy += stop - start
+                end = stop
+            elif stop > end:
+                busy += stop - end
+                end = stop
+        return nbytes / busy if busy > 0 else DEFAULT_MBS * MB
+
+    def task_seconds(self, nb_indices=1):
+        return sum(self.stage_seconds[s] for s in TASK_STAGES) + \
+            nb_indices * sum(self.stage_seconds[s] for s in INDEX_STAGES)
+
+
+def _band_sizes(product, s3conf):
+    """Returns ({band name: bytes}, bytes of the other objects) of the
+    product from its manifest, the bands being located with the cached band
+    map or else by the suffix of their file name."""
+    product_manifest = prdl._get_manifest(s3conf, product)
+    bands_loc = prdl.band_objects(product, s3conf)
+    if not bands_loc:
+        for k in product_manifest.keys():
+            stem, ext = os.path.splitext(os.path.basename(k))
+            if ext == '.jp2' and '_' in stem:
+                bands_loc[stem.split('_')[-1]] = k
+    bands = dict((b, product_manifest.size(k)) for b, k in bands_loc.items() if k in product_manifest.by_key)
+    band_keys = set(bands_loc.values())
+    meta = sum(product_manifest.size(k) for k in product_manifest.keys() if k not in band_keys)
+    return bands, meta
+
+
+def estimate(job, s3conf, history, fused=False):
+    """Returns the estimate of a job as a dict with the product, the bytes
+    to download, the seconds to download them and the seconds of each
+    task, in the order of the tasks of the job.
+
+    :param job: [product, processing function, tasks]
+    :param history: History
+    :param fused: the tasks of the product are fused into one
+    """
+    product, _, tasks = job
+    bands, meta = _band_sizes(product, s3conf)
+    # only the tiles of the bands covering the region of interest are downloaded
+    roi = tasks[0]['roi'] if all(t.get('roi') for t in tasks) else None
+    fraction = min(1., roi[2] * roi[3] / float(GRID_SIZE ** 2)) if roi else 1.
+    nbytes = meta
+    for band in set(b for t in tasks for b in t['bands']):
+        if band not in bands:
+            logger.warn('Plan: band %s of %s not found, not accounted.', band, product)
+            continue
+        nbytes += bands[band] * fraction
+    if fused:
+        labels = ['+'.join(t['index'] for t in tasks)]
+        task_seconds = [history.task_seconds(len(tasks))]
+    else:
+        labels = [t['index'] for t in tasks]
+        task_seconds = [history.task_seconds() for _ in tasks]
+    return {'product': product, 'bytes': nbytes, 'download_s': nbytes / history.bytes_per_second,
+            'tasks': labels, 'task_s': task_seconds}
+
+
+def order(estimates, slots=1):
+    """Returns the estimates in the order of the rule of Johnson for a
+    download stage and a processing stage of 'slots' parallel tasks."""
+    def process_s(e):
+        return sum(e['task_s']) / float(min(slots, len(e['task_s'])))
+    first = sorted([e for e in estimates if e['download_s'] < process_s(e)], key=lambda e: e['download_s'])
+    last = sorted([e for e in estimates if e['download_s'] >= process_s(e)], key=process_s, reverse=True)
+    return first + last
+
+
+def simulate(estimates, slots=1, prefetch=0):
+    """Predicts the timings of the products run in the order of 'estimates'
+    by task_planner.main: at most prefetch + 1 products in flight, their
+    downloads sharing the throughput and their tasks run on 'slots' parallel
+    processing slots once the product is downloaded.
+
+    :return: list of dicts with the 'start', 'downloaded' and 'end' times of
+             the products in seconds from the start of the run
+    """
+    free = [0.] * slots
+    start = 0.
+    downloading = 0.
+    ends = []
+    schedule = []
+    for i, e in enumerate(estimates):
+        # the products in flight are joined in order
+        start = max(start, ends[i - prefetch - 1]) if i > prefetch else 0.
+        downloading = max(start, downloading) + e['download_s']
+        end = downloading
+        for seconds in sorted(e['task_s'], reverse=True):
+            slot_free = heapq.heappop(free)
+            task_end = max(slot_free, downloading) + seconds
+            heapq.heappush(free, task_end)
+            end = max(end, task_end)
+        ends.append(end)
+        schedule.append(dict(e, start=start, downloaded=downloading, end=end))
+    return schedule
+
+
+def processing_slots(workers=0):
+    """Returns the number of tasks processed at the same time, bounded by
+    the workers and the cpus they are admitted against."""
+    slots = max(1, int(admission.CPU_BUDGET // admission.TASK_CPUS))
+    return min(workers, slots) if workers > 0 else slots
+
+
+def plan(jobs, s3conf, prefetch=0, workers=0, fused=False):
+    """Orders the jobs to minimize the makespan of the run.
+
+    :param jobs: [[product, processing function, tasks],]
+    :return: (jobs in the order to run them, predicted schedule as returned
+              by simulate)
+    """
+    history = History()
+    slots = processing_slots(workers)
+    estimates = [dict(estimate(job, s3conf, history, fused), job=job) for job in jobs]
+    schedule = simulate(order(estimates, slots), slots, prefetch)
+    logger.info('Plan: %d products, throughput %0.1f MB/s, %d processing slots, predicted makespan %0.1f s.',
+                len(schedule), history.bytes_per_second / MB, slots, makespan(schedule))
+    return [s['job'] for s in schedule], schedule
+
+
+def makespan(schedule):
+    return max(s['end'] for s in schedule) if schedule else 0.
+
+
+def format_schedule(schedule):
+    """Returns the predicted schedule as lines of text."""
+    lines = ['%3s  %-64s %9s %10s %8s %11s %8s' % ('#', 'product', 'MB', 'download_s', 'start', 'downloaded', 'end')]
+    for i, s in enumerate(schedule):
+        lines.append('%3d  %-64s %9.1f %10.1f %8.1f %11.1f %8.1f' % (
+            i + 1, s['product'], s['bytes'] / MB, s['download_s'], s['start'], s['downloaded'], s['end']))
+        for label, seconds in zip(s['tasks'], s['task_s']):
+            lines.append('%5s%-64s %41s %8.1f' % ('', label, '', seconds))
+    lines.append('predicted makespan: %0.1f s' % makespan(schedule))
+    return lines
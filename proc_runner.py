@@ -5,10 +5,12 @@ import threading
 
 import NoDaemonProcess as ndp
 import Shared
+import admission
+import metrics
 import product_downloader as prdl
 import product_meta as pm
+import staging
 from log import get_logger
-from utils import rdm_sleep
 
 logger = get_logger()
 ''' Library  of communicating processes over a shared object
@@ -32,83 +34,193 @@ class download_decorator(object):
         index = task['index']
         index_expr = args[2]
         s3conf = args[3]
+        roi = args[4] if len(args) > 4 else None
         whoaim("a process assigned to bands %s from %s" % (bands, product))
-        self._register_and_download_bands(product, bands, s3conf)
+        self._register_and_download_bands(product, bands, s3conf, roi)
 
-        return partial(self.target, index=index, index_expr=index_expr)
+        cost = admission.task_cost(bands, len(index_expr) if isinstance(index_expr, list) else 1,
+                                   task.get('roi'))
+        return _Task(partial(self.target, index=index, index_expr=index_expr, roi=task.get('roi')),
+                     product, bands, s3conf, cost, index)
         # return self.target(pm.get_meta_from_prod(self.product), self.params)
 
-    def _register_and_download_bands(self, product, bands, s3conf):
-        valid_index = [key for key in bands if key not in Shared.shared.dict]
-        for v in valid_index:
-            Shared.shared.write(v, False)
-        logger.info('Registered in shared object: %s' % ','.join(bands))
-        logger.info('The shared object: %s' % Shared.shared.dict)
-        rdm_sleep()
-
-        Shared.shared.dict["nbproc"] += -1
-        if Shared.shared.dict["nbproc"] == 0:
+    def _register_and_download_bands(self, product, bands, s3conf, roi=None):
+        keys = [Shared.key(product, band) for band in bands]
+        for k in keys:
+            Shared.shared.subscribe(k)
+            # number of tasks waiting for the object, used to prioritize downloads
+            Shared.shared.increment(k)
+        keys.append(Shared.key(product, 'meta'))
+        Shared.shared.subscribe(keys[-1])
+        logger.info('Registered in shared object: %s', ','.join(keys))
+        # The bands downloaded by an interrupted run are ready right away.
+        for band in prdl.journaled_bands(product, bands, s3conf, roi):
+            Shared.shared.notify(Shared.key(product, band))
+            logger.info('%s of %s already downloaded.', band, product)
+        logger.debug('The shared object: %s', Shared.shared)
+
+        if Shared.shared.decrement(Shared.key(product, "nbproc")) == 0:
             # Shared.shared.write('Init', False)
-            self._run_download_manager(product, s3conf)
+            self._run_download_manager(product, s3conf, roi)
 
-        # barrier until bands are downloaded
-        while not all(Shared.shared.dict[k] for k in bands):
-            logger.debug('Keys found for @%s, %s', multiprocessing.current_process().name,
-                         [k for k in bands if Shared.shared.dict[k]])
-            rdm_sleep(1)
-        logger.debug('The shared object after barrier: %s' % Shared.shared.dict)
+        # barrier until metadata and bands are downloaded, woken up by the download callbacks
+        with metrics.Timer('barrier', product, bands=bands):
+            Shared.shared.wait(keys)
+        logger.debug('The shared object after barrier: %s', Shared.shared)
 
-    def _run_download_manager(self, product, s3conf):
+    def _run_download_manager(self, product, s3conf, roi=None):
 
         def create_download_threads(bands_loc, metadata_loc):
             whoaim("the download manager process for metadata and bands %s for prod %s." % (bands_loc, product))
-            object_list = [k for k in Shared.shared.dict.keys() if k in bands_loc.keys()]
+            object_list = [b for b in bands_loc.keys() if Shared.key(product, b) in Shared.shared and
+                           Shared.shared.state(Shared.key(product, b)) != Shared.READY]
             logger.info("Bands selected: %s for prod %s", object_list, product)
+            # the bands waited for by tasks, counted in their value, which the
+            # product does not have
+            prefix = Shared.key(product, '')
+            for k in Shared.shared.keys():
+                if k.startswith(prefix) and k[len(prefix):] not in bands_loc and Shared.shared.read(k) > 0:
+                    logger.error('Band %s not found in %s.', k[len(prefix):], product)
+                    Shared.shared.fail(k)
             meta = threading.Thread(target=prdl.get_product_metadata,
-                                    args=(metadata_loc, s3conf))
+                                    args=(metadata_loc, s3conf, product))
 
             bands = threading.Thread(target=prdl.get_product_data,
-                                     args=(bands_loc, s3conf, object_list))
+                                     args=(bands_loc, s3conf, object_list, product, roi))
+            # metadata and bands are queued to the same download scheduler
             meta.start()
-            meta.join()  # Can be optimized
             bands.start()
+            meta.join()
             bands.join()
 
         def download_manager():
-            bands_loc, metadata_loc = prdl.init(s3conf, product)
+            try:
+                bands_loc, metadata_loc = prdl.init(s3conf, product)
+            except Exception:
+                logger.exception('Cannot list the objects of %s.', product)
+                # all the tasks wait for the metadata, they fail instead of blocking
+                Shared.shared.fail(Shared.key(product, 'meta'))
+                return
             create_download_threads(bands_loc, metadata_loc)
 
-        downlad_manager_daemon = Process(target=download_manager)
-        downlad_manager_daemon.daemon = True
-        downlad_manager_daemon.start()
-        downlad_manager_daemon.join()
+        # Not joined so that this task can start as soon as its own objects
+        # are ready. Being non daemonic, the pool worker waits for it on exit.
+        downlad_manager = Process(target=download_manager)
+        downlad_manager.daemon = False
+        downlad_manager.start()
+
+
+class _Task(object):
+    """Runs the processing of a task once admitted and then releases the
+    bands no other task of the product needs. The number of tasks needing a
+    band is its value in the shared index."""
+
+    def __init__(self, proc_func, product, bands, s3conf, cost, index=''):
+        self.proc_func = proc_func
+        self.product = product
+        self.bands = bands
+        self.s3conf = s3conf
+        self.cost = cost
+        self.index = index
+
+    def __call__(self, prod_endpoint):
+        try:
+            with admission.admitted(self.cost, self.product):
+                return self.proc_func(prod_endpoint)
+        finally:
+            objects = prdl.band_objects(self.product, self.s3conf)
+            for band in self.bands:
+                if Shared.shared.decrement(Shared.key(self.product, band)) == 0 and objects.get(band):
+                    staging.release(objects[band])
 
 
 def whoaim(id):
-    logger.info("I'm running on CPU #%s and I am %s" % (multiprocessing.current_process(), id))
+    logger.info("I'm running on CPU #%s and I am %s", multiprocessing.current_process(), id)
+
+
+def _tasks_roi(tasks):
+    """Returns the bounding box of the regions of interest of the tasks, or
+    None if any of them needs the whole product."""
+    rois = [t.get('roi') for t in tasks]
+    if not rois or None in rois:
+        return None
+    x0 = min(r[0] for r in rois)
+    y0 = min(r[1] for r in rois)
+    x1 = max(r[0] + r[2] for r in rois)
+    y1 = max(r[1] + r[3] for r in rois)
+    return x0, y0, x1 - x0, y1 - y0
 
 
-def main(proc_func, args, s3conf):
+def fuse_tasks(tasks, indices_expr):
+    """Merges the tasks of a product into one computing all their indices,
+    so that the product is read, resampled and subset once.
+
+    :param tasks: [{'bands': [], 'index': '', 'roi': (x, y, w, h)},]
+    :param indices_expr: {'index': 'expr',}
+    :return: [task], {task index: [(index, expr),]}
+    """
+    bands = []
+    for t in tasks:
+        bands.extend(b for b in t['bands'] if b not in bands)
+    name = '+'.join(t['index'] for t in tasks)
+    task = {'bands': bands, 'index': name}
+    roi = _tasks_roi(tasks)
+    if roi:
+        task['roi'] = roi
+    return [task], {name: [(t['index'], indices_expr[t['index']]) for t in tasks]}
+
+
+def main(proc_func, args, s3conf, workers=None):
     """
     :param proc_func: processing function
-    :param args: {'product': '', 'tasks': [{'bands': [], 'index': ''},], 'indices_expr': {'index': 'expr',}}
+    :param args: {'product': '', 'tasks': [{'bands': [], 'index': '', 'roi': (x, y, w, h)},],
+                  'indices_expr': {'index': 'expr',}}
+                 'roi' is optional, when set by all the tasks only the part of the bands
+                 covering the regions of interest is downloaded
+    :param workers: worker_pool.WorkerPool the processing is submitted to once
+                    the objects of a task are ready, None to run it in this
+                    process
     :return:
     """
     nbproc = len(args['tasks'])
-    Shared.shared.write("nbproc", nbproc)
+    Shared.shared.write(Shared.key(args['product'], "nbproc"), nbproc)
     pool = ndp.MyPool(nbproc)
     prod_endpoint = pm.get_meta_from_prod(args['product'])
+    submitted = {}  # {shared index key: task index}
+    proc_failed = []
 
     def proc_func_runner(_proc_func):
-        return _proc_func(prod_endpoint)
-
+        if workers is None:
+            try:
+                _proc_func(prod_endpoint)
+            except Exception:
+                logger.exception('Task %s of %s failed.', _proc_func.index, args['product'])
+                proc_failed.append(_proc_func.index)
+            return
+        k = Shared.key(args['product'], 'task:%d' % len(submitted))
+        submitted[k] = _proc_func.index
+        workers.submit(k, _proc_func, (prod_endpoint,))
+
+    roi = _tasks_roi(args['tasks'])
     res = []
     for task in args['tasks']:
-        logger.info('Starting async daemon for task: %s' % task)
+        logger.info('Starting async daemon for task: %s', task)
         res.append(pool.apply_async(
             download_decorator(proc_func),
-            args=(args['product'], task, args['indices_expr'][task['index']], s3conf),
+            args=(args['product'], task, args['indices_expr'][task['index']], s3conf, roi),
             callback=proc_func_runner))
 
     pool.close()
     pool.join()
+    failed = [task['index'] for task, r in zip(args['tasks'], res) if not r.successful()]
+    if submitted:
+        workers.wait(list(submitted))
+        proc_failed.extend(submitted[k] for k in workers.failed(list(submitted)))
+    staging.release_product(args['product'])
+    Shared.shared.release(args['product'])
+    if failed:
+        raise Exception('Tasks %s of %s failed: their objects could not be downloaded.'
+                        % (', '.join(failed), args['product']))
+    if proc_failed:
+        raise Exception('Tasks %s of %s failed: their processing raised an error.'
+                        % (', '.join(proc_failed), args['product']))
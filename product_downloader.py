@@ -10,33 +10,104 @@ allows you to download the metadata and the required bands via the functions
 'get_product_metadata' and 'get_product_data'.
 """
 
-from functools import partial
-from multiprocessing.pool import ThreadPool
 import errno
-import io
 import logging
 import os
+import sys
+import threading
 import time
-import xml.etree.ElementTree as ET
-
-from utils import config_get
-import boto3
-from boto3.s3.transfer import TransferConfig
-log_level = logging.getLevelName(config_get('log_level').strip())
-boto3.set_stream_logger(name='botocore', level=log_level)
-logging.getLogger("botocore.vendored.requests.packages.urllib3.connectionpool").setLevel(logging.WARNING)
 
+from utils import config_get, config_get_num, config_get_str
 import Shared
+import jp2_ranges
+from journal import journal
+import manifest
+import metrics
+import object_cache
 import product_meta as pm
+import scheduler
+import staging
+import transfer
 
 from log import get_logger
 logger = get_logger()
 
-# Multipart mode paramaters
 GB = 1024 ** 3
-config = TransferConfig(multipart_threshold=0.03 * GB,
-                        max_concurrency=20,
-                        use_threads=True)
+MB = 1024 ** 2
+
+# Bounds the total number of connections and sizes the parts of all the
+# objects in flight, tuned at runtime from the measured throughput.
+controller = transfer.AdaptiveController(
+    min_connections=config_get_num('min_connections', 4),
+    max_connections=config_get_num('max_connections', 64),
+    connections=config_get_num('connections', 8),
+    min_part_size=config_get_num('min_part_size_mb', 5) * MB,
+    max_part_size=config_get_num('max_part_size_mb', 64) * MB,
+    part_size=config_get_num('part_size_mb', 8) * MB)
+
+# Time outs, retries and hedging of the range requests.
+policy = transfer.RequestPolicy(
+    timeout=config_get_num('part_timeout_s', 60, float),
+    max_retries=config_get_num('max_retries', 4),
+    backoff=config_get_num('retry_backoff_s', 0.5, float),
+    hedge_multiplier=config_get_num('hedge_multiplier', 2, float),
+    hedge_quantile=config_get_num('hedge_quantile', 0.95, float))
+
+# Cache of the products' manifests. Products are immutable so they never
+# expire unless a time to live is set.
+MANIFEST_DIR = os.path.expanduser(config_get_str('manifest_dir', '~/.cache/eo-data-access/manifests'))
+MANIFEST_TTL = config_get_num('manifest_ttl_h', 0, float) * 3600
+
+# Number of objects downloaded at the same time by the scheduler of a process.
+DOWNLOAD_THREADS = config_get_num('download_threads', 16)
+# Priority of the metadata, needed by every task before it can start.
+META_PRIORITY = (-sys.maxsize,)
+
+# Size of the HTTP connection pool of the S3 client. It bounds the number of
+# keep-alive connections shared by all the download threads of a process.
+MAX_POOL_CONNECTIONS = config_get_num('max_pool_connections', controller.max_connections)
+
+# Persistent cache of the downloaded objects, disabled with a budget of 0.
+cache = object_cache.ObjectCache(
+    os.path.expanduser(config_get_str('cache_dir', '~/.cache/eo-data-access/objects')),
+    config_get_num('cache_budget_gb', 20, float) * GB)
+
+_clients = {}
+_clients_lock = threading.Lock()
+_boto3 = None
+
+
+def _import_boto3():
+    """Imports boto3 and sets up the logging of botocore on the creation of
+    the first client, so that the processes which do not download do not
+    pay for it."""
+    global _boto3
+    if _boto3 is None:
+        import boto3
+        boto3.set_stream_logger(name='botocore', level=logging.getLevelName(config_get('log_level').strip()))
+        logging.getLogger("botocore.vendored.requests.packages.urllib3.connectionpool").setLevel(logging.WARNING)
+        _boto3 = boto3
+    return _boto3
+
+
+def _get_client(s3conf):
+    """Returns the S3 client of the current process for the endpoint. The
+    client is thread safe and shared by all the threads of the process so
+    that they reuse the same pool of keep-alive connections.
+
+    :param s3conf:
+    :return:
+    """
+    k = (os.getpid(), s3conf['endpoint_url'])
+    with _clients_lock:
+        if k not in _clients:
+            from botocore.config import Config
+            session = _import_boto3().session.Session()
+            # a request stalled past the time out of the parts is abandoned
+            _clients[k] = session.client('s3', endpoint_url=s3conf['endpoint_url'],
+                                         config=Config(max_pool_connections=MAX_POOL_CONNECTIONS,
+                                                       read_timeout=policy.timeout))
+        return _clients[k]
 
 ''' Takes the absolute path of a file and create locally the unexisting
  directories.'''
@@ -51,26 +122,109 @@ def _create_dir(abs_path):
             raise
 
 
-def _download_obj(obj, s3conf):
+def _download_obj(obj, s3conf, stage='metadata'):
     """Takes a single object's filename and downloads it locally.
     :param obj:
     :param s3conf:
+    :param stage: metrics stage the download is recorded as
     :return:
     """
     _create_dir(obj)
-    s3 = boto3.resource('s3', endpoint_url=s3conf['endpoint_url'])
+    s3 = _get_client(s3conf)
     try:
-        t0 = time.time()
-        logger.debug('%s - start object download' % obj)
-        s3.Bucket(s3conf['bucket_id']).download_file(obj, obj, Config=config)
-        logger.debug('%s - finish object download. Time took: %0.3f' % (obj, time.time() - t0))
-    except OSError as ex:
+        with metrics.Timer(stage, obj) as timer:
+            logger.debug('%s - start object download', obj)
+            head = s3.head_object(Bucket=s3conf['bucket_id'], Key=obj)
+            etag = head['ETag']
+            size = head['ContentLength']
+            timer.extra['size'] = size
+            # The HEAD request is enough to validate the local and the cached copies.
+            if journal.is_complete(obj, etag):
+                timer.extra['journal'] = True
+                logger.debug('%s - already downloaded. Time took: %0.3f', obj, time.time() - timer.start)
+                return obj
+            if cache.enabled() and cache.fetch(s3conf['bucket_id'], obj, etag, obj):
+                timer.extra['cached'] = True
+                journal.complete(obj, size, etag)
+                logger.debug('%s - served from cache. Time took: %0.3f', obj, time.time() - timer.start)
+                return obj
+            resume = journal.resumable(obj, size, etag)
+            if resume:
+                part_size, parts_done = resume
+                logger.info('%s - resuming download, %d parts already written.', obj, len(parts_done))
+            else:
+                part_size, parts_done = controller.part_size, ()
+                journal.pending(obj, size, etag, part_size)
+            with staging.staged(obj, size) as dest:
+                timer.extra['in_memory'] = dest != obj
+                transfer.download(s3, s3conf['bucket_id'], obj, dest, size, controller, policy, timer,
+                                  part_size, parts_done, lambda start: journal.part_done(obj, etag, start))
+            journal.complete(obj, size, etag)
+            if cache.enabled():
+                cache.store(s3conf['bucket_id'], obj, etag, obj)
+            logger.debug('%s - finish object download. Time took: %0.3f', obj, time.time() - timer.start)
+    except Exception as ex:
         msg = "Failed to download %s from %s." % (obj, s3conf['bucket_id'])
         logger.error(msg)
         raise Exception('%s %s' % (msg, 'Error: %s' % ex))
     return obj
 
 
+def _download_window(obj, s3conf, window):
+    """Downloads only the tiles of the JPEG 2000 object covering the window
+    with HTTP range requests. Falls back to a whole object download if the
+    file layout does not allow it.
+
+    :param obj:
+    :param s3conf:
+    :param window: (x, y, w, h) in pixels of the band
+    :return:
+    """
+    _create_dir(obj)
+    s3 = _get_client(s3conf)
+    bucket_id = s3conf['bucket_id']
+    timer = metrics.Timer('band', obj, window=window)
+
+    def get_range(start, end):
+        return transfer.fetch_range(s3, bucket_id, obj, start, end, controller, policy, timer)
+
+    with timer:
+        head = s3.head_object(Bucket=bucket_id, Key=obj)
+        size = head['ContentLength']
+        timer.extra['size'] = size
+        if journal.is_complete(obj, head['ETag'], window):
+            timer.extra['journal'] = True
+            logger.debug('%s - window %s already downloaded.', obj, window)
+            return obj
+        try:
+            with staging.staged(obj, size) as dest:
+                fetched = jp2_ranges.fetch_window(get_range, size, window, dest)
+        except jp2_ranges.Jp2Error as ex:
+            timer.extra['fallback'] = True
+            fallback = ex
+        else:
+            fallback = None
+            journal.complete(obj, size, head['ETag'], window)
+    if fallback:
+        logger.warn('%s - cannot download window, downloading whole object. Error: %s', obj, fallback)
+        return _download_obj(obj, s3conf, 'band')
+    logger.debug('%s - window %s downloaded, %d of %d bytes. Time took: %0.3f',
+                 obj, window, fetched, size, time.time() - timer.start)
+    return obj
+
+
+def _get_manifest(s3conf, product):
+    """Returns the manifest of the product objects, listed once and then
+    read from the disk cache.
+
+    :param s3conf:
+    :param product:
+    :return:
+    """
+    return manifest.load(_get_client(s3conf), s3conf['bucket_id'], product,
+                         MANIFEST_DIR, MANIFEST_TTL)
+
+
 def _get_product_keys(s3conf, f=""):
     """Lists the objects of an entire bucket or one of its directories.
 
@@ -78,19 +232,16 @@ def _get_product_keys(s3conf, f=""):
     :param f:
     :return:
     """
-    s3 = boto3.resource('s3', endpoint_url=s3conf['endpoint_url'])
-    bucket = s3.Bucket(s3conf['bucket_id'])
-    objects = list(bucket.objects.filter(Prefix=f + '/'))
-    return map(lambda x: x.Object().key, list(objects))
+    return _get_manifest(s3conf, f).keys()
 
 
-def _locate_bands(product, meta, file_keys, s3conf):
+def _locate_bands(product, meta, product_manifest, s3conf):
     """From the product's info containted in the 'xml' tree we can extract the
     bands's filename.
 
     inputs
         product: string of the product's name
-        file_keys: product objects' list
+        product_manifest: manifest of the product objects
         s3conf: string of the bucket's name
 
     output
@@ -98,54 +249,123 @@ def _locate_bands(product, meta, file_keys, s3conf):
         indexed by their accronym.
     """
 
+    bands = manifest.load_band_map(MANIFEST_DIR, s3conf['bucket_id'], product, MANIFEST_TTL)
+    if bands is not None:
+        logger.debug("Bands' location of %s loaded from cache.", product)
+        return bands
+
     metadata_file = meta
     logger.info("Determine bands' location from " + metadata_file)
-    s3 = boto3.resource('s3', endpoint_url=s3conf['endpoint_url'])
-    obj = s3.Object(s3conf['bucket_id'], metadata_file)
-    data = io.BytesIO()
-    # Since we use xml file only once we retrieve it as
-    obj.download_fileobj(data)
-    data.seek(0)  # a file-like object.
-    root = ET.parse(data).getroot()
+    s3 = _get_client(s3conf)
+    body = s3.get_object(Bucket=s3conf['bucket_id'], Key=metadata_file)['Body']
+    try:
+        # Streamed, the rest of the document is not read once the list is found.
+        band_files = pm.parse_band_files(body)
+    finally:
+        body.close()
     bands = {}
-    for child in root[0][0][-1][0][0]:
-        band = child.text
-        bands[band.split('_')[-1]] = ''.join([f for f in file_keys if f.find(band) != -1])
+    for band in band_files:
+        keys = product_manifest.find(band)
+        if not keys:
+            logger.warn('No object matches band %s of %s, ignored.', band, product)
+            continue
+        if len(keys) > 1:
+            logger.warn('%d objects match band %s, using %s', len(keys), band, keys[0])
+        bands[band.split('_')[-1]] = keys[0]
+    manifest.save_band_map(MANIFEST_DIR, s3conf['bucket_id'], product, bands)
     return bands
 
 
-def get_product_metadata(keys, s3conf):
+def band_objects(product, s3conf):
+    """Returns {band name: object key} of the product from the cached band
+    map, empty if it is not cached."""
+    return manifest.load_band_map(MANIFEST_DIR, s3conf['bucket_id'], product, MANIFEST_TTL) or {}
+
+
+def journaled_bands(product, bands, s3conf, roi=None):
+    """Returns the bands of the product the journal records as downloaded by
+    a previous run, without any request to the object store. The location of
+    the bands is taken from the cached band map, no band is returned if it
+    is not cached.
+
+    :param product: product name
+    :param bands: band names
+    :param s3conf:
+    :param roi: (x, y, w, h) region of interest in pixels of the processing grid
+    :return: list of band names
+    """
+    bands_loc = band_objects(product, s3conf)
+    done = []
+    for band in bands:
+        obj = bands_loc.get(band)
+        if not obj:
+            continue
+        window = pm.band_window(band, roi) if roi and obj.endswith('.jp2') else None
+        if journal.is_complete(obj, window=window):
+            done.append(band)
+    return done
+
+
+def get_product_metadata(keys, s3conf, product=''):
     """Takes an objects list and downloads it in parallel.
 
     :param keys:
     :param s3conf:
+    :param product: product name the shared index keys are namespaced with
     :return:
     """
-    pool = ThreadPool(processes=len(keys))
-    _get_obj = partial(_download_obj, s3conf=s3conf)
+    downloader = scheduler.get_scheduler(DOWNLOAD_THREADS)
     t0 = time.time()
     logger.info("Metadata: starting download.")
-    pool.map(_get_obj, keys)
-    Shared.shared.write('meta', True)
-    logger.info("Metadata: finished downloading. Time took: %0.3f" % (time.time() - t0))
+    jobs = [downloader.submit(_download_obj, (k, s3conf), META_PRIORITY, name=k) for k in keys]
+    for job in jobs:
+        job.wait()
+    failed = [job.name for job in jobs if job.error is not None]
+    if failed:
+        # the tasks waiting for the metadata fail instead of blocking
+        Shared.shared.fail(Shared.key(product, 'meta'))
+        logger.error("Metadata: %d objects failed to download: %s", len(failed), ', '.join(failed))
+    else:
+        Shared.shared.write(Shared.key(product, 'meta'), True)
+        logger.info("Metadata: finished downloading. Time took: %0.3f", time.time() - t0)
+    cache.log_stats()
+
+
+def _band_priority(product, band):
+    """Bands waited for by the most tasks are downloaded first."""
+    k = Shared.key(product, band)
+    return (-Shared.shared.read(k) if k in Shared.shared else 0,)
 
 
-def get_product_data(bands_dict, s3conf, targets=None):
-    """Takes the bands dict and downloads the selected ones in parallel.
+def get_product_data(bands_dict, s3conf, targets=None, product='', roi=None):
+    """Takes the bands dict and downloads the selected ones in parallel,
+    the bands waited for by the most tasks first.
 
     :param bands_dict:
     :param s3conf:
     :param targets:
+    :param product: product name the shared index keys are namespaced with
+    :param roi: (x, y, w, h) region of interest in pixels of the processing
+                grid, only the JPEG 2000 tiles covering it are downloaded
     :return:
     """
 
+    key2band = dict((v, k) for k, v in bands_dict.items())
+
     def value2key(value):
-        return bands_dict.keys()[bands_dict.values().index(value)]
+        return key2band[value]
 
     def callback(band):
         band_key = value2key(band)
-        Shared.shared.write(band_key, True)
-        logger.info("%s downloaded." % band_key)
+        if Shared.key(product, band_key) in Shared.shared:
+            Shared.shared.notify(Shared.key(product, band_key))
+        logger.info("%s downloaded.", band_key)
+
+    def errback(band):
+        def failed(error):
+            if Shared.key(product, band) in Shared.shared:
+                Shared.shared.fail(Shared.key(product, band))
+        return failed
 
     if targets:
         bands = [bands_dict[i] for i in targets]
@@ -155,19 +375,27 @@ def get_product_data(bands_dict, s3conf, targets=None):
     def obj_downloader(band, bucket_id):
         t0 = time.time()
         bname = value2key(band)
-        logger.info('%s - start object download' % bname)
-        obj = _download_obj(band, bucket_id)
-        logger.info('%s - finish object download. Time took: %0.3f' % (bname, time.time() - t0))
+        if Shared.key(product, bname) in Shared.shared:
+            Shared.shared.transition(Shared.key(product, bname), Shared.REGISTERED, Shared.DOWNLOADING)
+        logger.info('%s - start object download', bname)
+        if roi and band.endswith('.jp2'):
+            obj = _download_window(band, bucket_id, pm.band_window(bname, roi))
+        else:
+            obj = _download_obj(band, bucket_id, 'band')
+        logger.info('%s - finish object download. Time took: %0.3f', bname, time.time() - t0)
         return obj
 
-    pool = ThreadPool(processes=len(bands))
-    logger.info("Product data: starting download of %s" % str(bands))
-    res = []
-    for band in bands:
-        res.append(pool.apply_async(obj_downloader, args=(band, s3conf), callback=callback))
-
-    pool.close()
-    pool.join()
+    downloader = scheduler.get_scheduler(DOWNLOAD_THREADS)
+    logger.info("Product data: starting download of %s", bands)
+    jobs = [downloader.submit(obj_downloader, (band, s3conf), _band_priority(product, value2key(band)),
+                              callback=callback, name=band, errback=errback(value2key(band)))
+            for band in bands]
+    for job in jobs:
+        job.wait()
+    failed = [value2key(job.name) for job in jobs if job.error is not None]
+    if failed:
+        logger.error("Product data: bands %s of %s failed to download.", failed, product)
+    cache.log_stats()
 
 
 def _locate_metadata(files, bands):
@@ -177,6 +405,7 @@ def _locate_metadata(files, bands):
     :param bands:
     :return:
     """
+    bands = set(bands)
     return [f for f in files if f not in bands]
 
 
@@ -190,7 +419,7 @@ def init(s3conf, product):
     :param product:
     :return:
     """
-    product_file_list = _get_product_keys(s3conf, product)
-    bands_index = _locate_bands(product, pm.get_meta_from_prod(product), product_file_list, s3conf)
-    metadata_loc = _locate_metadata(product_file_list, bands_index.values())
+    product_manifest = _get_manifest(s3conf, product)
+    bands_index = _locate_bands(product, pm.get_meta_from_prod(product), product_manifest, s3conf)
+    metadata_loc = _locate_metadata(product_manifest.keys(), bands_index.values())
     return bands_index, metadata_loc
@@ -1,4 +1,15 @@
 ''' Draft function returning the metadata '.xml' filename from the product name '''
+import xml.etree.ElementTree as ET
+
+# Resolution in meters of the Sentinel-2 bands.
+BAND_RESOLUTION = {'B01': 60, 'B02': 10, 'B03': 10, 'B04': 10, 'B05': 20,
+                   'B06': 20, 'B07': 20, 'B08': 10, 'B8A': 20, 'B09': 60,
+                   'B10': 60, 'B11': 20, 'B12': 20}
+
+# Resolution in meters the products are resampled to before processing.
+PROCESSING_RESOLUTION = 60
+# Default region (x, y, w, h) of the processing grid kept by the subset.
+SUBSET_REGION = (0, 500, 500, 500)
 
 
 def get_meta_from_prod(p):
@@ -9,3 +20,37 @@ def get_meta_from_prod(p):
         foo = p.split('_')[1] + '.xml'
         bar = p + '/MTD_'
     return bar + foo
+
+
+def band_window(band, roi):
+    """Returns the window (x, y, w, h) in pixels of the band covering the
+    region of interest given in pixels of the processing grid."""
+    scale = PROCESSING_RESOLUTION // BAND_RESOLUTION.get(band, PROCESSING_RESOLUTION)
+    return tuple(v * scale for v in roi)
+
+
+# Tags of the band file names in the product metadata, in the 'MSIL1C' and
+# the older 'S2A_OPER' layouts.
+BAND_FILE_TAGS = ('IMAGE_FILE', 'IMAGE_ID')
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def parse_band_files(stream):
+    """Returns the band file names listed in the first granule of the product
+    metadata. The document is parsed incrementally and the reading stops as
+    soon as the list is complete.
+
+    :param stream: file-like object of the metadata '.xml'
+    :return: list of band file names without extension
+    """
+    files = []
+    for _, elem in ET.iterparse(stream, events=('end',)):
+        tag = _local_name(elem.tag)
+        if tag in BAND_FILE_TAGS:
+            files.append(elem.text.strip())
+        elif files and tag.startswith('Granule'):
+            break
+    return files
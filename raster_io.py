@@ -0,0 +1,87 @@
+import numpy
+
+from utils import config_get_num
+
+''' Tiled raster reading and writing with a bounded memory.
+
+    The rasters are never loaded whole: they are read with
+    readPixels(x, y, w, h, buffer) tile by tile into buffers allocated once
+    and reused for every tile, and the results are written to the output
+    tile by tile with writePixels. The size of the tiles follows from the
+    memory budget of a worker, so that the memory used by a task does not
+    depend on the size of the bands.
+'''
+
+MB = 1024 ** 2
+# Memory a worker may use for the tiles in flight.
+TILE_MEMORY = config_get_num('tile_memory_mb', 64) * MB
+
+
+def strip_rows(width, bytes_per_pixel, budget=None, multiple=1):
+    """Returns the number of rows of full width strips fitting the memory
+    budget, at least and a multiple of 'multiple'.
+
+    :param width: raster width in pixels
+    :param bytes_per_pixel: memory used per pixel of a strip by all the
+                            buffers and temporaries of the processing
+    :param budget: bytes, TILE_MEMORY by default
+    :param multiple: granularity of the number of rows
+    """
+    budget = budget or TILE_MEMORY
+    rows = int(budget // (width * bytes_per_pixel))
+    return max(multiple, rows // multiple * multiple)
+
+
+def tiles(width, height, tile_width, tile_height):
+    """Yields the (x, y, w, h) tiles covering the raster, row by row."""
+    for y in range(0, height, tile_height):
+        for x in range(0, width, tile_width):
+            yield x, y, min(tile_width, width - x), min(tile_height, height - y)
+
+
+class TileReader(object):
+    """Reads the tiles of a band into buffers reused from tile to tile.
+    The arrays returned are only valid until the next read."""
+
+    def __init__(self, band, dtype=numpy.float64, valid_mask=False):
+        """
+        :param band: SNAP band
+        :param dtype: type of the pixels read, float64 for the geophysical
+                      values as used by the band maths
+        :param valid_mask: also reads the valid pixels mask of the band
+        """
+        self.band = band
+        self.dtype = dtype
+        self.valid_mask = valid_mask
+        self._data = numpy.empty(0, dtype)
+        self._mask = numpy.empty(0, numpy.bool_)
+
+    def read(self, x, y, w, h):
+        """Returns the pixels of the tile as an array of h x w and its valid
+        pixels mask, None if not read."""
+        n = w * h
+        if len(self._data) < n:
+            self._data = numpy.empty(n, self.dtype)
+            if self.valid_mask:
+                self._mask = numpy.empty(n, numpy.bool_)
+        data = self._data[:n]
+        self.band.readPixels(x, y, w, h, data)
+        mask = None
+        if self.valid_mask:
+            mask = self._mask[:n]
+            self.band.readValidMask(x, y, w, h, mask)
+            mask = mask.reshape(h, w)
+        return data.reshape(h, w), mask
+
+
+class TileWriter(object):
+    """Streams the tiles of a band to the writer of its product, the header
+    of which must have been written."""
+
+    def __init__(self, band):
+        self.band = band
+
+    def write(self, x, y, values):
+        """Writes the h x w array 'values' at (x, y)."""
+        h, w = values.shape
+        self.band.writePixels(x, y, w, h, numpy.ascontiguousarray(values).ravel())
@@ -0,0 +1,240 @@
+from __future__ import print_function
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urllib import unquote
+from urlparse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+import email.utils
+import hashlib
+import os
+import random
+import sys
+import threading
+import time
+
+''' Local S3-compatible stand-in for benchmarks. Serves the files of
+    '<root>/<bucket>/<key>' with path-style addressing and supports the calls
+    used by the framework: ListObjects (v1 and v2), HeadObject and GetObject
+    with an optional byte range. Connection setup delay, per request
+    latency, straggling requests and throttling errors can be simulated.
+
+    usage: python s3_stub.py <root_dir> [port]
+'''
+
+LIST_PAGE_SIZE = 1000
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.count('connections')
+        if self.server.connect_delay:
+            time.sleep(self.server.connect_delay)
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _split_path(self):
+        url = urlparse(self.path)
+        parts = unquote(url.path).lstrip('/').split('/', 1)
+        bucket = parts[0]
+        key = parts[1] if len(parts) > 1 else ''
+        return bucket, key, parse_qs(url.query, keep_blank_values=True)
+
+    def _send(self, code, body='', headers=None):
+        self.send_response(code)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _not_found(self, key):
+        body = '<?xml version="1.0" encoding="UTF-8"?><Error><Code>NoSuchKey</Code>' \
+               '<Key>%s</Key></Error>' % escape(key)
+        self._send(404, body, {'Content-Type': 'application/xml'})
+
+    def _delay(self):
+        self.server.count('requests')
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def _fault(self):
+        """Delays or fails the request at the rates set on the server.
+
+        :return: True if an error was sent
+        """
+        server = self.server
+        if server.error_rate and random.random() < server.error_rate:
+            server.count('errors')
+            body = '<?xml version="1.0" encoding="UTF-8"?><Error><Code>SlowDown</Code>' \
+                   '<Message>Please reduce your request rate.</Message></Error>'
+            self._send(503, body, {'Content-Type': 'application/xml'})
+            return True
+        if server.straggler_rate and random.random() < server.straggler_rate:
+            server.count('stragglers')
+            time.sleep(server.straggler_delay)
+        return False
+
+    def do_HEAD(self):
+        self._delay()
+        bucket, key, _ = self._split_path()
+        path = self.server.path(bucket, key)
+        if not os.path.isfile(path):
+            return self._send(404)
+        self.send_response(200)
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.send_header('ETag', self.server.etag(path))
+        self.send_header('Last-Modified', email.utils.formatdate(os.path.getmtime(path), usegmt=True))
+        self.end_headers()
+
+    def do_GET(self):
+        self._delay()
+        bucket, key, query = self._split_path()
+        if not key:
+            return self._list(bucket, query)
+        path = self.server.path(bucket, key)
+        if not os.path.isfile(path):
+            return self._not_found(key)
+        if self._fault():
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        code = 200
+        headers = {'ETag': self.server.etag(path),
+                   'Accept-Ranges': 'bytes',
+                   'Content-Type': 'application/octet-stream',
+                   'Last-Modified': email.utils.formatdate(os.path.getmtime(path), usegmt=True)}
+        rng = self.headers.getheader('Range')
+        if rng and rng.startswith('bytes='):
+            first, _, last = rng[len('bytes='):].partition('-')
+            if first:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            else:
+                start = max(0, size - int(last))
+            code = 206
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        with open(path, 'rb') as f:
+            f.seek(start)
+            body = f.read(end - start + 1)
+        self.server.count('bytes', len(body))
+        self._send(code, body, headers)
+
+    def _list(self, bucket, query):
+        def arg(name, default=''):
+            return query.get(name, [default])[0]
+
+        v2 = arg('list-type') == '2'
+        prefix = arg('prefix')
+        max_keys = int(arg('max-keys', LIST_PAGE_SIZE))
+        after = arg('continuation-token') or arg('start-after') if v2 else arg('marker')
+        keys = [k for k in self.server.keys(bucket) if k.startswith(prefix) and k > after]
+        page, truncated = keys[:max_keys], len(keys) > max_keys
+
+        contents = []
+        for k in page:
+            path = self.server.path(bucket, k)
+            contents.append('<Contents><Key>%s</Key><LastModified>%s</LastModified><ETag>%s</ETag>'
+                            '<Size>%d</Size><StorageClass>STANDARD</StorageClass></Contents>' %
+                            (escape(k), time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                                      time.gmtime(os.path.getmtime(path))),
+                             escape(self.server.etag(path)), os.path.getsize(path)))
+        if v2:
+            marker = '<KeyCount>%d</KeyCount>' % len(page)
+            if truncated:
+                marker += '<NextContinuationToken>%s</NextContinuationToken>' % escape(page[-1])
+        else:
+            marker = '<Marker>%s</Marker>' % escape(after)
+            if truncated:
+                marker += '<NextMarker>%s</NextMarker>' % escape(page[-1])
+        body = '<?xml version="1.0" encoding="UTF-8"?>' \
+               '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">' \
+               '<Name>%s</Name><Prefix>%s</Prefix>%s<MaxKeys>%d</MaxKeys>' \
+               '<IsTruncated>%s</IsTruncated>%s</ListBucketResult>' % \
+               (escape(bucket), escape(prefix), marker, max_keys,
+                'true' if truncated else 'false', ''.join(contents))
+        self._send(200, body, {'Content-Type': 'application/xml'})
+
+
+class S3Stub(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root, port=0, latency=0., connect_delay=0.,
+                 straggler_rate=0., straggler_delay=0., error_rate=0.):
+        """
+        :param root: directory containing one sub-directory per bucket
+        :param port: port to listen to on localhost, 0 for any free port
+        :param latency: seconds added to each request
+        :param connect_delay: seconds added to each new connection
+        :param straggler_rate: fraction of the object GETs delayed by
+                               'straggler_delay' seconds
+        :param straggler_delay: seconds added to a straggling GET
+        :param error_rate: fraction of the object GETs answered with a 503
+                           SlowDown error
+        """
+        HTTPServer.__init__(self, ('127.0.0.1', port), _Handler)
+        self.root = root
+        self.latency = latency
+        self.connect_delay = connect_delay
+        self.straggler_rate = straggler_rate
+        self.straggler_delay = straggler_delay
+        self.error_rate = error_rate
+        self.stats = {'connections': 0, 'requests': 0, 'bytes': 0, 'stragglers': 0, 'errors': 0}
+        self._etags = {}
+        self._lock = threading.Lock()
+
+    @property
+    def endpoint_url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+
+    def reset_stats(self):
+        with self._lock:
+            for k in self.stats:
+                self.stats[k] = 0
+
+    def path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def keys(self, bucket):
+        top = os.path.join(self.root, bucket)
+        keys = []
+        for d, _, files in os.walk(top):
+            for f in files:
+                keys.append(os.path.relpath(os.path.join(d, f), top))
+        return sorted(keys)
+
+    def etag(self, path):
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            cached = self._etags.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 ** 2), b''):
+                md5.update(chunk)
+        etag = '"%s"' % md5.hexdigest()
+        with self._lock:
+            self._etags[path] = (mtime, etag)
+        return etag
+
+    def start(self):
+        """Serves the requests in a background thread."""
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+
+if __name__ == '__main__':
+    stub = S3Stub(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 0)
+    print('Serving %s on %s' % (stub.root, stub.endpoint_url))
+    stub.serve_forever()
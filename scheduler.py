@@ -0,0 +1,115 @@
+import heapq
+import itertools
+import os
+import sys
+import threading
+import time
+
+import metrics
+from log import get_logger
+
+logger = get_logger()
+
+''' Bounded, priority-ordered download scheduler.
+
+    A single pool of download threads per process serves a priority queue of
+    jobs, so the number of threads does not grow with the number of objects
+    and the objects needed first are fetched first. Lower priorities are
+    served first, jobs of equal priority in submission order.
+'''
+
+
+class Job(object):
+
+    def __init__(self, func, args, callback, name='', errback=None):
+        self.func = func
+        self.args = args
+        self.callback = callback
+        self.errback = errback
+        self.name = name
+        self.submitted = time.time()
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def run(self):
+        metrics.record('queue', time.time() - self.submitted, self.name)
+        try:
+            self.result = self.func(*self.args)
+            if self.callback:
+                self.callback(self.result)
+        except Exception:
+            self.error = sys.exc_info()[1]
+            logger.error('Download job %s%s failed: %s', self.func.__name__, self.args, self.error)
+            if self.errback:
+                self.errback(self.error)
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+
+    def get(self):
+        """Waits for the job to finish and returns its result."""
+        self.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class DownloadScheduler(object):
+
+    def __init__(self, nb_threads):
+        self.nb_threads = nb_threads
+        self._queue = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def _start(self):
+        """Must be called with the lock held."""
+        while len(self._threads) < self.nb_threads:
+            t = threading.Thread(target=self._worker, name='downloader-%d' % len(self._threads))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                _, _, job = heapq.heappop(self._queue)
+            job.run()
+
+    def submit(self, func, args, priority=0, callback=None, name='', errback=None):
+        """Queues the call of 'func' with 'args'.
+
+        :param priority: lower values are served first
+        :param callback: called with the result of the job on success
+        :param name: name of the job in the queue wait metrics
+        :param errback: called with the exception of the job on failure
+        :return: Job
+        """
+        job = Job(func, args, callback, name, errback)
+        with self._cond:
+            self._start()
+            heapq.heappush(self._queue, (priority, next(self._seq), job))
+            self._cond.notify()
+        return job
+
+    def pending(self):
+        with self._cond:
+            return len(self._queue)
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(nb_threads):
+    """Returns the download scheduler of the current process."""
+    pid = os.getpid()
+    with _schedulers_lock:
+        if pid not in _schedulers:
+            _schedulers[pid] = DownloadScheduler(nb_threads)
+        return _schedulers[pid]
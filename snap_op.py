@@ -1,24 +1,58 @@
+from contextlib import contextmanager
 from functools import wraps
+import importlib
 import os
 import sys
 import time
 
-sys.path.append(os.path.expanduser('~/.snap/snap-python'))
-import snappy
-from snappy import ProductIO
+from log import get_logger
+import metrics
+import object_cache
+import product_meta as pm
+from utils import Lazy, config_get_num, config_get_str
 
-jpy = snappy.jpy
-from snappy import GPF
-from snappy import Rectangle
-import matplotlib
+logger = get_logger()
 
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import numpy
+SNAPPY_DIR = os.path.expanduser('~/.snap/snap-python')
 
-from log import get_logger
 
-logger = get_logger()
+def _import_snappy():
+    """Imports snappy, which starts the JVM."""
+    if SNAPPY_DIR not in sys.path:
+        sys.path.append(SNAPPY_DIR)
+    return importlib.import_module('snappy')
+
+
+def _import_pyplot():
+    import matplotlib
+    matplotlib.use('Agg')
+    return importlib.import_module('matplotlib.pyplot')
+
+
+# Imported on first use, so that the processes importing the module only to
+# pass its functions to the processing workers, e.g. the planner, the
+# product and the download processes, neither start a JVM nor load NumPy.
+snappy = Lazy(_import_snappy)
+ProductIO = Lazy(lambda: snappy.ProductIO)
+GPF = Lazy(lambda: snappy.GPF)
+jpy = Lazy(lambda: snappy.jpy)
+plt = Lazy(_import_pyplot)
+numpy = Lazy(lambda: importlib.import_module('numpy'))
+index_engine = Lazy(lambda: importlib.import_module('index_engine'))
+raster_io = Lazy(lambda: importlib.import_module('raster_io'))
+
+# Largest side in pixels of the image plotted by save_array.
+PREVIEW_SIZE = 1200
+
+# Cache of the resampled and subset bands, disabled with a budget of 0.
+# Each entry is one band of a product at a resolution and region, stored in
+# BEAM-DIMAP, which is read back without decoding the JPEG 2000 again.
+intermediates = object_cache.ProductCache(
+    os.path.expanduser(config_get_str('intermediate_cache_dir', '~/.cache/eo-data-access/intermediates')),
+    config_get_num('intermediate_cache_budget_gb', 20, float) * object_cache.GB)
+INTERMEDIATE_FILE = 'intermediate.dim'
+
+_operators_loaded = False
 
 ''' Read, resample, subset, and compute the vegetation indices of SENTINEL-2
     products'''
@@ -31,22 +65,32 @@ def _log_product_info(product):
     description = product.getDescription()
     band_names = product.getBandNames()
 
-    logger.info("Product:     %s, %s" % (name, description))
-    logger.info("Raster size: %d x %d pixels" % (width, height))
+    logger.info("Product:     %s, %s", name, description)
+    logger.info("Raster size: %d x %d pixels", width, height)
     logger.info("Start time:  " + str(product.getStartTime()))
     logger.info("End time:    " + str(product.getEndTime()))
-    logger.info("Bands:       %s" % (list(band_names)))
+    logger.info("Bands:       %s", list(band_names))
 
 
-def start_stop(msg):
+def start_stop(msg, stage=None):
+    """Logs the start and the duration of the decorated function and
+    records it in the metrics under 'stage' if set."""
     def func_decor(func):
         # FIXME: %(funcName)s in the logger still prints the name of the wrapper function.
         @wraps(func)
         def func_wrap(*args, **kwargs):
             t0 = time.time()
             logger.info('>>> Start: %s', msg)
-            res = func(*args, **kwargs)
-            logger.info('>>> Finish: %s. Time took: %.3f', msg, time.time() - t0)
+            try:
+                res = func(*args, **kwargs)
+            except Exception:
+                if stage:
+                    metrics.record(stage, time.time() - t0, error=True)
+                raise
+            dt = time.time() - t0
+            if stage:
+                metrics.record(stage, dt)
+            logger.info('>>> Finish: %s. Time took: %.3f', msg, dt)
             return res
         func_wrap.__name__ = func.__name__
         return func_wrap
@@ -54,21 +98,37 @@ def start_stop(msg):
     return func_decor
 
 
-@start_stop('read product')
+def load_operators():
+    """Registers the GPF operators, once per process."""
+    global _operators_loaded
+    if not _operators_loaded:
+        GPF.getDefaultInstance().getOperatorSpiRegistry().loadOperatorSpis()
+        _operators_loaded = True
+
+
+def init_worker():
+    """Initializer of the processing workers: snappy is imported, starting
+    the JVM, and the operators are registered before the first task."""
+    t0 = time.time()
+    load_operators()
+    logger.info('SNAP worker ready. Time took: %.3f', time.time() - t0)
+
+
+@start_stop('read product', 'read')
 def read_product(fn):
     product = ProductIO.readProduct(os.getcwd() + '/' + fn)
     _log_product_info(product)
     return product
 
 
-@start_stop('write product')
+@start_stop('write product', 'write')
 def write_product(product, veg_index):
     fn = 'snappy_bmaths_output_%s_%s.dim' % (veg_index, product.getName())
     fmt = 'BEAM-DIMAP'
     ProductIO.writeProduct(product, fn, fmt)
 
 
-@start_stop('re-sampling')
+@start_stop('re-sampling', 'resample')
 def resample(product, params):
     _log_product_info(product)
     HashMap = jpy.get_type('java.util.HashMap')
@@ -77,8 +137,8 @@ def resample(product, params):
     return GPF.createProduct('Resample', parameters, product)
 
 
-@start_stop('sub-setting')
-def subset(product):
+@start_stop('sub-setting', 'subset')
+def subset(product, region=pm.SUBSET_REGION):
     _log_product_info(product)
     SubsetOp = jpy.get_type('org.esa.snap.core.gpf.common.SubsetOp')
     #    WKTReader = jpy.get_type('com.vividsolutions.jts.io.WKTReader')
@@ -90,17 +150,24 @@ def subset(product):
     #    geometry = WKTReader().read(wkt)
     op = SubsetOp()
     op.setSourceProduct(product)
-    op.setRegion(Rectangle(0, 500, 500, 500))
+    op.setRegion(snappy.Rectangle(*region))
     sub_product = op.getTargetProduct()
     return sub_product
 
 
 def save_array(band):
+    """Plots the band. The band is read by strips and subsampled to at most
+    PREVIEW_SIZE pixels per side, the resolution of the figure, so that a
+    full resolution band is never loaded whole."""
     w = band.getRasterWidth()
     h = band.getRasterHeight()
-    band_data = numpy.zeros(w * h, numpy.float32)
-    band.readPixels(0, 0, w, h, band_data)
-    band_data.shape = h, w
+    step = max(1, -(-max(w, h) // PREVIEW_SIZE))
+    band_data = numpy.empty((-(-h // step), -(-w // step)), numpy.float32)
+    reader = raster_io.TileReader(band, numpy.float32)
+    rows = raster_io.strip_rows(w, 4, multiple=step)
+    for x, y, tw, th in raster_io.tiles(w, h, w, rows):
+        tile, _ = reader.read(x, y, tw, th)
+        band_data[y // step:(y + th + step - 1) // step] = tile[::step, ::step]
     width = 12
     height = 12
     fig = plt.figure(figsize=(width, height))
@@ -111,10 +178,10 @@ def save_array(band):
     plt.savefig(band.getName() + '.jpg')
 
 
-@start_stop('compute vegetation index')
+@start_stop('compute vegetation index', 'bandmaths')
 def compute_vegetation_index(product, index, index_expr):
-    logger.info("vegetation index to compute: %s" % index)
-    GPF.getDefaultInstance().getOperatorSpiRegistry().loadOperatorSpis()
+    logger.info("vegetation index to compute: %s", index)
+    load_operators()
     HashMap = jpy.get_type('java.util.HashMap')
     BandDescriptor = jpy.get_type('org.esa.snap.core.gpf.common.BandMathsOp$BandDescriptor')
     targetBand = BandDescriptor()
@@ -128,33 +195,228 @@ def compute_vegetation_index(product, index, index_expr):
     logger.info("Start to compute expression:" + index_expr)
     result = GPF.createProduct('BandMaths', parameters, product)
     logger.info('Expression computed: ' + index_expr)
-    logger.info('Result: %s' % result)
+    logger.info('Result: %s', result)
     return result
 
 
-@start_stop(__name__)
-def _main(product_fn_xml, veg_index, index_expr):
+@start_stop('compute vegetation indices', 'bandmaths')
+def compute_vegetation_indices(product, indices):
+    """Computes several indices with a single BandMaths operator, one target
+    band per index, so that the source bands are read once for all of them.
+
+    :param product: source product
+    :param indices: [(index, expression),]
+    :return: product with one band per index
+    """
+    logger.info("vegetation indices to compute: %s", [i for i, _ in indices])
+    load_operators()
+    HashMap = jpy.get_type('java.util.HashMap')
+    BandDescriptor = jpy.get_type('org.esa.snap.core.gpf.common.BandMathsOp$BandDescriptor')
+    targetBands = jpy.array('org.esa.snap.core.gpf.common.BandMathsOp$BandDescriptor', len(indices))
+    for i, (index, index_expr) in enumerate(indices):
+        targetBand = BandDescriptor()
+        targetBand.name = index
+        targetBand.type = 'float32'
+        targetBand.expression = index_expr
+        targetBands[i] = targetBand
+    parameters = HashMap()
+    parameters.put('targetBands', targetBands)
+    result = GPF.createProduct('BandMaths', parameters, product)
+    logger.info('Result: %s', result)
+    return result
+
+
+def select_bands(product, band_names):
+    """Returns the product restricted to the bands 'band_names'."""
+    SubsetOp = jpy.get_type('org.esa.snap.core.gpf.common.SubsetOp')
+    op = SubsetOp()
+    op.setSourceProduct(product)
+    op.setBandNames(jpy.array('java.lang.String', band_names))
+    sub_product = op.getTargetProduct()
+    sub_product.setName(product.getName())
+    return sub_product
+
+
+@start_stop('compute vegetation indices with numpy', 'bandmaths')
+def write_indices_numpy(product, indices, budget=None):
+    """Computes the indices with the NumPy engine and writes one output per
+    index, as write_product does for the BandMaths results. The source bands
+    are read and the results written by strips sized for the memory budget,
+    the pixels crossing the JVM boundary a strip at a time instead of one by
+    one.
+
+    :param product: source product
+    :param indices: [(index, expression),]
+    :param budget: memory in bytes for the strips, raster_io.TILE_MEMORY by default
+    :return:
+    """
+    logger.info("vegetation indices to compute with numpy: %s", [i for i, _ in indices])
+    Product = jpy.get_type('org.esa.snap.core.datamodel.Product')
+    ProductData = jpy.get_type('org.esa.snap.core.datamodel.ProductData')
+    ProductUtils = jpy.get_type('org.esa.snap.core.util.ProductUtils')
+    w = product.getSceneRasterWidth()
+    h = product.getSceneRasterHeight()
+    expressions = [index_engine.compile_expr(expr) for _, expr in indices]
+
+    targets = []
+    for veg_index, _ in indices:
+        target = Product(product.getName(), product.getProductType(), w, h)
+        ProductUtils.copyGeoCoding(product, target)
+        band = target.addBand(veg_index, ProductData.TYPE_FLOAT32)
+        band.setNoDataValue(index_engine.NO_DATA)
+        band.setNoDataValueUsed(True)
+        target.setProductWriter(ProductIO.getProductWriter('BEAM-DIMAP'))
+        target.writeHeader('snappy_bmaths_output_%s_%s.dim' % (veg_index, product.getName()))
+        targets.append((target, raster_io.TileWriter(band)))
+    readers = {}
+
+    def read_block(band_names, y, rows):
+        data = {}
+        masks = {}
+        for name in band_names:
+            if name not in readers:
+                readers[name] = raster_io.TileReader(product.getBand(name), valid_mask=True)
+            data[name], masks[name] = readers[name].read(0, y, w, rows)
+        return data, masks
+
+    def write_block(i, y, rows, values):
+        targets[i][1].write(0, y, values)
+
+    rows = raster_io.strip_rows(w, index_engine.block_bytes_per_pixel(expressions), budget)
+    logger.info('Strips of %d rows of %d pixels.', rows, w)
+    index_engine.evaluate_blocks(expressions, read_block, write_block, w, h, rows)
+    for target, _ in targets:
+        target.closeIO()
+
+
+@start_stop('write intermediate product', 'write')
+def write_intermediate(product, directory):
+    ProductIO.writeProduct(product, os.path.join(directory, INTERMEDIATE_FILE), 'BEAM-DIMAP')
+
+
+@start_stop('read intermediate product', 'read')
+def read_intermediates(directories):
+    """Reads the single band intermediate products and returns them as one
+    product with all the bands."""
+    ProductUtils = jpy.get_type('org.esa.snap.core.util.ProductUtils')
+    products = [ProductIO.readProduct(os.path.join(d, INTERMEDIATE_FILE)) for d in directories]
+    product = products[0]
+    for other in products[1:]:
+        for name in other.getBandNames():
+            ProductUtils.copyBand(name, other, product, True)
+    _log_product_info(product)
+    return product
+
+
+def _expressions_bands(indices):
+    """Returns the names of the bands the expressions refer to, None if one
+    of them is not understood by the expression parser."""
+    try:
+        return sorted(set().union(*[index_engine.compile_expr(e).bands for _, e in indices]))
+    except index_engine.ExpressionError as ex:
+        logger.warn('Intermediate product cache not used: %s', ex)
+        return None
+
+
+@contextmanager
+def prepared_product(product_fn_xml, indices, roi=None):
+    """Yields the product read, resampled and subset, with at least the bands
+    used by the indices.
+
+    The bands are taken from the cache of intermediate products, the missing
+    ones being computed from the raw product with a single read, resample
+    and subset. A band is computed by a single worker at a time, the others
+    waiting for it and reusing it. The product must only be used within the
+    context.
+
+    :param product_fn_xml: path to product's metadata xml
+    :param indices: [(index, expression),]
+    :param roi: (x, y, w, h) region of interest in pixels of the processing grid
+    """
+    region = tuple(roi or pm.SUBSET_REGION)
+    bands = _expressions_bands(indices) if intermediates.enabled() else None
+    if not bands:
+        product = read_product(product_fn_xml)
+        product = resample(product, pm.PROCESSING_RESOLUTION)
+        yield subset(product, region)
+        return
+
+    names = dict(('%s/%s/%s/%s' % (product_fn_xml, pm.PROCESSING_RESOLUTION, region, b), b) for b in bands)
+
+    def compute(dirs):
+        logger.info('Computing the intermediate bands %s of %s.', [names[n] for n in dirs], product_fn_xml)
+        product = read_product(product_fn_xml)
+        product = resample(product, pm.PROCESSING_RESOLUTION)
+        product = subset(product, region)
+        for name, directory in dirs.items():
+            write_intermediate(select_bands(product, [names[name]]), directory)
+
+    with intermediates.use(list(names), compute) as paths:
+        yield read_intermediates([paths[n] for n in sorted(names)])
+    intermediates.log_stats()
+
+
+@start_stop(__name__, 'task')
+def _main(product_fn_xml, veg_index, index_expr, roi=None):
     """
     :param product_fn_xml: path to product's metadata xml
     :param veg_index: vegetation index to compute
     :param index_expr: expression to compute
+    :param roi: (x, y, w, h) region of interest in pixels of the processing grid
     :return:
     """
     logger.info('snap_op main - product: %s', product_fn_xml)
     logger.info('snap_op main - vegetation index: %s', veg_index)
     logger.info('snap_op main - expression: %s', index_expr)
-    product = read_product(product_fn_xml)
-    product = resample(product, 60)
-    product = subset(product)
-    result = compute_vegetation_index(product, veg_index, index_expr)
-    logger.info('Final result computed.')
-    _log_product_info(result)
-    write_product(result, veg_index)
+    with prepared_product(product_fn_xml, [(veg_index, index_expr)], roi) as product:
+        result = compute_vegetation_index(product, veg_index, index_expr)
+        logger.info('Final result computed.')
+        _log_product_info(result)
+        write_product(result, veg_index)
 
 
-def main(product_fn_xml, index, index_expr):
+def main(product_fn_xml, index, index_expr, roi=None):
     "For calling from multi-threaded environment."
-    _main(product_fn_xml, index, index_expr)
+    _main(product_fn_xml, index, index_expr, roi)
+
+
+@start_stop(__name__ + ' numpy', 'task')
+def main_numpy(product_fn_xml, index, index_expr, roi=None):
+    """Same as 'main', or 'main_fused' if 'index_expr' is a list, with the
+    indices computed by the NumPy engine instead of the BandMaths operator.
+
+    :param product_fn_xml: path to product's metadata xml
+    :param index: vegetation index, or name of the fused task
+    :param index_expr: expression, or [(index, expression),]
+    :param roi: (x, y, w, h) region of interest in pixels of the processing grid
+    :return:
+    """
+    logger.info('snap_op main numpy - product: %s', product_fn_xml)
+    logger.info('snap_op main numpy - vegetation indices: %s %s', index, index_expr)
+    indices = index_expr if isinstance(index_expr, list) else [(index, index_expr)]
+    with prepared_product(product_fn_xml, indices, roi) as product:
+        write_indices_numpy(product, indices)
+
+
+@start_stop(__name__ + ' fused', 'task')
+def main_fused(product_fn_xml, index, index_expr, roi=None):
+    """Computes all the indices of a product with a single read, resample
+    and subset, and writes one output per index, as 'main' does.
+
+    :param product_fn_xml: path to product's metadata xml
+    :param index: name of the fused task
+    :param index_expr: [(index, expression),] as built by proc_runner.fuse_tasks
+    :param roi: (x, y, w, h) region of interest in pixels of the processing grid
+    :return:
+    """
+    logger.info('snap_op main fused - product: %s', product_fn_xml)
+    logger.info('snap_op main fused - vegetation indices: %s', index_expr)
+    with prepared_product(product_fn_xml, index_expr, roi) as product:
+        result = compute_vegetation_indices(product, index_expr)
+        logger.info('Final result computed.')
+        _log_product_info(result)
+        for veg_index, _ in index_expr:
+            write_product(select_bands(result, [veg_index]), veg_index)
 
 
 if __name__ == '__main__':
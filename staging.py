@@ -0,0 +1,145 @@
+from contextlib import contextmanager
+from multiprocessing import Lock, RawValue
+import ctypes
+import errno
+import os
+import shutil
+
+from utils import config_get_num, config_get_str
+from log import get_logger
+
+logger = get_logger()
+
+''' Staging area of the downloaded objects.
+
+    The objects are downloaded to a RAM backed directory (tmpfs) as long as
+    the memory budget allows it, and to the working directory beyond it. The
+    path of an object in the product directory is then a symbolic link to
+    its file in memory, so that the readers do not have to know where it is.
+    The files in memory mirror the absolute paths of the objects, so that
+    runs in different working directories, e.g. the agents of a multi-node
+    run on the same host, do not share them.
+
+    The memory used is accounted in shared memory inherited by the forked
+    processes, like the shared index. Once the last task using an object is
+    done, the object is released: its file is removed from the memory or
+    from the disk, which bounds both over runs of many products.
+'''
+
+MB = 1024 ** 2
+
+STAGING_DIR = os.path.expanduser(config_get_str('staging_dir', '/dev/shm/eo-staging'))
+# Memory in bytes the staged objects may use, 0 downloads to disk only.
+STAGING_MEMORY = config_get_num('staging_memory_mb', 1024) * MB
+# Removes the objects once processed.
+RELEASE = config_get_str('staging_release', 'true').lower() in ('true', 'yes', '1')
+
+_lock = Lock()
+_used = RawValue(ctypes.c_longlong, 0)
+
+
+def _size(path):
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _memory_path(path):
+    return os.path.join(STAGING_DIR, os.path.abspath(path).lstrip(os.sep))
+
+
+def _in_memory(path):
+    return path.startswith(STAGING_DIR + os.sep)
+
+
+def _reserve(n):
+    with _lock:
+        if _used.value + n > STAGING_MEMORY:
+            return False
+        _used.value += n
+        return True
+
+
+def _free(n):
+    with _lock:
+        _used.value = max(0, _used.value - n)
+
+
+def init():
+    """Accounts the files left in memory by a previous run, which may be
+    reused. Must be called before the processes are forked."""
+    if STAGING_MEMORY and os.path.isdir(STAGING_DIR):
+        _used.value = _size(STAGING_DIR)
+        logger.info('Staging: %0.1f MB in memory from a previous run.', _used.value / float(MB))
+
+
+def used():
+    """Returns the memory in bytes used by the staged objects."""
+    return _used.value
+
+
+@contextmanager
+def staged(obj, size):
+    """Yields the path the object 'obj' of 'size' bytes must be written to,
+    in memory if it fits in the budget, 'obj' itself otherwise. Once written,
+    'obj' links to the file in memory. On error the memory is given back.
+
+    :param obj: local path of the object
+    :param size: size of the object in bytes, an upper bound if the file
+                 written is smaller
+    """
+    if not STAGING_MEMORY or not _reserve(size):
+        yield obj
+        return
+    path = _memory_path(obj)
+    try:
+        _makedirs(os.path.dirname(path))
+    except OSError as ex:
+        _free(size)
+        logger.warn('Staging: cannot write to %s, %s written to disk: %s', STAGING_DIR, obj, ex)
+        yield obj
+        return
+    try:
+        yield path
+    except BaseException:
+        _free(size)
+        raise
+    _free(size - os.path.getsize(path))
+    tmp = obj + '.lnk'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(os.path.abspath(path), tmp)
+    os.rename(tmp, obj)
+
+
+def release(obj):
+    """Removes the object from the memory or the disk."""
+    if not RELEASE or not os.path.lexists(obj):
+        return
+    if os.path.islink(obj):
+        path = os.path.realpath(obj)
+        if _in_memory(path) and os.path.exists(path):
+            size = os.path.getsize(path)
+            os.remove(path)
+            _free(size)
+    os.remove(obj)
+    logger.debug('Staging: %s released.', obj)
+
+
+def release_product(product):
+    """Removes all the objects of the product left, e.g. the metadata."""
+    if not RELEASE:
+        return
+    path = _memory_path(product)
+    if os.path.isdir(path):
+        size = _size(path)
+        shutil.rmtree(path, ignore_errors=True)
+        _free(size)
+    shutil.rmtree(product, ignore_errors=True)
+    logger.info('Staging: %s released, %0.1f MB in memory.', product, _used.value / float(MB))
@@ -1,12 +1,24 @@
+from contextlib import contextmanager
 import sys
 import multiprocessing
+import time
 
+import NoDaemonProcess as ndp
+import admission
+import cluster
+from journal import journal
+import metrics
+import planner
 import proc_runner
 import snap_op as snap
+import staging
+import worker_pool
 from log import get_logger
 
 logger = get_logger()
 
+MB = 1024 ** 2
+
 indices_expr = {'ndvi': '(B7 + B4) != 0 ? (B7 - B4) / (B7 + B4) : -2',
                 'ndi45': '(B5 + B4) != 0 ? (B5 - B4) / (B5 + B4) : -2',
                 'gndvi': '(B7 + B3) != 0 ? (B7 - B3) / (B7 + B3) : -2'}
@@ -28,48 +40,229 @@ tasks_map = {'ndvi': task1,
              'gndvi': task3}
 
 
-def main(jobs, indices_expr, s3conf):
-    logger.info("%d cpu available" % multiprocessing.cpu_count())
+def _run_job(job, indices_expr, s3conf, workers=None, fused=False):
+    prod, proc_func, tasks = job
+    if fused:
+        tasks, indices_expr = proc_runner.fuse_tasks(tasks, indices_expr)
+    map_arg = {'product': prod,
+               'tasks': tasks,
+               'indices_expr': indices_expr}
+    logger.info('will run... %s', map_arg)
+    proc_runner.main(proc_func, map_arg, s3conf, workers)
+
+
+def _run_pipelined(jobs, indices_expr, s3conf, prefetch, workers=None, fused=False):
+    """Runs each product in its own process with at most 'prefetch' products
+    downloading ahead of the oldest product still being processed.
 
+    Each of the prefetch + 1 products in flight runs its whole pipeline, so
+    a product downloaded ahead is processed as soon as its tasks are
+    admitted: the processing of the products in flight is bounded by the
+    worker pool, if any, and by the budgets of admission, not by 'prefetch'.
+    """
+    running = []
     for job in jobs:
-        prod, proc_func, tasks = job
-        map_arg = {'product': prod,
-                   'tasks': tasks,
-                   'indices_expr': indices_expr}
-        logger.info('will run... %s', map_arg)
-        proc_runner.main(proc_func, map_arg, s3conf)
+        if len(running) > prefetch:
+            _join_job(*running.pop(0))
+        p = ndp.NoDaemonProcess(target=_run_job, args=(job, indices_expr, s3conf, workers, fused))
+        p.start()
+        running.append((job[0], p))
+    for prod, p in running:
+        _join_job(prod, p)
+
+
+def _join_job(prod, p):
+    p.join()
+    if p.exitcode != 0:
+        logger.error('Processing of %s failed with exit code %s.', prod, p.exitcode)
+
+
+@contextmanager
+def _pipeline(workers=0, maxtasksperchild=None, initializer=None):
+    """Sets up the processes shared by the products of a run and yields the
+    worker pool, None if 'workers' is 0."""
+    logger.info("%d cpu available", multiprocessing.cpu_count())
+    # replayed by every download, the records of the previous runs are merged
+    journal.compact()
+    staging.init()
+    logger.info('Processing budgets: %g cpus, %d MB.', admission.CPU_BUDGET, admission.MEMORY_BUDGET // MB)
+
+    # created before the product processes are forked so that they share it
+    pool = worker_pool.WorkerPool(workers, initializer, maxtasksperchild=maxtasksperchild).start() \
+        if workers > 0 else None
+    # the totals of all the processes are exported while the run is going
+    exporter = metrics.Exporter().start()
+    try:
+        yield pool
+    finally:
+        exporter.stop()
+        if pool:
+            pool.close()
+
+
+def main(jobs, indices_expr, s3conf, prefetch=0, workers=0, maxtasksperchild=None, initializer=None,
+         fused=False):
+    """
+    :param jobs: [[product, processing function, tasks],]
+    :param indices_expr: {'index': 'expr',}
+    :param s3conf: {'endpoint_url': '', 'bucket_id': ''}
+    :param prefetch: number of products downloaded ahead of the one being
+                     processed, 0 runs the products one after the other. The
+                     products downloaded ahead are processed as well, within
+                     the workers and the admission budgets
+    :param workers: number of warm processing workers shared by all the
+                    products, 0 runs the processing in the product processes
+    :param maxtasksperchild: number of tasks after which a worker is replaced
+    :param initializer: called once by each worker when it starts
+    :param fused: computes all the indices of a product in one task, the
+                  processing function takes the list of (index, expr)
+                  built by proc_runner.fuse_tasks
+    :return:
+    """
+    with _pipeline(workers, maxtasksperchild, initializer) as pool:
+        t0 = time.time()
+        if prefetch > 0:
+            _run_pipelined(jobs, indices_expr, s3conf, prefetch, pool, fused)
+        else:
+            for job in jobs:
+                _run_job(job, indices_expr, s3conf, pool, fused)
+    logger.info('Makespan of %d products (prefetch %d): %0.3f', len(jobs), prefetch, time.time() - t0)
+
+
+def main_coordinator(jobs, indices_expr, s3conf, address=(cluster.HOST, cluster.PORT)):
+    """Serves the jobs to the agents of a multi-node run until they are all
+    done.
+
+    :param jobs: [[product, processing function, tasks],], the processing
+                 function is ignored, it is chosen by the agents
+    :param address: (host, port) the coordinator listens on
+    :return:
+    """
+    t0 = time.time()
+    status = cluster.serve(cluster.Coordinator(jobs, indices_expr, s3conf), address)
+    for agent, st in sorted(status['agents'].items()):
+        logger.info('Agent %s: %d units done.', agent, st['done'])
+    logger.info('Makespan of %d products on %d agents: %0.3f, %d units failed.',
+                len(jobs), len(status['agents']), time.time() - t0, status['failed'])
+
+
+def main_agent(address, processor, prefetch=0, workers=0, maxtasksperchild=None, initializer=None,
+               fused=False):
+    """Runs the units of the coordinator at 'address' until all the units
+    of the run are done. The options are those of main."""
+    def run_job(product, tasks, indices_expr, s3conf):
+        _run_job([product, processor, tasks], indices_expr, s3conf, pool, fused)
+
+    with _pipeline(workers, maxtasksperchild, initializer) as pool:
+        nb_units = cluster.run_agent(address, run_job, prefetch + 1)
+    logger.info('Agent done, %d units run.', nb_units)
+
+
+def _get_args():
+    return [a for a in sys.argv[1:] if not a.startswith('--')]
+
+
+def _get_opts():
+    """Returns the '--key=value' options of the command line as a dict."""
+    opts = {}
+    for a in sys.argv[1:]:
+        if a.startswith('--'):
+            k, _, v = a[2:].partition('=')
+            opts[k] = v
+    return opts
 
 
 def _check_args():
-    if len(sys.argv) < 5:
-        usage = """required args: <s3_endpoint_url> <s3_bucket> <prod,..> <index,..>
+    if len(_get_args()) < 4 and 'agent' not in _get_opts():
+        usage = """required args: <s3_endpoint_url> <s3_bucket> <prod,..> <index,..> [--prefetch=N] [--roi=x,y,w,h]
+               [--workers=N] [--max-tasks-per-worker=N] [--fused] [--engine=snap|numpy]
+               [--cpus=N] [--memory-mb=N] [--coordinator=[host]:port] [--plan] [--no-plan]
+   or: --agent=host:port [--prefetch=N] [--workers=N] [--max-tasks-per-worker=N] [--fused]
+               [--engine=snap|numpy] [--cpus=N] [--memory-mb=N]
 prod - e.g. S2A_MSIL1C_20170202T090201_N0204_R007_T35SNA_20170202T090155.SAFE
-index - any of or all ndvi,ndi45,gndvi"""
+index - any of or all ndvi,ndi45,gndvi
+prefetch - number of products downloaded, and processed within the admission budgets, while
+           the current one is processed (default 0)
+roi - region of interest in pixels of the 60m processing grid, only the
+      band tiles covering it are downloaded (default: whole bands)
+workers - number of warm SNAP processing workers shared by all the products (default: number of cpus)
+max-tasks-per-worker - tasks after which a worker is replaced to release the JVM heap (default: never)
+fused - computes all the indices of a product with a single read, resample and subset
+engine - computes the indices with the SNAP BandMaths operator or the NumPy engine (default: snap)
+cpus - cpus the processing tasks are admitted against (default: number of cpus)
+memory-mb - memory the processing tasks are admitted against (default: 80% of the memory
+            not used by the staging area)
+coordinator - serves the products to the agents of a multi-node run instead of processing them,
+              on 127.0.0.1 unless a host is given, cluster_authkey must be set
+agent - processes the products served by the coordinator at host:port
+plan - prints the planned order of the products and their predicted timings without running them
+no-plan - runs the products in the order of the command line"""
         print(usage)
         raise SystemExit(1)
 
 
 def _get_s3_coords():
-    endpoint_url = sys.argv[1]
-    bucket_id = sys.argv[2]
+    args = _get_args()
+    endpoint_url = args[0]
+    bucket_id = args[1]
     return {'endpoint_url': endpoint_url,
             'bucket_id': bucket_id}
 
 
-def _build_jobs(processor):
-    products = sys.argv[3].split(',')
-    tasks_req = sys.argv[4].split(',')
+def _build_jobs(processor, roi=None):
+    args = _get_args()
+    products = args[2].split(',')
+    tasks_req = args[3].split(',')
     tasks = []
     for t in tasks_req:
-        tasks.append(tasks_map[t])
+        task = dict(tasks_map[t])
+        if roi:
+            task['roi'] = roi
+        tasks.append(task)
     return [[prod, processor, tasks] for prod in products]
 
 
 if __name__ == '__main__':
     _check_args()
+    opts = _get_opts()
+
+    roi = tuple(int(v) for v in opts['roi'].split(',')) if 'roi' in opts else None
+    admission.configure(float(opts.get('cpus', 0)), int(opts.get('memory-mb', 0)) * MB)
+
+    fused = 'fused' in opts
+    if opts.get('engine') == 'numpy':
+        processor = snap.main_numpy
+    else:
+        processor = snap.main_fused if fused else snap.main
+    # the agents get their jobs from the coordinator
+    jobs = None if 'agent' in opts else _build_jobs(processor, roi)
+    if jobs and 'no-plan' not in opts:
+        jobs, schedule = planner.plan(jobs, _get_s3_coords(),
+                                      prefetch=int(opts.get('prefetch', 0)),
+                                      workers=int(opts.get('workers', multiprocessing.cpu_count())),
+                                      fused=fused)
+        if 'plan' in opts:
+            print('\n'.join(planner.format_schedule(schedule)))
+            raise SystemExit(0)
 
-    main(_build_jobs(snap.main),
-         indices_expr,
-         _get_s3_coords())
+    if 'coordinator' in opts:
+        main_coordinator(jobs, indices_expr, _get_s3_coords(), cluster.parse_address(opts['coordinator']))
+    elif 'agent' in opts:
+        main_agent(cluster.parse_address(opts['agent']),
+                   processor,
+                   prefetch=int(opts.get('prefetch', 0)),
+                   workers=int(opts.get('workers', multiprocessing.cpu_count())),
+                   maxtasksperchild=int(opts.get('max-tasks-per-worker', 0)) or None,
+                   initializer=snap.init_worker,
+                   fused=fused)
+    else:
+        main(jobs,
+             indices_expr,
+             _get_s3_coords(),
+             prefetch=int(opts.get('prefetch', 0)),
+             workers=int(opts.get('workers', multiprocessing.cpu_count())),
+             maxtasksperchild=int(opts.get('max-tasks-per-worker', 0)) or None,
+             initializer=snap.init_worker,
+             fused=fused)
 
     logger.info('success.')
@@ -0,0 +1,341 @@
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import os
+import Queue
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from log import get_logger
+
+logger = get_logger()
+
+''' Parallel ranged download of objects with an adaptive number of
+    connections.
+
+    Every object is split in parts fetched with HTTP range requests by a
+    thread pool shared by all the objects in flight in the process. An
+    AdaptiveController bounds the total number of concurrent connections and
+    tunes it at runtime with an AIMD policy on the measured aggregate
+    throughput and error rate: the limit grows by one connection while the
+    throughput improves and is halved on errors, throttling or a throughput
+    drop. The part size follows the per-connection throughput so that a part
+    takes about PART_TARGET_TIME seconds.
+
+    The requests of the parts follow a RequestPolicy: a request taking much
+    longer than the recent ones of the same size is hedged, a duplicate
+    being sent and the first response used, and a part failing or timing
+    out is retried with an exponential backoff.
+'''
+
+MB = 1024 ** 2
+# Period over which the throughput is measured before adapting the limits.
+WINDOW = 1.
+# Duration a part download should last, used to size the parts.
+PART_TARGET_TIME = 2.
+# Relative throughput change considered significant.
+THROUGHPUT_TOLERANCE = 0.05
+# Period of the evaluation of the hedging delay while it is not known.
+HEDGE_POLL = 0.1
+# Error codes meaning the object store asks to slow down.
+THROTTLE_CODES = ('SlowDown', 'Throttling', 'RequestLimitExceeded', '503', 'ServiceUnavailable')
+
+
+def is_throttle(ex):
+    return isinstance(ex, ClientError) and \
+        ex.response.get('Error', {}).get('Code') in THROTTLE_CODES
+
+
+class PartTimeout(Exception):
+    pass
+
+
+def is_retryable(ex):
+    """Throttling, server errors, time outs and connection errors are
+    retried, the other errors of the object store, e.g. a missing object or
+    a denied access, are not."""
+    if isinstance(ex, ClientError):
+        status = ex.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        return is_throttle(ex) or status >= 500
+    return True
+
+
+class AdaptiveController(object):
+
+    def __init__(self, min_connections=4, max_connections=64, connections=8,
+                 min_part_size=5 * MB, max_part_size=64 * MB, part_size=8 * MB):
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.limit = max(min_connections, min(connections, max_connections))
+        self.min_part_size = min_part_size
+        self.max_part_size = max_part_size
+        self.part_size = part_size
+        self.active = 0
+        self._cond = threading.Condition()
+        self._reset_window(time.time())
+        self._last_throughput = 0.
+
+    def _reset_window(self, now):
+        self._window_start = now
+        self._bytes = 0
+        self._errors = 0
+        self._requests = 0
+        self._busy = 0.  # connection-seconds spent in requests
+
+    def acquire(self):
+        """Blocks until a connection is available."""
+        with self._cond:
+            while self.active >= self.limit:
+                self._cond.wait()
+            self.active += 1
+
+    def release(self, nbytes, elapsed, error=False):
+        """Gives back a connection and records the outcome of its request.
+
+        :param nbytes: bytes transferred
+        :param elapsed: duration of the request in seconds
+        :param error: True if the request failed or was throttled
+        """
+        with self._cond:
+            self.active -= 1
+            self._bytes += nbytes
+            self._busy += elapsed
+            self._requests += 1
+            self._errors += bool(error)
+            now = time.time()
+            if now - self._window_start >= WINDOW:
+                self._adapt(now)
+            self._cond.notify_all()
+
+    def _adapt(self, now):
+        """AIMD update of the limits. Must be called with the lock held."""
+        throughput = self._bytes / (now - self._window_start)
+        old = self.limit
+        if self._errors:
+            self.limit = max(self.min_connections, self.limit // 2)
+        elif throughput > self._last_throughput * (1 + THROUGHPUT_TOLERANCE):
+            self.limit = min(self.max_connections, self.limit + 1)
+        elif throughput < self._last_throughput * (1 - THROUGHPUT_TOLERANCE):
+            self.limit = max(self.min_connections, self.limit - max(1, self.limit // 4))
+        if self._busy > 0:
+            per_connection = self._bytes / self._busy
+            size = int(per_connection * PART_TARGET_TIME) // MB * MB
+            self.part_size = max(self.min_part_size, min(self.max_part_size, size))
+        if self.limit != old:
+            logger.debug('Transfer: %0.1f MB/s, %d errors, connections %d -> %d, part size %d MB',
+                         throughput / MB, self._errors, old, self.limit, self.part_size // MB)
+        self._last_throughput = throughput
+        self._reset_window(now)
+
+
+class RequestPolicy(object):
+    """Time outs, retries and hedging of the range requests.
+
+    The durations of the last requests are kept per process so that a
+    request is hedged once it runs 'hedge_multiplier' times longer than the
+    'hedge_quantile' of the recent requests of about the same size.
+    """
+
+    # number of recent requests the quantile is computed over
+    HISTORY = 256
+
+    def __init__(self, timeout=60., max_retries=4, backoff=0.5, hedge_multiplier=2.,
+                 hedge_quantile=0.95, hedge_min_samples=20):
+        """
+        :param timeout: seconds to wait for a part before retrying it
+        :param max_retries: number of retries of a part
+        :param backoff: seconds before the first retry, doubled at each retry
+        :param hedge_multiplier: 0 disables the hedged requests
+        :param hedge_quantile: quantile of the durations the hedging delay
+                               is based on
+        :param hedge_min_samples: number of requests of the same size to
+                                  observe before hedging
+        """
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.hedge_multiplier = hedge_multiplier
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self._history = deque(maxlen=self.HISTORY)
+        self._lock = threading.Lock()
+
+    def observe(self, size, duration):
+        with self._lock:
+            self._history.append((size, duration))
+
+    def hedge_delay(self, size):
+        """Returns the seconds after which a request of 'size' bytes is
+        hedged, None if it is not."""
+        if not self.hedge_multiplier:
+            return None
+        with self._lock:
+            durations = sorted(d for s, d in self._history if size / 2 <= s <= size * 2)
+        if len(durations) < self.hedge_min_samples:
+            return None
+        return self.hedge_multiplier * durations[int(self.hedge_quantile * (len(durations) - 1))]
+
+    def retry_delay(self, attempt):
+        """Exponential backoff with jitter before the retry 'attempt'."""
+        return self.backoff * 2 ** attempt * random.uniform(0.5, 1.)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(controller, kind='parts'):
+    """Returns the thread pool of the current process fetching the parts, or
+    sending the requests of the parts if 'kind' is 'requests'. A part may
+    wait for a hedged request so that the requests need threads of their
+    own."""
+    k = (os.getpid(), controller.max_connections, kind)
+    with _pools_lock:
+        if k not in _pools:
+            n = controller.max_connections * (2 if kind == 'requests' else 1)
+            _pools[k] = ThreadPool(processes=n)
+        return _pools[k]
+
+
+def get_range(client, bucket, key, start, end, controller, timer=None):
+    """Returns the bytes of the object between the offsets 'start' and 'end'
+    included, fetched over a connection granted by the controller.
+
+    :param timer: metrics.Timer of the object the first byte and the
+                  retries of the request are reported to, the bytes are
+                  reported by the caller, once per part whether it was
+                  hedged or not
+    """
+    controller.acquire()
+    t0 = time.time()
+    try:
+        resp = client.get_object(Bucket=bucket, Key=key, Range='bytes=%d-%d' % (start, end))
+        if timer:
+            timer.first_byte()
+        body = resp['Body'].read()
+        if timer:
+            timer.add(0, resp['ResponseMetadata'].get('RetryAttempts', 0))
+    except Exception as ex:
+        controller.release(0, time.time() - t0, error=True)
+        if is_throttle(ex):
+            logger.warn('%s - throttled by the object store: %s', key, ex)
+        raise
+    controller.release(len(body), time.time() - t0)
+    return body
+
+
+def _hedged_range(client, bucket, key, start, end, controller, policy, timer):
+    """Sends the request and, if it runs past the hedging delay, a
+    duplicate. Returns the first successful response, the only one whose
+    bytes are reported to the timer."""
+    responses = Queue.Queue()
+    pool = _get_pool(controller, 'requests')
+
+    def request():
+        t0 = time.time()
+        try:
+            body = get_range(client, bucket, key, start, end, controller, timer)
+        except Exception as ex:
+            responses.put((False, ex))
+        else:
+            policy.observe(len(body), time.time() - t0)
+            responses.put((True, body))
+
+    t0 = time.time()
+    deadline = t0 + policy.timeout
+    pool.apply_async(request)
+    pending = 1
+    hedged = False
+    while True:
+        # The delay is evaluated again while waiting, the requests sent
+        # before enough were observed can still be hedged.
+        delay = None if hedged else policy.hedge_delay(end - start + 1)
+        wake = deadline if hedged else min(deadline, t0 + delay if delay is not None else time.time() + HEDGE_POLL)
+        try:
+            ok, value = responses.get(timeout=max(0, wake - time.time()))
+        except Queue.Empty:
+            if time.time() >= deadline:
+                raise PartTimeout('%s - no response for bytes %d-%d after %0.1f s' % (key, start, end, policy.timeout))
+            if delay is not None and time.time() >= t0 + delay:
+                logger.debug('%s - hedging the request of bytes %d-%d after %0.3f s', key, start, end, delay)
+                if timer:
+                    timer.hedge()
+                pool.apply_async(request)
+                pending += 1
+                hedged = True
+            continue
+        if ok:
+            if timer:
+                timer.add(len(value))
+            return value
+        pending -= 1
+        if not pending:
+            raise value
+
+
+def fetch_range(client, bucket, key, start, end, controller, policy, timer=None):
+    """Same as get_range with the time out, the hedging and the retries of
+    the request policy."""
+    for attempt in range(policy.max_retries + 1):
+        try:
+            return _hedged_range(client, bucket, key, start, end, controller, policy, timer)
+        except Exception as ex:
+            if attempt == policy.max_retries or not is_retryable(ex):
+                raise
+            delay = policy.retry_delay(attempt)
+            logger.warn('%s - bytes %d-%d failed, retrying in %0.1f s: %s', key, start, end, delay, ex)
+            if timer:
+                timer.add(0, retries=1)
+            time.sleep(delay)
+
+
+def _get_part(client, bucket, key, dest, start, end, controller, policy, lock, timer, on_part):
+    body = fetch_range(client, bucket, key, start, end, controller, policy, timer)
+    with lock:
+        with open(dest, 'r+b') as f:
+            f.seek(start)
+            f.write(body)
+    if on_part:
+        on_part(start)
+    return len(body)
+
+
+def download(client, bucket, key, dest, size, controller, policy, timer=None,
+             part_size=None, parts_done=(), on_part=None):
+    """Downloads the object to 'dest' with parallel range requests. The parts
+    are written to a temporary file renamed to 'dest' once complete.
+
+    :param client: S3 client
+    :param bucket: bucket name
+    :param key: object key
+    :param dest: local file name
+    :param size: size of the object in bytes
+    :param controller: AdaptiveController bounding the connections
+    :param policy: RequestPolicy of the requests of the parts
+    :param timer: metrics.Timer of the object
+    :param part_size: size of the parts, the one of the controller if None
+    :param parts_done: offsets of the parts already in the temporary file
+                       of an interrupted download, which is resumed
+    :param on_part: function(offset) called once a part is written
+    :return: number of bytes downloaded
+    """
+    part_size = part_size or controller.part_size
+    tmp = dest + '.part'
+    if not parts_done or not os.path.exists(tmp) or os.path.getsize(tmp) != size:
+        parts_done = ()
+        with open(tmp, 'wb') as f:
+            f.truncate(size)
+    elif timer:
+        timer.extra['resumed_parts'] = len(parts_done)
+    parts_done = set(parts_done)
+    lock = threading.Lock()
+    pool = _get_pool(controller)
+    res = [pool.apply_async(_get_part, args=(client, bucket, key, tmp, start,
+                                             min(start + part_size, size) - 1, controller, policy,
+                                             lock, timer, on_part))
+           for start in range(0, size, part_size) if start not in parts_done]
+    nbytes = sum(r.get() for r in res)
+    os.rename(tmp, dest)
+    return nbytes
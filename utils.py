@@ -24,5 +24,36 @@ def config_get(opt, default=''):
     return parser.get(CONFIG_SECTION, opt, default)
 
 
+def config_get_str(opt, default):
+    """Returns the option 'opt' or 'default' if it is not set."""
+    try:
+        return config_get(opt).strip() or default
+    except Exception:
+        return default
+
+
+def config_get_num(opt, default, type=int):
+    """Returns the numerical option 'opt' or 'default' if it is not set."""
+    try:
+        return type(config_get(opt).strip())
+    except Exception:
+        return default
+
+
 def rdm_sleep(offset=0):
-    time.sleep(.001 * randint(10, 100) + offset)
\ No newline at end of file
+    time.sleep(.001 * randint(10, 100) + offset)
+
+
+class Lazy(object):
+    """Proxy of the object returned by 'loader', called on the first access
+    to one of its attributes, to defer a heavy import to the code paths
+    which need it."""
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._target = None
+
+    def __getattr__(self, name):
+        if self._target is None:
+            self._target = self._loader()
+        return getattr(self._target, name)
@@ -0,0 +1,135 @@
+from multiprocessing import Array, Process, Queue
+import threading
+import time
+
+import Shared
+from log import get_logger
+
+logger = get_logger()
+
+''' Pool of warm processing workers.
+
+    The pool is created once per run, before the product processes are
+    forked, so that all of them submit their tasks to the same workers
+    through the inherited task queue. Each worker runs the initializer once,
+    e.g. to start the JVM and register the SNAP operators, and then serves
+    the tasks of any product. With 'maxtasksperchild' a worker exits after
+    that many tasks, which bounds the growth of the JVM heap, and is replaced
+    by the supervisor thread of the pool.
+
+    The completion of a task is reported through the shared index: the key
+    given at submission is set ready with the value OK or FAILED.
+'''
+
+OK = 0
+FAILED = 1
+
+# Period of the check of the workers by the supervisor.
+SUPERVISE_PERIOD = 0.1
+
+
+def _worker(tasks, current, initializer, initargs, maxtasks):
+    if initializer:
+        initializer(*initargs)
+    done = 0
+    while not maxtasks or done < maxtasks:
+        task = tasks.get()
+        if task is None:
+            break
+        k, func, args = task
+        current.value = k.encode('utf-8')
+        try:
+            func(*args)
+            status = OK
+        except Exception:
+            logger.exception('Task %s failed.', k)
+            status = FAILED
+        Shared.shared.write(k, status)
+        Shared.shared.write(k, True)
+        current.value = b''
+        done += 1
+
+
+class WorkerPool(object):
+
+    def __init__(self, nb_workers, initializer=None, initargs=(), maxtasksperchild=None):
+        """
+        :param nb_workers: number of worker processes
+        :param initializer: called once by each worker when it starts
+        :param initargs: arguments of the initializer
+        :param maxtasksperchild: number of tasks after which a worker is
+                                 replaced, None to keep the workers for the
+                                 whole run
+        """
+        self.nb_workers = nb_workers
+        self.initializer = initializer
+        self.initargs = initargs
+        self.maxtasksperchild = maxtasksperchild
+        self.tasks = Queue()
+        self._workers = []
+        self._closing = False
+        self._supervisor = threading.Thread(target=self._supervise, name='worker-pool-supervisor')
+        self._supervisor.daemon = True
+
+    def _start_worker(self, i):
+        current = Array('c', Shared.KEY_SIZE, lock=False)
+        p = Process(target=_worker, name='ProcessingWorker-%d' % i,
+                    args=(self.tasks, current, self.initializer, self.initargs, self.maxtasksperchild))
+        p.daemon = True
+        p.start()
+        return p, current
+
+    def start(self):
+        self._workers = [self._start_worker(i) for i in range(self.nb_workers)]
+        self._supervisor.start()
+        return self
+
+    def _supervise(self):
+        """Replaces the workers which exited, failing the task a worker was
+        running when it died."""
+        while self._workers:
+            for i, (p, current) in enumerate(self._workers):
+                if p.is_alive():
+                    continue
+                p.join()
+                if current.value:
+                    k = current.value.decode('utf-8')
+                    logger.error('Worker %s died with exit code %s running task %s.', p.name, p.exitcode, k)
+                    Shared.shared.write(k, FAILED)
+                    Shared.shared.write(k, True)
+                if self._closing:
+                    self._workers[i] = None
+                else:
+                    logger.debug('Replacing worker %s.', p.name)
+                    self._workers[i] = self._start_worker(i)
+            self._workers = [w for w in self._workers if w is not None]
+            time.sleep(SUPERVISE_PERIOD)
+
+    def submit(self, k, func, args=()):
+        """Queues the call of 'func' with 'args'. Can be called from any
+        process forked after the pool was started.
+
+        :param k: shared index key the completion of the task is reported to
+        :return:
+        """
+        Shared.shared.subscribe(k)
+        self.tasks.put((k, func, args))
+
+    def wait(self, keys):
+        """Blocks until the tasks are done.
+
+        :return: True if all of them succeeded
+        """
+        Shared.shared.wait(keys)
+        return not self.failed(keys)
+
+    def failed(self, keys):
+        """Returns the keys of the tasks done which failed."""
+        return [k for k in keys if Shared.shared.is_ready(k) and Shared.shared.read(k) != OK]
+
+    def close(self):
+        """Stops the workers once the queued tasks are done."""
+        self._closing = True
+        for _ in range(self.nb_workers):
+            self.tasks.put(None)
+        self._supervisor.join()